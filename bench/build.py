@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+# compares the compiled Models.build path against the original
+# reflection-based implementation on a synthetic feed
+#
+# usage: python bench/build.py [posts] [repeat]
+
+import sys
+import pathlib
+import inspect as ins
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import hoordu.models as m
+from sqlalchemy import inspect
+
+import schemas as s
+
+
+class LegacyBuildContext:
+    def __init__(self, parent=None):
+        self.parent = parent
+        if self.parent is not None:
+            self._refs = self.parent._refs.copy()
+        else:
+            self._refs = set()
+    
+    def push(self):
+        return LegacyBuildContext(self)
+    
+    # same as BuildContext.nested
+    def nested(self, obj):
+        if self._ref(obj) in self._refs:
+            return None
+        
+        ctx = LegacyBuildContext()
+        ctx._refs = {r for r in self._refs if r[0] is type(obj)}
+        return ctx
+    
+    @staticmethod
+    def _ref(v):
+        i = inspect(v.__class__)
+        key = []
+        for pk in i.primary_key:
+            k = next((attr for attr in i.c.keys() if i.c[attr].name == pk.name), None)
+            key.append(getattr(v, k))
+        
+        return (type(v), tuple(key))
+    
+    def check(self, v):
+        if not hasattr(v, '__table__'):
+            return True
+        
+        ref = self._ref(v)
+        if ref in self._refs:
+            return False
+        
+        self._refs.add(ref)
+        return True
+
+class LegacyModels(s.Models):
+    def _conv_list(self, l, ctx):
+        r = []
+        for v in l:
+            rv = self.build(v, ctx.push())
+            if rv is not None:
+                r.append(rv)
+        
+        return r
+    
+    def build(self, obj, ctx=None):
+        if ctx is None:
+            ctx = LegacyBuildContext()
+        
+        classes = ins.getmro(type(obj))
+        
+        conv = self._find(self.converters, classes)
+        if conv is not None:
+            obj = conv(obj, ctx)
+            classes = ins.getmro(type(obj))
+        
+        target = self._find(self.models, classes)
+        if target is not None:
+            ctx.check(obj)
+            d = {k: self.build(v, ctx.push()) for k, v in obj.__dict__.items() if not k.startswith('_') and ctx.check(v)}
+            return target(**d)
+        
+        else:
+            return obj
+
+
+def file_fields(file):
+    return dict(
+        id=file.id,
+        local_id=file.local_id,
+        local_order=file.local_order,
+        remote_id=file.remote_id,
+        remote_order=file.remote_order,
+        file_url=f'/data/files/{file.id}',
+        thumb_url=f'/data/thumbs/{file.id}',
+        hash=file.hash.hex() if file.hash is not None else None,
+        filename=file.filename,
+        mime=file.mime,
+        metadata=file.metadata_,
+        remote_identifier=file.remote_identifier,
+    )
+
+def register_converters(models):
+    @models.register_converter(m.File)
+    def convert_file(file, ctx):
+        return s.File(**file_fields(file))
+    
+    @models.register_converter(m.Related)
+    def convert_related(related, ctx):
+        if related.remote is not None:
+            nested = ctx.nested(related.remote)
+            if nested is not None:
+                return models.build(related.remote, nested)
+        
+        return None
+
+
+def make_post(source, tags, id, files):
+    post = m.RemotePost(
+        id=id,
+        source_id=source.id,
+        source=source,
+        original_id=str(id),
+        url=f'https://example.com/{id}',
+        title=f'post {id}',
+        comment='lorem ipsum ' * 8,
+        post_time=datetime(2020, 1, 1),
+        type=next(iter(m.PostType)),
+        metadata_=None,
+    )
+    post.files = [
+        m.File(
+            id=id * 100 + i,
+            local_id=None,
+            local_order=None,
+            remote_id=id,
+            remote_order=i,
+            hash=bytes(16),
+            filename=f'{i}.png',
+            mime='image/png',
+            metadata_=None,
+            remote_identifier=None,
+        )
+        for i in range(files)
+    ]
+    post.tags = tags
+    return post
+
+def make_feed(count, files=4, tags=12, related=3):
+    source = m.Source(id=1, name='bench', config=None, metadata_=None)
+    source.preferred_plugin = m.Plugin(id=1, name='bench', source_id=1, source=source)
+    category = next(iter(m.TagCategory))
+    all_tags = [m.RemoteTag(id=i, source_id=1, source=source, category=category, tag=f'tag{i}') for i in range(tags * 4)]
+    
+    entries = []
+    for i in range(count):
+        post = make_post(source, all_tags[i % 4::4][:tags], i + 1, files)
+        post.related = [
+            m.Related(remote=make_post(source, [], 10000 + i * related + j, files))
+            for j in range(related)
+        ]
+        entries.append(m.FeedEntry(sort_index=i + 1, post=post))
+    
+    return entries
+
+
+def main():
+    posts = int(sys.argv[1]) if len(sys.argv) >= 2 else 20
+    repeat = int(sys.argv[2]) if len(sys.argv) >= 3 else 50
+    
+    legacy = LegacyModels()
+    legacy.models = s.models.models
+    register_converters(legacy)
+    register_converters(s.models)
+    
+    feed = make_feed(posts)
+    
+    assert [e.model_dump() for e in legacy.build(feed)] == [e.model_dump() for e in s.models.build(feed)]
+    
+    for name, func in (
+            ('legacy', lambda: legacy.build(feed)),
+            ('compiled', lambda: s.models.build(feed))):
+        best = min(timeit.repeat(func, number=1, repeat=repeat))
+        print(f'{name:>10}: {best * 1000:8.2f} ms per {posts}-post feed')
+
+
+if __name__ == '__main__':
+    main()
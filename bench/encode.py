@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# compares serializing a synthetic feed through the pydantic models, the
+# way the api routes do, against the fastjson encoder and its normalized
+# output
+#
+# usage: python bench/encode.py [posts] [repeat]
+
+import sys
+import pathlib
+import json
+import timeit
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import hoordu.models as m
+from pydantic import TypeAdapter
+
+import schemas as s
+import fastjson
+from build import make_feed, register_converters, file_fields
+
+
+def register_encoders(encoder):
+    @encoder.register_converter(m.File)
+    def encode_file(file, ctx, sel=None):
+        return file_fields(file)
+    
+    @encoder.register_converter(m.Related)
+    def encode_related(related, ctx, sel=None):
+        if related.remote is not None:
+            nested = ctx.nested(related.remote)
+            if nested is not None:
+                return encoder.to_json(related.remote, nested, sel)
+        
+        return None
+
+
+def make_normalizer(encoder):
+    normalizer = fastjson.Normalizer(encoder, {
+        m.RemotePost: 'posts',
+        m.File: 'files',
+        m.RemoteTag: 'tags',
+        m.Source: 'sources',
+    })
+    normalizer.register_unwrap(m.Related)(lambda related: related.remote)
+    return normalizer
+
+
+def serialize_pydantic(feed):
+    # mirrors fastapi's serialize_response with exclude_unset and by field name
+    adapter = TypeAdapter(list[s.FeedEntry])
+    content = [e.model_dump(by_alias=True, exclude_unset=True) for e in s.models.build(feed)]
+    value = adapter.validate_python(content)
+    data = adapter.dump_python(value, mode='json', by_alias=False, exclude_unset=True)
+    return json.dumps(data, ensure_ascii=False, allow_nan=False, indent=None, separators=(',', ':')).encode('utf-8')
+
+
+def main():
+    posts = int(sys.argv[1]) if len(sys.argv) >= 2 else 20
+    repeat = int(sys.argv[2]) if len(sys.argv) >= 3 else 50
+    
+    register_converters(s.models)
+    encoder = fastjson.Encoder(s.models)
+    register_encoders(encoder)
+    normalizer = make_normalizer(encoder)
+    
+    feed = make_feed(posts)
+    
+    assert serialize_pydantic(feed) == encoder.encode(feed)
+    
+    for name, func in (
+            ('pydantic', lambda: serialize_pydantic(feed)),
+            ('fastjson', lambda: encoder.encode(feed)),
+            ('normalized', lambda: normalizer.encode(feed))):
+        best = min(timeit.repeat(func, number=1, repeat=repeat))
+        size = len(func())
+        print(f'{name:>10}: {best * 1000:8.2f} ms, {size} bytes per {posts}-post feed')
+
+
+if __name__ == '__main__':
+    main()
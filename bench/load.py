@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+
+# runs every endpoint in-process against the data made by bench/seed.py
+# at a fixed concurrency and reports latency percentiles, throughput and
+# peak rss, results are saved per commit so runs can be compared
+#
+# usage (from the repository root):
+#   python bench/load.py [--concurrency 16] [--requests 500] [--only feed,search]
+#   python bench/load.py --compare bench/results/<old>.json bench/results/<new>.json
+
+import sys
+import pathlib
+import argparse
+import asyncio
+import json
+import resource
+import subprocess
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import orjson
+
+from server import app
+from seed import source_name, subscription_name, gallery_name
+
+
+RESULTS = pathlib.Path(__file__).resolve().parent / 'results'
+
+
+# minimal asgi client, no sockets involved
+class Client:
+    def __init__(self, app):
+        self.app = app
+    
+    @staticmethod
+    def _scope(type, path, query, headers=()):
+        return {
+            'type': type,
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'scheme': 'http' if type == 'http' else 'ws',
+            'path': path,
+            'raw_path': path.encode(),
+            'root_path': '',
+            'query_string': urlencode(query or {}).encode(),
+            'headers': [(b'host', b'bench'), *headers],
+            'client': ('127.0.0.1', 0),
+            'server': ('bench', 80),
+        }
+    
+    async def _http(self, method, path, query=None, body=None, collect=False):
+        data = orjson.dumps(body) if body is not None else b''
+        headers = []
+        if body is not None:
+            headers.append((b'content-type', b'application/json'))
+            headers.append((b'content-length', str(len(data)).encode()))
+        
+        scope = self._scope('http', path, query, headers)
+        scope['method'] = method
+        
+        sent = False
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {'type': 'http.request', 'body': data, 'more_body': False}
+            
+            await asyncio.Event().wait()
+        
+        status = None
+        response_headers = {}
+        size = 0
+        content = bytearray()
+        async def send(message):
+            nonlocal status, size
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                response_headers.update((k.decode().lower(), v.decode()) for k, v in message.get('headers', ()))
+            elif message['type'] == 'http.response.body':
+                chunk = message.get('body', b'')
+                size += len(chunk)
+                if collect:
+                    content.extend(chunk)
+        
+        await self.app(scope, receive, send)
+        return status, size, response_headers, content
+    
+    async def request(self, method, path, query=None, body=None):
+        status, size, _, _ = await self._http(method, path, query, body)
+        return status, size
+    
+    async def json(self, path, query=None):
+        status, _, headers, content = await self._http('GET', path, query, collect=True)
+        return status, headers, orjson.loads(content)
+    
+    # reads the websocket feed until `count` posts arrived or it ends
+    async def feed(self, path, query, count):
+        incoming = asyncio.Queue()
+        outgoing = asyncio.Queue()
+        incoming.put_nowait({'type': 'websocket.connect'})
+        
+        scope = self._scope('websocket', path, query)
+        scope['subprotocols'] = []
+        
+        async def send(message):
+            outgoing.put_nowait(message)
+        
+        task = asyncio.create_task(self.app(scope, incoming.get, send))
+        received = 0
+        size = 0
+        try:
+            while received < count:
+                message = await outgoing.get()
+                if message['type'] == 'websocket.close':
+                    break
+                
+                if message['type'] != 'websocket.send':
+                    continue
+                
+                text = message.get('text') or ''
+                size += len(text)
+                frame = orjson.loads(text)
+                received += len(frame.get('entries') or ())
+                if frame['c'] == 'end':
+                    break
+            
+            incoming.put_nowait({'type': 'websocket.receive', 'text': '{"c": "stop"}'})
+            incoming.put_nowait({'type': 'websocket.disconnect', 'code': 1000})
+            await asyncio.wait_for(task, 10)
+        
+        finally:
+            task.cancel()
+        
+        return 200, size
+
+
+class Lifespan:
+    def __init__(self, app):
+        self.app = app
+        self.incoming = asyncio.Queue()
+        self.outgoing = asyncio.Queue()
+    
+    async def _send(self, message):
+        self.outgoing.put_nowait(message)
+    
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self.app({'type': 'lifespan', 'asgi': {'version': '3.0'}}, self.incoming.get, self._send))
+        self.incoming.put_nowait({'type': 'lifespan.startup'})
+        await self.outgoing.get()
+        return self
+    
+    async def __aexit__(self, *exc):
+        self.incoming.put_nowait({'type': 'lifespan.shutdown'})
+        await self.outgoing.get()
+        await self.task
+
+
+def scenarios(post_ids):
+    source = source_name(0)
+    subscription = subscription_name(0)
+    feed = f'/api/source/{source}/subscription/{subscription}/feed'
+    
+    urls = [f'https://example.com/{s}/{i}' for s in range(2) for i in range(50)]
+    
+    def rotate(f):
+        i = 0
+        def next_request(client):
+            nonlocal i
+            i += 1
+            return f(client, post_ids[i % len(post_ids)])
+        return next_request
+    
+    return {
+        'sources': lambda c: c.request('GET', '/api/sources'),
+        'source': lambda c: c.request('GET', f'/api/source/{source}'),
+        'plugins': lambda c: c.request('GET', '/api/plugins'),
+        'parse_batch': lambda c: c.request('POST', '/api/parse', body={'urls': urls}),
+        'subscriptions': lambda c: c.request('GET', f'/api/source/{source}/subscriptions'),
+        'source_stats': lambda c: c.request('GET', f'/api/source/{source}/stats'),
+        'tags_top': lambda c: c.request('GET', '/api/tags/top', {'count': 100}),
+        'post': rotate(lambda c, id: c.request('GET', f'/api/post/{id}')),
+        'posts_batch': lambda c: c.request('POST', '/api/posts', body={'ids': post_ids[:100]}),
+        'related': rotate(lambda c, id: c.request('GET', f'/api/post/{id}/related')),
+        'graph': rotate(lambda c, id: c.request('GET', f'/api/post/{id}/graph', {'depth': 3})),
+        'source_posts': lambda c: c.request('GET', f'/api/source/{source}/posts', {'count': 20}),
+        'source_posts_sparse': lambda c: c.request('GET', f'/api/source/{source}/posts',
+            {'count': 20, 'include': 'files', 'fields': 'title'}),
+        'source_posts_normalized': lambda c: c.request('GET', f'/api/source/{source}/posts',
+            {'count': 20, 'normalize': 'true'}),
+        'feed': lambda c: c.request('GET', feed, {'count': 20}),
+        'timeline': lambda c: c.request('POST', '/api/timeline', {'count': 20},
+            body={'sources': [source_name(0), source_name(1)]}),
+        'gallery': lambda c: c.request('GET', f'/api/gallery/{gallery_name(0)}', {'count': 20}),
+        'random': lambda c: c.request('GET', '/api/random', {'count': 20}),
+        'search': lambda c: c.request('GET', '/api/search', {'query': 'tag-0 tag-1', 'count': 20}),
+        'search_text': lambda c: c.request('GET', '/api/search', {'query': 'text:lorem', 'count': 20, 'sort': 'rank'}),
+        'export': lambda c: c.request('GET', f'/api/source/{source}/export', {'chunk': 200}),
+        'ws_feed': lambda c: c.feed(feed, {'count': 40, 'batch': 20, 'live': 'false'}, 40),
+    }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def peak_rss_mb():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(client, func, requests, concurrency):
+    latencies = []
+    errors = 0
+    remaining = requests
+    
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            try:
+                status, _ = await func(client)
+                if status is None or status >= 400:
+                    errors += 1
+            except Exception:
+                errors += 1
+            
+            latencies.append(time.perf_counter() - start)
+    
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    
+    return dict(
+        requests=len(latencies),
+        errors=errors,
+        p50_ms=percentile(latencies, 50) * 1000,
+        p99_ms=percentile(latencies, 99) * 1000,
+        rps=len(latencies) / elapsed,
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+
+async def bench(args):
+    client = Client(app)
+    results = {}
+    async with Lifespan(app):
+        status, _ = await client.request('GET', f'/api/source/{source_name(0)}')
+        if status != 200:
+            raise SystemExit('no benchmark data, run bench/seed.py first')
+        
+        # post ids come from the api so they always exist
+        post_ids = []
+        cursor = None
+        while len(post_ids) < 200:
+            query = {'count': 100, 'include': '', 'fields': ''}
+            if cursor is not None:
+                query['cursor'] = cursor
+            _, headers, entries = await client.json(f'/api/source/{source_name(0)}/posts', query)
+            post_ids.extend(e['post']['id'] for e in entries)
+            cursor = headers.get('x-next-cursor')
+            if cursor is None:
+                break
+        
+        selected = scenarios(post_ids)
+        if args.only:
+            selected = {k: v for k, v in selected.items() if k in args.only.split(',')}
+        
+        for name, func in selected.items():
+            # warm caches and connections first
+            await run(client, func, min(args.requests, args.concurrency * 2), args.concurrency)
+            r = results[name] = await run(client, func, args.requests, args.concurrency)
+            print(f'{name:>24}: p50 {r["p50_ms"]:8.2f} ms  p99 {r["p99_ms"]:8.2f} ms  '
+                  f'{r["rps"]:8.1f} req/s  rss {r["peak_rss_mb"]:7.1f} MiB  errors {r["errors"]}')
+    
+    return results
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                cwd=RESULTS.parent, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def save(args, results):
+    RESULTS.mkdir(exist_ok=True)
+    rev = commit()
+    now = datetime.now(timezone.utc)
+    path = RESULTS / f'{now:%Y%m%d-%H%M%S}-{rev}.json'
+    path.write_text(json.dumps(dict(
+        commit=rev,
+        date=now.isoformat(),
+        concurrency=args.concurrency,
+        requests=args.requests,
+        results=results,
+    ), indent=2))
+    print(f'saved {path}')
+
+def compare(old_path, new_path):
+    old = json.loads(pathlib.Path(old_path).read_text())
+    new = json.loads(pathlib.Path(new_path).read_text())
+    print(f'{old["commit"]} -> {new["commit"]}')
+    for name, n in new['results'].items():
+        o = old['results'].get(name)
+        if o is None:
+            continue
+        
+        def delta(key):
+            return (n[key] - o[key]) / o[key] * 100 if o[key] else 0.0
+        
+        print(f'{name:>24}: p50 {delta("p50_ms"):+7.1f}%  p99 {delta("p99_ms"):+7.1f}%  '
+              f'req/s {delta("rps"):+7.1f}%')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='in-process load benchmark of the api')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=500, help='per endpoint')
+    parser.add_argument('--only', help='comma separated scenario names')
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+    
+    if args.compare:
+        compare(*args.compare)
+        return
+    
+    results = asyncio.run(bench(args))
+    if not args.no_save:
+        save(args, results)
+
+
+if __name__ == '__main__':
+    main()
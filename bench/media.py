@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+# drives the media server in-process: throughput of full and ranged reads
+# of a large file and request rate of many concurrent small thumbnail reads
+#
+# the server's zero copy send can't be measured in-process, these numbers
+# are for the chunked fallback
+#
+# usage: python bench/media.py [large file MiB] [thumbnails] [concurrency]
+
+import sys
+import pathlib
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from media import MediaFiles
+
+
+async def request(app, path, headers=(), query=b''):
+    status = None
+    size = 0
+    length = None
+    
+    async def receive():
+        return {'type': 'http.disconnect'}
+    
+    async def send(message):
+        nonlocal status, size, length
+        match message['type']:
+            case 'http.response.start':
+                status = message['status']
+                length = int(dict(message['headers']).get(b'content-length', 0))
+            
+            case 'http.response.body':
+                size += len(message.get('body', b''))
+    
+    scope = {
+        'type': 'http',
+        'method': 'GET',
+        'path': path,
+        'root_path': '',
+        'query_string': query,
+        'headers': [(k.encode(), v.encode()) for k, v in headers],
+    }
+    await app(scope, receive, send)
+    assert length == size
+    return status, size
+
+
+def check(app, size, digest):
+    async def run():
+        assert await request(app, '/large.bin') == (200, size)
+        assert await request(app, '/large.bin', [('range', 'bytes=0-99')]) == (206, 100)
+        assert (await request(app, '/large.bin', [('range', f'bytes={size}-')]))[0] == 416
+        assert (await request(app, '/large.bin', [('range', 'bytes=0-9,5-19')])) == (206, 20)
+        assert (await request(app, '/large.bin', [('range', 'bytes=0-0,-1,100-199')]))[0] == 206
+        assert (await request(app, '/../etc/passwd'))[0] == 404
+        assert (await request(app, '/thumbs/0.jpg', [('if-none-match', f'"{digest}"')], f'v={digest}'.encode()))[0] == 304
+        # a version that isn't the content's hash isn't trusted
+        assert (await request(app, '/thumbs/0.jpg', [('if-none-match', '"abc"')], b'v=abc'))[0] == 200
+    
+    asyncio.run(run())
+
+
+def bench_large(app, size, repeat=5):
+    async def full():
+        return await request(app, '/large.bin')
+    
+    async def ranges():
+        # a video player seeking around the file
+        step = size // 16
+        for i in range(16):
+            await request(app, '/large.bin', [('range', f'bytes={i * step}-{i * step + 1024 * 1024 - 1}')])
+    
+    for name, func, total in (
+            ('full', full, size),
+            ('ranges', ranges, 16 * 1024 * 1024)):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            asyncio.run(func())
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        
+        print(f'{name:>10}: {total / best / 1024 / 1024:10.1f} MiB/s')
+
+
+def bench_thumbs(app, count, concurrency, digest):
+    async def run():
+        sem = asyncio.Semaphore(concurrency)
+        
+        async def one(i):
+            async with sem:
+                return await request(app, f'/thumbs/{i}.jpg', query=f'v={digest}'.encode())
+        
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one(i) for i in range(count)))
+        elapsed = time.perf_counter() - start
+        assert all(status == 200 for status, _ in results)
+        return elapsed
+    
+    elapsed = asyncio.run(run())
+    print(f'{"thumbs":>10}: {count / elapsed:10.1f} req/s, {count} files at concurrency {concurrency}')
+
+
+def main():
+    large = int(sys.argv[1]) if len(sys.argv) >= 2 else 256
+    thumbs = int(sys.argv[2]) if len(sys.argv) >= 3 else 2000
+    concurrency = int(sys.argv[3]) if len(sys.argv) >= 4 else 64
+    
+    with tempfile.TemporaryDirectory() as directory:
+        size = large * 1024 * 1024
+        with open(os.path.join(directory, 'large.bin'), 'wb') as f:
+            chunk = os.urandom(1024 * 1024)
+            for _ in range(large):
+                f.write(chunk)
+        
+        os.mkdir(os.path.join(directory, 'thumbs'))
+        data = os.urandom(24 * 1024)
+        for i in range(thumbs):
+            with open(os.path.join(directory, 'thumbs', f'{i}.jpg'), 'wb') as f:
+                f.write(data)
+        
+        digest = hashlib.md5(data).hexdigest()
+        app = MediaFiles(directory)
+        check(app, size, digest)
+        bench_large(app, size)
+        bench_thumbs(app, thumbs, concurrency, digest)
+
+
+if __name__ == '__main__':
+    main()
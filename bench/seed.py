@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+# seeds the configured hoordu database with synthetic data for the load
+# benchmarks, everything it creates hangs off sources named bench-<n>
+# and galleries named bench-<n>, and is removed with --drop
+#
+# usage (from the repository root):
+#   python bench/seed.py [--sources 2] [--subscriptions 4] [--posts 20000]
+#       [--files 4] [--tags 12] [--tag-pool 2000] [--related 2]
+#       [--gallery 5000] [--seed 0]
+#   python bench/seed.py --drop
+
+import sys
+import pathlib
+import argparse
+import asyncio
+import hashlib
+import random
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import hoordu
+from hoordu.models import *
+from sqlalchemy import delete, insert, select
+
+from server import Gallery
+
+
+PREFIX = 'bench-'
+BATCH = 5000
+
+
+def source_name(i):
+    return f'{PREFIX}{i}'
+
+def subscription_name(i):
+    return f'{PREFIX}sub-{i}'
+
+def gallery_name(i):
+    return f'{PREFIX}{i}'
+
+
+async def insert_many(session, table, rows):
+    ids = []
+    for i in range(0, len(rows), BATCH):
+        q = insert(table).returning(table.c.id, sort_by_parameter_order=True)
+        result = await session.execute(q, rows[i:i + BATCH])
+        ids.extend(result.scalars())
+    
+    return ids
+
+async def insert_plain(session, table, rows):
+    for i in range(0, len(rows), BATCH):
+        await session.execute(insert(table), rows[i:i + BATCH])
+
+
+async def seed(hrd, args):
+    rng = random.Random(args.seed)
+    start = datetime(2020, 1, 1)
+    
+    async with hrd.session() as session:
+        for s in range(args.sources):
+            t = time.perf_counter()
+            
+            source_id, = await insert_many(session, Source.__table__, [
+                dict(name=source_name(s)),
+            ])
+            
+            subscription_ids = await insert_many(session, Subscription.__table__, [
+                dict(source_id=source_id, name=subscription_name(i), options='{}')
+                for i in range(args.subscriptions)
+            ])
+            
+            tag_ids = await insert_many(session, RemoteTag.__table__, [
+                dict(source_id=source_id, category=TagCategory.general, tag=f'tag-{i}')
+                for i in range(args.tag_pool)
+            ])
+            
+            post_ids = await insert_many(session, RemotePost.__table__, [
+                dict(
+                    source_id=source_id,
+                    original_id=str(i),
+                    url=f'https://example.com/{s}/{i}',
+                    title=f'post {i}',
+                    comment=' '.join(rng.choice(('lorem', 'ipsum', 'dolor', 'sit', 'amet')) for _ in range(20)),
+                    type=PostType.set,
+                    post_time=start + timedelta(minutes=i),
+                )
+                for i in range(args.posts)
+            ])
+            
+            await insert_plain(session, File.__table__, [
+                dict(
+                    remote_id=post_id,
+                    remote_order=order,
+                    filename=f'{order}.png',
+                    mime='image/png',
+                    hash=hashlib.md5(f'{post_id}-{order}'.encode()).digest(),
+                )
+                for post_id in post_ids
+                for order in range(args.files)
+            ])
+            
+            # tag popularity is skewed, like real tags
+            weights = [1 / (i + 1) for i in range(len(tag_ids))]
+            await insert_plain(session, remote_post_tag, [
+                dict(post_id=post_id, tag_id=tag_id)
+                for post_id in post_ids
+                for tag_id in set(rng.choices(tag_ids, weights, k=args.tags))
+            ])
+            
+            await insert_plain(session, Related.__table__, [
+                dict(related_to_id=post_id, remote_id=rng.choice(post_ids))
+                for post_id in post_ids
+                for _ in range(args.related)
+            ])
+            
+            if subscription_ids:
+                await insert_plain(session, FeedEntry.__table__, [
+                    dict(subscription_id=rng.choice(subscription_ids), remote_post_id=post_id, sort_index=i)
+                    for i, post_id in enumerate(post_ids)
+                ])
+            
+            await insert_plain(session, Gallery.__table__, [
+                dict(name=gallery_name(s), post_id=post_id)
+                for post_id in rng.sample(post_ids, min(args.gallery, len(post_ids)))
+            ])
+            
+            await session.commit()
+            print(f'{source_name(s)}: {len(post_ids)} posts in {time.perf_counter() - t:.1f}s')
+
+async def drop(hrd):
+    async with hrd.session() as session:
+        source_ids = select(Source.id).where(Source.name.like(f'{PREFIX}%')).scalar_subquery()
+        post_ids = select(RemotePost.id).where(RemotePost.source_id.in_(source_ids))
+        
+        await session.execute(delete(Gallery).where(Gallery.name.like(f'{PREFIX}%')))
+        await session.execute(delete(FeedEntry).where(FeedEntry.remote_post_id.in_(post_ids)))
+        await session.execute(delete(Related).where(Related.related_to_id.in_(post_ids)))
+        await session.execute(delete(Related).where(Related.remote_id.in_(post_ids)))
+        await session.execute(delete(remote_post_tag).where(remote_post_tag.c.post_id.in_(post_ids)))
+        await session.execute(delete(File).where(File.remote_id.in_(post_ids)))
+        await session.execute(delete(RemotePost).where(RemotePost.source_id.in_(source_ids)))
+        await session.execute(delete(RemoteTag).where(RemoteTag.source_id.in_(source_ids)))
+        await session.execute(delete(Subscription).where(Subscription.source_id.in_(source_ids)))
+        await session.execute(delete(Source).where(Source.name.like(f'{PREFIX}%')))
+        await session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='seed a hoordu database with benchmark data')
+    parser.add_argument('--sources', type=int, default=2)
+    parser.add_argument('--subscriptions', type=int, default=4, help='per source')
+    parser.add_argument('--posts', type=int, default=20000, help='per source')
+    parser.add_argument('--files', type=int, default=4, help='per post')
+    parser.add_argument('--tags', type=int, default=12, help='per post')
+    parser.add_argument('--tag-pool', type=int, default=2000, help='distinct tags per source')
+    parser.add_argument('--related', type=int, default=2, help='per post')
+    parser.add_argument('--gallery', type=int, default=5000, help='gallery rows per source')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--drop', action='store_true', help='remove the benchmark data')
+    args = parser.parse_args()
+    
+    hrd = hoordu.hoordu(hoordu.load_config())
+    if args.drop:
+        asyncio.run(drop(hrd))
+    else:
+        asyncio.run(seed(hrd, args))
+
+
+if __name__ == '__main__':
+    main()
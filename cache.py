@@ -0,0 +1,187 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict, defaultdict
+from email.utils import formatdate, parsedate_to_datetime
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+
+# invalidations are sent to every worker on this postgres channel
+CHANNEL = 'hoordu_api_cache'
+# notification payloads must stay under 8000 bytes
+MAX_PAYLOAD = 7000
+
+
+class CacheEntry:
+    __slots__ = ('body', 'etag', 'last_modified', 'modified', 'expires', 'tags')
+    
+    def __init__(self, body, tags, ttl):
+        now = time.time()
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        self.modified = int(now)
+        self.last_modified = formatdate(self.modified, usegmt=True)
+        self.expires = time.monotonic() + ttl
+        self.tags = tags
+    
+    def matches(self, request: Request):
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match is not None:
+            etags = [t.strip() for t in if_none_match.split(',')]
+            # weak comparison, like If-None-Match asks for
+            return '*' in etags or any(t.removeprefix('W/') == self.etag for t in etags)
+        
+        if_modified_since = request.headers.get('if-modified-since')
+        if if_modified_since is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            
+            return self.modified <= since
+        
+        return False
+
+
+# caches encoded responses of the read mostly routes, bounded by the total
+# size of the bodies and dropped in lru order
+#
+# entries carry tags that the mutating routes invalidate, a response built
+# while anything was invalidated is returned but not stored
+class ResponseCache:
+    def __init__(self, maxsize=64 * 1024 * 1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.size = 0
+        
+        # key -> CacheEntry
+        self._entries = OrderedDict()
+        # tag -> keys
+        self._tags = defaultdict(set)
+        # bumped by every invalidation
+        self._generation = 0
+        
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.invalidations = 0
+    
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        if entry.expires < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+    
+    def generation(self):
+        return self._generation
+    
+    def put(self, key, body, tags, generation=None):
+        entry = CacheEntry(body, tags, self.ttl)
+        if generation is not None and generation != self._generation:
+            return entry
+        
+        if len(body) > self.maxsize:
+            return entry
+        
+        if key in self._entries:
+            self._remove(key)
+        
+        self._entries[key] = entry
+        self.size += len(body)
+        for tag in tags:
+            self._tags[tag].add(key)
+        
+        while self.size > self.maxsize:
+            self._remove(next(iter(self._entries)))
+        
+        return entry
+    
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= len(entry.body)
+        for tag in entry.tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+    
+    def invalidate(self, *tags):
+        self._generation += 1
+        for tag in tags:
+            self.invalidations += 1
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+    
+    def clear(self):
+        self._generation += 1
+        self.invalidations += 1
+        self._entries.clear()
+        self._tags.clear()
+        self.size = 0
+    
+    def response(self, request: Request, entry: CacheEntry, media_type='application/json'):
+        headers = {
+            'ETag': entry.etag,
+            'Last-Modified': entry.last_modified,
+            'Cache-Control': 'no-cache',
+        }
+        
+        if entry.matches(request):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        
+        return Response(content=entry.body, media_type=media_type, headers=headers)
+    
+    def stats(self):
+        return dict(
+            entries=len(self._entries),
+            size=self.size,
+            hits=self.hits,
+            misses=self.misses,
+            not_modified=self.not_modified,
+            invalidations=self.invalidations,
+        )
+
+
+# splits invalidated tags into notification payloads, a json list of tags
+# with tuples as lists, and "*" for a cleared cache
+def encode_invalidation(tags=None):
+    if tags is None:
+        return ['*']
+    
+    payloads = []
+    chunk = []
+    size = 2
+    for tag in tags:
+        item = json.dumps(tag, separators=(',', ':'))
+        if chunk and size + len(item) + 1 > MAX_PAYLOAD:
+            payloads.append('[' + ','.join(chunk) + ']')
+            chunk = []
+            size = 2
+        
+        chunk.append(item)
+        size += len(item) + 1
+    
+    if chunk:
+        payloads.append('[' + ','.join(chunk) + ']')
+    
+    return payloads
+
+# the tags of a payload, None when the whole cache was cleared
+def decode_invalidation(payload):
+    if payload == '*':
+        return None
+    
+    return [tuple(t) if isinstance(t, list) else t for t in json.loads(payload)]
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import os
+import time
+
+import hoordu
+from hoordu.models import Plugin
+from sqlalchemy import select
+
+
+log = logging.getLogger(__name__)
+
+
+class PluginConfig:
+    __slots__ = ('success', 'form')
+    
+    def __init__(self, success, form):
+        self.success = success
+        self.form = form
+
+
+# caches the result of setting each plugin up and its built config form
+#
+# entries go away when a plugin's config is updated, one of the
+# `config_files` changes, those are checked at most every `check_interval`
+# seconds, or after `ttl` seconds so updates made by other workers are
+# eventually seen
+class PluginConfigCache:
+    def __init__(self, hrd: hoordu.hoordu, build, config_files=(), check_interval=1, ttl=300):
+        self.hrd = hrd
+        self.build = build
+        self.config_files = list(config_files)
+        self.check_interval = check_interval
+        self.ttl = ttl
+        
+        # plugin name -> (expires, PluginConfig)
+        self._entries = {}
+        # plugin name -> future of the setup
+        self._pending = {}
+        # bumped by every invalidation, setups started before it aren't stored
+        self._generation = 0
+        self._mtimes = None
+        self._checked = 0
+        self._task = None
+    
+    def _stat(self):
+        mtimes = []
+        for path in self.config_files:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        
+        return mtimes
+    
+    async def _check_files(self):
+        now = time.monotonic()
+        if not self.config_files or now - self._checked < self.check_interval:
+            return
+        
+        self._checked = now
+        loop = asyncio.get_running_loop()
+        mtimes = await loop.run_in_executor(None, self._stat)
+        if self._mtimes is not None and mtimes != self._mtimes:
+            log.info('config files changed, dropping cached plugin configs')
+            self.clear()
+        
+        self._mtimes = mtimes
+    
+    # setups already running are left to finish for their callers, later
+    # ones start over
+    def invalidate(self, name):
+        self._entries.pop(name, None)
+        self._pending.pop(name, None)
+        self._generation += 1
+    
+    def clear(self):
+        self._entries.clear()
+        self._pending.clear()
+        self._generation += 1
+    
+    def _done(self, name, pending):
+        if self._pending.get(name) is pending:
+            del self._pending[name]
+    
+    async def _setup(self, name, generation):
+        success, form = await self.hrd.setup_plugin(name, parameters=None)
+        if form is None:
+            async with self.hrd.session() as session:
+                plugin = await session.plugin(name)
+                form = plugin.config_form()
+                form.fill(plugin.config)
+        
+        config = PluginConfig(success, self.build(form))
+        if generation == self._generation:
+            self._entries[name] = (time.monotonic() + self.ttl, config)
+        
+        return config
+    
+    async def get(self, name):
+        await self._check_files()
+        
+        entry = self._entries.get(name)
+        if entry is not None:
+            expires, config = entry
+            if expires >= time.monotonic():
+                return config
+            
+            del self._entries[name]
+        
+        pending = self._pending.get(name)
+        if pending is None:
+            pending = self._pending[name] = asyncio.ensure_future(self._setup(name, self._generation))
+            pending.add_done_callback(lambda _: self._done(name, pending))
+        
+        # a cancelled request doesn't cancel the setup for the others
+        return await asyncio.shield(pending)
+    
+    async def _warm(self):
+        async with self.hrd.session() as session:
+            names = (await session.execute(select(Plugin.name))).scalars().all()
+        
+        for name in names:
+            try:
+                await self.get(name)
+            except Exception:
+                log.exception('could not set up plugin %s', name)
+    
+    def start(self):
+        if self._task is None:
+            self._mtimes = self._stat()
+            self._checked = time.monotonic()
+            self._task = asyncio.create_task(self._warm())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
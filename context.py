@@ -1,23 +1,118 @@
 import hoordu
+import asyncio
 import contextvars
+import inspect
 
 _HOORDU_SESSION = contextvars.ContextVar('_HOORDU_SESSION', default=None)
 
+# methods that don't need a connection and return nothing, they're queued
+# until the session is opened
+_QUEUED = frozenset(('add', 'add_all'))
+
+# a request's session, only opened once something is awaited on it
+class LazySession:
+    def __init__(self, hrd: hoordu.hoordu):
+        self.hrd = hrd
+        self.session = None
+        self._context = None
+        self._queued = []
+        self._lock = asyncio.Lock()
+    
+    async def open(self) -> hoordu.HoorduSession:
+        async with self._lock:
+            if self.session is None:
+                context = self.hrd.session()
+                session = await context.__aenter__()
+                for name, args, kwargs in self._queued:
+                    getattr(session, name)(*args, **kwargs)
+                
+                self._queued.clear()
+                self._context, self.session = context, session
+        
+        return self.session
+    
+    def queue(self, name):
+        def call(*args, **kwargs):
+            self._queued.append((name, args, kwargs))
+        
+        return call
+    
+    # returns the connection to the pool, the session is opened again if
+    # it's used afterwards
+    async def close(self, exc=None):
+        async with self._lock:
+            context, self._context, self.session = self._context, None, None
+            self._queued.clear()
+            if context is not None:
+                await context.__aexit__(type(exc) if exc is not None else None, exc,
+                        exc.__traceback__ if exc is not None else None)
+
+# records attribute accesses and calls made on the session before it's
+# opened, and replays them on the real session when awaited
+class Deferred:
+    __slots__ = ('_lazy', '_steps')
+    
+    def __init__(self, lazy, steps):
+        self._lazy = lazy
+        self._steps = steps
+    
+    def __getattr__(self, name):
+        return Deferred(self._lazy, (*self._steps, (name, None, None)))
+    
+    def __call__(self, *args, **kwargs):
+        return Deferred(self._lazy, (*self._steps, (None, args, kwargs)))
+    
+    async def _resolve(self):
+        obj = await self._lazy.open()
+        for name, args, kwargs in self._steps:
+            obj = getattr(obj, name) if name is not None else obj(*args, **kwargs)
+        
+        if inspect.isawaitable(obj):
+            obj = await obj
+        
+        return obj
+    
+    def __await__(self):
+        return self._resolve().__await__()
+
 class ContextSession:
     def __getattr__(self, name):
-        current_session = _HOORDU_SESSION.get()
-        if current_session is None:
+        lazy = _HOORDU_SESSION.get()
+        if lazy is None:
             raise RuntimeError('No session was created for this context')
-        return getattr(current_session, name)
+        
+        if lazy.session is not None:
+            return getattr(lazy.session, name)
+        
+        if name in _QUEUED:
+            return lazy.queue(name)
+        
+        return Deferred(lazy, ((name, None, None),))
 
 session: hoordu.HoorduSession = ContextSession()
 
+# closes the current context's session if it was opened
+async def release(exc=None):
+    lazy = _HOORDU_SESSION.get()
+    if lazy is not None:
+        await lazy.close(exc)
+
 class ContextSessionDepedency:
     def __init__(self, hrd: hoordu.hoordu):
         self.hrd = hrd
 
     async def __call__(self) -> hoordu.HoorduSession:
-        async with self.hrd.session() as session:
-            token = _HOORDU_SESSION.set(session)
+        lazy = LazySession(self.hrd)
+        token = _HOORDU_SESSION.set(lazy)
+        try:
             yield session
+        
+        except BaseException as e:
+            await lazy.close(e)
+            raise
+        
+        else:
+            await lazy.close()
+        
+        finally:
             _HOORDU_SESSION.reset(token)
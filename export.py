@@ -0,0 +1,54 @@
+import hoordu
+
+import schemas as s
+
+
+MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json',
+}
+
+
+# pages through a query in keyset order, every chunk is loaded and built
+# in its own short lived session so memory and connection use stay
+# constant however many posts there are
+async def export_chunks(hrd: hoordu.hoordu, query, keyset, entry, build, chunk=200, cursor=None):
+    while True:
+        async with hrd.session() as session:
+            page = await keyset.fetch(query(session), chunk, cursor=cursor)
+            entries = await build([entry(x) for x in page.items])
+            cursors = [keyset.encode(keyset.key(x)) for x in page.items]
+        
+        yield list(zip(cursors, entries))
+        
+        if page.next_cursor is None:
+            break
+        
+        cursor = page.next_cursor
+
+# every exported entry carries the cursor that resumes right after it
+async def encode(chunks, format='ndjson'):
+    first = True
+    if format == 'json':
+        yield b'['
+    
+    async for chunk in chunks:
+        lines = [
+            s.ExportEntry(cursor=cursor, entry=entry).model_dump_json(exclude_unset=True)
+            for cursor, entry in chunk
+        ]
+        if not lines:
+            continue
+        
+        if format == 'json':
+            data = ','.join(lines)
+            if not first:
+                data = ',' + data
+        else:
+            data = '\n'.join(lines) + '\n'
+        
+        first = False
+        yield data.encode()
+    
+    if format == 'json':
+        yield b']'
@@ -0,0 +1,279 @@
+import types
+import typing
+from datetime import datetime, date, time
+
+import orjson
+from pydantic import BaseModel
+from sqlalchemy import inspect
+from sqlalchemy.orm.collections import InstrumentedList
+
+import schemas as s
+
+
+def _default(v):
+    # same formats pydantic uses in json mode
+    if isinstance(v, (datetime, time)):
+        r = v.isoformat()
+        if r.endswith('+00:00'):
+            r = r[:-6] + 'Z'
+        return r
+    
+    if isinstance(v, date):
+        return v.isoformat()
+    
+    raise TypeError(f'Object of type {type(v).__name__} is not JSON serializable')
+
+def dumps(v):
+    return orjson.dumps(v, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+def _is_str_field(field):
+    annotation = field.annotation
+    if typing.get_origin(annotation) in (typing.Union, types.UnionType):
+        return [a for a in typing.get_args(annotation) if a is not type(None)] == [str]
+    
+    return annotation is str
+
+
+class EncoderPlan:
+    __slots__ = ('kind', 'converter', 'target', 'fields', 'order', 'relations')
+    
+    def __init__(self, kind, converter=None, target=None, fields=None, order=None, relations=None):
+        self.kind = kind
+        self.converter = converter
+        self.target = target
+        # (attribute, output name, coerce to str) in the order they're checked
+        self.fields = fields
+        # attributes in `fields` that are relationships
+        self.relations = relations
+        # output names in field order, None when it matches `fields`
+        self.order = order
+
+
+# encodes ORM objects straight to json bytes, producing the same output as
+# building the pydantic models with Models.build and serializing them with
+# exclude_unset and by field name, like the api routes do
+#
+# the plans mirror the ones compiled by Models, converters registered here
+# must return json ready values, types with a regular converter but no
+# fast one fall back to building and dumping the pydantic model
+class Encoder:
+    def __init__(self, models: s.Models):
+        self.models = models
+        self.converters = {}
+        self._plans = {}
+    
+    def register_converter(self, Type):
+        def reg_conv_internal(func):
+            self.converters[Type] = func
+            self._plans.clear()
+            return func
+        return reg_conv_internal
+    
+    def _compile(self, cls):
+        if cls in (list, InstrumentedList):
+            return EncoderPlan('list')
+        
+        converter = self.models._find(self.converters, cls.__mro__)
+        if converter is not None:
+            return EncoderPlan('converter', converter=converter)
+        
+        plan = self.models.plan(cls)
+        if plan.converter is not None or (plan.target is not None and plan.attrs is None):
+            return EncoderPlan('model', target=plan.target)
+        
+        if plan.target is None:
+            return EncoderPlan('value')
+        
+        names = {}
+        for name, field in plan.target.model_fields.items():
+            names[name] = (name, _is_str_field(field))
+            if field.alias is not None:
+                names[field.alias] = (name, _is_str_field(field))
+        
+        fields = tuple((attr, *names[attr]) for attr in plan.attrs)
+        
+        declared = list(plan.target.model_fields)
+        order = sorted((name for _, name, _ in fields), key=declared.index)
+        if order == [name for _, name, _ in fields]:
+            order = None
+        
+        relations = frozenset(inspect(cls).relationships.keys())
+        
+        return EncoderPlan('orm', target=plan.target, fields=fields, order=order, relations=relations)
+    
+    def plan(self, cls):
+        plan = self._plans.get(cls)
+        if plan is None:
+            plan = self._plans[cls] = self._compile(cls)
+        
+        return plan
+    
+    # `sel` is a sparse.Selection that trims which attributes are emitted
+    def to_json(self, obj, ctx=None, sel=None):
+        if ctx is None:
+            ctx = s.BuildContext(self.models)
+        
+        plan = self.plan(type(obj))
+        match plan.kind:
+            case 'value':
+                return obj
+            
+            case 'list':
+                r = []
+                for v in obj:
+                    rv = self.to_json(v, ctx, sel)
+                    if rv is not None:
+                        r.append(rv)
+                return r
+            
+            case 'converter':
+                return plan.converter(obj, ctx, sel)
+            
+            case 'model':
+                v = self.models.build(obj, ctx)
+                if isinstance(v, BaseModel):
+                    return v.model_dump(mode='json', exclude_unset=True)
+                return self.to_json(v, ctx)
+        
+        ref = self.models.plan(type(obj)).ref(obj)
+        key = ref if sel is None else (ref, sel)
+        if ref is not None:
+            value = ctx.cached(key)
+            if value is not None:
+                return value
+        
+        mark = ctx.push()
+        ctx.enter(ref)
+        
+        fields = plan.fields if sel is None else sel.fields(plan)
+        
+        d = obj.__dict__
+        out = {}
+        for attr, name, to_str in fields:
+            if attr not in d:
+                continue
+            
+            v = d[attr]
+            if not ctx.check(v):
+                continue
+            
+            if sel is not None and attr in plan.relations:
+                v = self.to_json(v, ctx, sel.relations[attr])
+            else:
+                v = self.to_json(v, ctx)
+            
+            if to_str and v is not None and not isinstance(v, str):
+                v = str(v)
+            out[name] = v
+        
+        if plan.order is not None:
+            out = {name: out[name] for name in plan.order if name in out}
+        
+        ctx.pop(mark, ref, out, key)
+        return out
+    
+    def encode(self, obj, sel=None):
+        return dumps(self.to_json(obj, sel=sel))
+
+
+# opt-in normalized output for post graphs, objects of the tabled types are
+# emitted once in per-type tables keyed by primary key and every place they
+# appear holds just the key
+#
+#   {"result": [...], "posts": {"1": {...}}, "files": {...}, ...}
+#
+# an object is added to its table before its children are walked, so
+# cycles end in a reference instead of being cut
+class Normalizer:
+    def __init__(self, encoder: Encoder, tables):
+        self.encoder = encoder
+        self.models = encoder.models
+        # class -> table name
+        self.tables = tables
+        self.unwrappers = {}
+    
+    # objects of this type are replaced by what the function returns, e.g.
+    # a Related by the post it points to
+    def register_unwrap(self, Type):
+        def reg_unwrap_internal(func):
+            self.unwrappers[Type] = func
+            return func
+        return reg_unwrap_internal
+    
+    def _value(self, obj, sel, out, ctx):
+        cls = type(obj)
+        unwrap = self.models._find(self.unwrappers, cls.__mro__)
+        if unwrap is not None:
+            obj = unwrap(obj)
+            if obj is None:
+                return None
+            
+            cls = type(obj)
+        
+        plan = self.encoder.plan(cls)
+        if plan.kind == 'value':
+            return obj
+        
+        if plan.kind == 'list':
+            r = []
+            for v in obj:
+                rv = self._value(v, sel, out, ctx)
+                if rv is not None:
+                    r.append(rv)
+            return r
+        
+        name = self.models._find(self.tables, cls.__mro__)
+        ref = self.models.plan(cls).ref(obj) if name is not None else None
+        if ref is None:
+            return self._entity(obj, plan, sel, out, ctx)
+        
+        _, key = ref
+        id = key[0] if len(key) == 1 else list(key)
+        table = out[name]
+        k = str(id)
+        if k not in table:
+            table[k] = None
+            table[k] = self._entity(obj, plan, sel, out, ctx)
+        
+        return id
+    
+    def _entity(self, obj, plan, sel, out, ctx):
+        match plan.kind:
+            case 'converter':
+                return plan.converter(obj, ctx, sel)
+            
+            case 'model':
+                return self.encoder.to_json(obj, ctx)
+        
+        fields = plan.fields if sel is None else sel.fields(plan)
+        
+        d = obj.__dict__
+        r = {}
+        for attr, name, to_str in fields:
+            if attr not in d:
+                continue
+            
+            v = d[attr]
+            if attr in plan.relations:
+                v = self._value(v, sel.relations[attr] if sel is not None else None, out, ctx)
+            else:
+                v = self.encoder.to_json(v, ctx)
+            
+            if to_str and v is not None and not isinstance(v, str):
+                v = str(v)
+            r[name] = v
+        
+        if plan.order is not None:
+            r = {name: r[name] for name in plan.order if name in r}
+        
+        return r
+    
+    def to_json(self, obj, sel=None):
+        out = {name: {} for name in self.tables.values()}
+        ctx = s.BuildContext(self.models)
+        result = self._value(obj, sel, out, ctx)
+        return {'result': result, **out}
+    
+    def encode(self, obj, sel=None):
+        return dumps(self.to_json(obj, sel))
@@ -0,0 +1,346 @@
+import asyncio
+import logging
+from collections import OrderedDict, defaultdict
+
+import hoordu
+from hoordu.models import FeedEntry
+from sqlalchemy import text
+from starlette.websockets import WebSocket, WebSocketDisconnect
+from pydantic import ValidationError
+
+import schemas as s
+
+
+log = logging.getLogger(__name__)
+
+CHANNEL = 'hoordu_api_feed'
+
+
+# forwards inserts into the feed table to the open websockets through
+# postgres LISTEN/NOTIFY, the payload is "<subscription_id>:<remote_post_id>"
+#
+# the same connection listens on the channels passed to subscribe(), whose
+# callbacks get each payload, and publish() notifies every worker on one
+class FeedNotifier:
+    def __init__(self, hrd: hoordu.hoordu):
+        self.hrd = hrd
+        self._listeners = defaultdict(set)
+        # channel -> asyncpg listener
+        self._channels = {CHANNEL: self._notify}
+        self._conn = None
+        self._raw = None
+        self._reconnect_task = None
+    
+    async def install(self):
+        table = FeedEntry.__tablename__
+        async with self.hrd.session() as session:
+            # workers starting together install it one at a time
+            await session.execute(text('SELECT pg_advisory_xact_lock(hashtext(:channel))'), {'channel': CHANNEL})
+            await session.execute(text(f'''
+                CREATE OR REPLACE FUNCTION {CHANNEL}_notify() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM pg_notify('{CHANNEL}', NEW.subscription_id || ':' || NEW.remote_post_id);
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql
+            '''))
+            # created only when missing, dropping it would take an exclusive
+            # lock on the feed table on every startup
+            exists = (await session.execute(text('''
+                SELECT 1 FROM pg_trigger
+                WHERE tgname = :name AND tgrelid = CAST(:table AS regclass)
+            '''), {'name': f'{CHANNEL}_insert', 'table': table})).first()
+            if exists is None:
+                await session.execute(text(f'''
+                    CREATE TRIGGER {CHANNEL}_insert AFTER INSERT ON {table}
+                    FOR EACH ROW EXECUTE FUNCTION {CHANNEL}_notify()
+                '''))
+            
+            await session.commit()
+    
+    async def _connect(self):
+        self._conn = await self.hrd.engine.connect()
+        self._raw = (await self._conn.get_raw_connection()).driver_connection
+        self._raw.add_termination_listener(self._terminated)
+        for channel, listener in self._channels.items():
+            await self._raw.add_listener(channel, listener)
+    
+    async def _disconnect(self):
+        if self._raw is not None:
+            self._raw.remove_termination_listener(self._terminated)
+            for channel, listener in self._channels.items():
+                try:
+                    await self._raw.remove_listener(channel, listener)
+                except Exception:
+                    pass
+            
+            self._raw = None
+        
+        if self._conn is not None:
+            try:
+                await self._conn.close()
+            except Exception:
+                pass
+            
+            self._conn = None
+    
+    async def start(self):
+        try:
+            await self.install()
+            await self._connect()
+        
+        except Exception:
+            log.exception('live feed updates are disabled')
+            await self._disconnect()
+    
+    async def stop(self):
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            try:
+                await self._reconnect_task
+            except asyncio.CancelledError:
+                pass
+            
+            self._reconnect_task = None
+        
+        await self._disconnect()
+    
+    # the listening connection was closed, e.g. by a database restart,
+    # notifications sent until it's back are lost
+    def _terminated(self, connection):
+        if connection is not self._raw or self._reconnect_task is not None:
+            return
+        
+        log.warning('lost the notification connection, reconnecting')
+        self._reconnect_task = asyncio.create_task(self._reconnect())
+    
+    async def _reconnect(self, max_delay=60):
+        delay = 1
+        try:
+            while True:
+                await self._disconnect()
+                try:
+                    await self._connect()
+                    log.info('notification connection is back')
+                    return
+                
+                except Exception as e:
+                    log.warning('failed to reconnect the notification connection, retrying in %ds: %s', delay, e)
+                
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_delay)
+        
+        finally:
+            self._reconnect_task = None
+    
+    def _notify(self, connection, pid, channel, payload):
+        try:
+            subscription_id, post_id = (int(x) for x in payload.split(':'))
+        except ValueError:
+            return
+        
+        for callback in list(self._listeners.get(subscription_id, ())):
+            callback(post_id)
+    
+    # only channels subscribed before start() are listened on
+    def subscribe(self, channel, callback):
+        self._channels[channel] = lambda connection, pid, channel, payload: callback(payload)
+    
+    async def publish(self, channel, payloads):
+        async with self.hrd.engine.connect() as conn:
+            for payload in payloads:
+                await conn.execute(text('SELECT pg_notify(:channel, :payload)'), {'channel': channel, 'payload': payload})
+            
+            # sent once committed
+            await conn.commit()
+    
+    def listen(self, subscription_id, callback):
+        self._listeners[subscription_id].add(callback)
+    
+    def unlisten(self, subscription_id, callback):
+        listeners = self._listeners.get(subscription_id)
+        if listeners is not None:
+            listeners.discard(callback)
+            if not listeners:
+                del self._listeners[subscription_id]
+
+
+# websocket protocol, every message is a json object with a "c" command
+#
+# client -> server
+#   {"c": "credit", "n": 20}   allow the server to send 20 more posts
+#   {"c": "continue"}          same as a credit of the initial count
+#   {"c": "stop"}              close the feed
+#
+# server -> client
+#   {"c": "posts", "entries": [...], "cursor": "..."}
+#       a batch of older posts, the cursor resumes right after the batch
+#   {"c": "end"}
+#       there are no older posts left
+#   {"c": "live", "entries": [...]}
+#       posts added to the subscription after the feed was opened
+#
+# each post sent uses one credit, the connection starts with `count`
+# credits, and no database cursor is kept open between batches
+#
+# live posts wait for credits in a backlog of up to `max_backlog` ids,
+# past that the backlog is dropped and the posts newer than the last live
+# key are read back from the database in order once there are credits,
+# so a client that stops reading costs a bounded amount of memory
+#
+# posts are only sent once, the last `max_sent` ids are remembered
+class FeedSocket:
+    def __init__(self, websocket: WebSocket, notifier, subscription_id,
+            fetch_page, fetch_entries, fetch_newer,
+            count=20, batch=20, cursor=None, until=None, live=True, live_key=None,
+            max_backlog=1000, max_sent=10000):
+        self.websocket = websocket
+        self.notifier = notifier
+        self.subscription_id = subscription_id
+        self.fetch_page = fetch_page
+        self.fetch_entries = fetch_entries
+        self.fetch_newer = fetch_newer
+        
+        self.count = count
+        self.batch = batch
+        self.cursor = cursor
+        self.until = until
+        self.live = live
+        self.max_backlog = max_backlog
+        self.max_sent = max_sent
+        
+        self.credits = count
+        self.history_done = False
+        self.stopped = False
+        # post id -> None, oldest first
+        self._sent = OrderedDict()
+        self._live_ids = []
+        # key of the newest live post sent, or of the newest post when the
+        # feed was opened
+        self._live_key = live_key
+        self._resync = False
+        self._wake = asyncio.Event()
+    
+    def _on_entry(self, post_id):
+        if len(self._live_ids) >= self.max_backlog:
+            self._live_ids = []
+            self._resync = True
+        
+        self._live_ids.append(post_id)
+        self._wake.set()
+    
+    async def _receive(self):
+        try:
+            while True:
+                data = await self.websocket.receive_text()
+                try:
+                    header = s.MessageHeader.model_validate_json(data)
+                except ValidationError:
+                    continue
+                
+                match header.c:
+                    case 'credit':
+                        self.credits += max(header.n or 0, 0)
+                    
+                    case 'continue':
+                        self.credits += self.count
+                    
+                    case 'stop':
+                        break
+                
+                self._wake.set()
+        
+        except WebSocketDisconnect:
+            pass
+        
+        finally:
+            self.stopped = True
+            self._wake.set()
+    
+    async def _send(self, frame):
+        await self.websocket.send_text(frame.model_dump_json(exclude_unset=True))
+    
+    def _unsent(self, entries):
+        r = []
+        for e in entries:
+            if e.remote_post_id not in self._sent:
+                self._sent[e.remote_post_id] = None
+                r.append(e)
+        
+        while len(self._sent) > self.max_sent:
+            self._sent.popitem(last=False)
+        
+        return r
+    
+    async def _send_history(self):
+        n = min(self.credits, self.batch)
+        entries, cursor = await self.fetch_page(n, self.cursor, self.until)
+        self.cursor = cursor
+        
+        entries = self._unsent(entries)
+        if entries:
+            self.credits -= len(entries)
+            await self._send(s.FeedFrame(c='posts', entries=entries, cursor=cursor))
+        
+        if cursor is None:
+            self.history_done = True
+            await self._send(s.FeedFrame(c='end'))
+    
+    async def _send_live(self):
+        n = min(self.credits, self.batch)
+        ids, self._live_ids = self._live_ids[:n], self._live_ids[n:]
+        
+        entries, key = await self.fetch_entries(ids)
+        if key is not None and (self._live_key is None or key > self._live_key):
+            self._live_key = key
+        
+        entries = self._unsent(entries)
+        if entries:
+            self.credits -= len(entries)
+            await self._send(s.FeedFrame(c='live', entries=entries))
+    
+    async def _send_resync(self):
+        n = min(self.credits, self.batch)
+        entries, key = await self.fetch_newer(n, self._live_key)
+        if len(entries) < n:
+            # caught up, the ids that came in meanwhile are sent as usual
+            self._resync = False
+        
+        if key is not None:
+            self._live_key = key
+        
+        entries = self._unsent(entries)
+        if entries:
+            self.credits -= len(entries)
+            await self._send(s.FeedFrame(c='live', entries=entries))
+    
+    async def serve(self):
+        if self.live:
+            self.notifier.listen(self.subscription_id, self._on_entry)
+        
+        receiver = asyncio.create_task(self._receive())
+        try:
+            while True:
+                self._wake.clear()
+                if self.stopped:
+                    break
+                
+                if self.credits > 0 and self._resync:
+                    await self._send_resync()
+                
+                elif self.credits > 0 and self._live_ids:
+                    await self._send_live()
+                
+                elif self.credits > 0 and not self.history_done:
+                    await self._send_history()
+                
+                else:
+                    await self._wake.wait()
+        
+        except WebSocketDisconnect:
+            pass
+        
+        finally:
+            receiver.cancel()
+            if self.live:
+                self.notifier.unlisten(self.subscription_id, self._on_entry)
@@ -0,0 +1,141 @@
+import asyncio
+import pathlib
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import hoordu
+from hoordu.models import File
+
+import metrics
+from sqlalchemy.orm.collections import InstrumentedList
+
+
+def collect_files(obj):
+    files = {}
+    seen = set()
+    stack = [obj]
+    while stack:
+        v = stack.pop()
+        if isinstance(v, (list, tuple, InstrumentedList)):
+            stack.extend(v)
+            continue
+        
+        if not hasattr(v, '__table__') or id(v) in seen:
+            continue
+        
+        seen.add(id(v))
+        if isinstance(v, File):
+            files[id(v)] = v
+            continue
+        
+        stack.extend(x for k, x in v.__dict__.items() if not k.startswith('_'))
+    
+    return list(files.values())
+
+
+class FileResolver:
+    def __init__(self, hrd: hoordu.hoordu, maxsize=65536, ttl=300, negative_ttl=10, workers=8, batch=64):
+        self.hrd = hrd
+        self.base = pathlib.Path(hrd.config.settings.base_path)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.batch = batch
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='file-resolver')
+        
+        # path -> (exists, expires)
+        self._cache = OrderedDict()
+    
+    def _get(self, path, now):
+        entry = self._cache.get(path)
+        if entry is None:
+            return None
+        
+        exists, expires = entry
+        if expires < now:
+            del self._cache[path]
+            return None
+        
+        self._cache.move_to_end(path)
+        return exists
+    
+    def _put(self, path, exists, now):
+        ttl = self.ttl if exists else self.negative_ttl
+        self._cache[path] = (exists, now + ttl)
+        self._cache.move_to_end(path)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+    
+    @staticmethod
+    def _stat_many(paths):
+        return [pathlib.Path(p).exists() for p in paths]
+    
+    def _paths(self, file):
+        return [str(p) for p in self.hrd.get_file_paths(file)]
+    
+    async def resolve(self, files):
+        now = time.monotonic()
+        missing = []
+        for file in files:
+            for path in self._paths(file):
+                if self._get(path, now) is None:
+                    missing.append(path)
+        
+        if not missing:
+            return
+        
+        missing = list(dict.fromkeys(missing))
+        metrics.count_stats(len(missing))
+        chunks = [missing[i:i + self.batch] for i in range(0, len(missing), self.batch)]
+        
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(
+            loop.run_in_executor(self.executor, self._stat_many, chunk)
+            for chunk in chunks
+        ))
+        
+        now = time.monotonic()
+        for chunk, exists in zip(chunks, results):
+            for path, e in zip(chunk, exists):
+                self._put(path, e, now)
+    
+    def exists(self, path):
+        path = str(path)
+        now = time.monotonic()
+        exists = self._get(path, now)
+        if exists is None:
+            # not prefetched, fall back to a blocking stat
+            metrics.count_stats(1)
+            exists = pathlib.Path(path).exists()
+            self._put(path, exists, now)
+        
+        return exists
+    
+    # urls with a version are content addressed and cached forever by
+    # the media server, the file hash is used so they change with the file
+    def url(self, path, version=None):
+        if not self.exists(path):
+            return None
+        
+        url = str(pathlib.Path('/data') / pathlib.Path(path).relative_to(self.base))
+        if version is not None:
+            url = f'{url}?v={version}'
+        
+        return url
+    
+    # the hash is the one of the original file, the plugin's thumbnail
+    # gets a plain url and is revalidated
+    def urls(self, file):
+        version = file.hash.hex() if file.hash is not None else None
+        orig, thumb = self._paths(file)
+        return self.url(orig, version), self.url(thumb)
+    
+    def invalidate(self, files=None):
+        if files is None:
+            self._cache.clear()
+            return
+        
+        for file in files:
+            for path in self._paths(file):
+                self._cache.pop(path, None)
@@ -0,0 +1,69 @@
+from hoordu.models import Related
+from sqlalchemy import Integer, literal, select
+
+
+# walks the related posts of a post in one recursive query, breadth first
+#
+# every row the walk produces counts as work, revisits through cycles
+# included, the walk stops after `work_factor` rows per node asked for
+# so dense graphs can't make a request run away
+class RelatedGraph:
+    def __init__(self, max_depth=8, max_nodes=1000, work_factor=8):
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.work_factor = work_factor
+    
+    def _walk(self, post_id, depth, work):
+        walk = select(
+                    literal(post_id, Integer).label('post_id'),
+                    literal(0, Integer).label('depth'),
+                ) \
+                .cte('walk', recursive=True)
+        
+        step = select(
+                    Related.remote_id,
+                    walk.c.depth + 1,
+                ) \
+                .join(walk, Related.related_to_id == walk.c.post_id) \
+                .where(
+                    walk.c.depth < depth,
+                    Related.remote_id.is_not(None),
+                )
+        
+        walk = walk.union(step)
+        
+        # postgres produces the rows of a recursive cte one level after the
+        # other and stops once the limit is reached
+        return select(walk.c.post_id, walk.c.depth).limit(work)
+    
+    # returns {post_id: depth} for up to `max_nodes` posts, the closest
+    # ones first, and whether any were left out
+    async def nodes(self, session, post_id, depth, max_nodes):
+        depth = max(0, min(depth, self.max_depth))
+        max_nodes = max(1, min(max_nodes, self.max_nodes))
+        work = max_nodes * self.work_factor
+        
+        rows = (await session.execute(self._walk(post_id, depth, work))).all()
+        
+        nodes = {}
+        for id, d in sorted(rows, key=lambda r: r[1]):
+            if id not in nodes:
+                nodes[id] = d
+        
+        truncated = len(rows) >= work or len(nodes) > max_nodes
+        if len(nodes) > max_nodes:
+            nodes = dict(list(nodes.items())[:max_nodes])
+        
+        return nodes, truncated
+    
+    async def edges(self, session, post_ids):
+        rows = await session.execute(
+            select(Related.related_to_id, Related.remote_id) \
+                    .where(
+                        Related.related_to_id.in_(post_ids),
+                        Related.remote_id.in_(post_ids),
+                    ) \
+                    .distinct() \
+                    .order_by(Related.related_to_id, Related.remote_id)
+        )
+        return [tuple(r) for r in rows]
@@ -0,0 +1,380 @@
+import asyncio
+import hashlib
+import mimetypes
+import os
+import secrets
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import parse_qs, unquote
+
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+# more ranges than this, after merging, get the whole file instead
+MAX_RANGES = 16
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+# parses a Range header into sorted, merged (start, end) pairs, end included
+# returns None when the header should be ignored and the whole file sent
+def parse_range(header, size):
+    unit, sep, specs = header.partition('=')
+    if not sep or unit.strip().lower() != 'bytes':
+        return None
+    
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        
+        first, sep, last = spec.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or not (first.isdigit() or (not first and last.isdigit())):
+            return None
+        
+        if not first:
+            # suffix range, the last n bytes
+            n = int(last)
+            if n > 0 and size > 0:
+                ranges.append((max(size - n, 0), size - 1))
+            continue
+        
+        start = int(first)
+        if last:
+            if not last.isdigit():
+                return None
+            
+            end = int(last)
+            if end < start:
+                return None
+        else:
+            end = size - 1
+        
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    
+    if not ranges:
+        raise RangeNotSatisfiable()
+    
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    
+    if len(merged) > MAX_RANGES:
+        return None
+    
+    return merged
+
+
+class _Opened:
+    __slots__ = ('file', 'stat', 'data')
+    
+    def __init__(self, file, st, data):
+        self.file = file
+        self.stat = st
+        # the whole content for small files, read along with the stat
+        self.data = data
+
+
+# serves the media directory, replacing StaticFiles on /data
+#
+# urls with a ?v=<file hash> are content addressed, the hash is the etag
+# and they can be cached forever, anything else gets a stat based etag
+# and has to be revalidated
+#
+# the version is only trusted once it matches the md5 of the content,
+# small files are hashed along with the read, larger ones in the
+# background on `hash_workers` threads and they're served like unversioned
+# ones until that's done, the digests are kept for the last `max_digests`
+# (inode, mtime, size) seen so a file is only hashed again after it changes
+#
+# small files are read in the same worker call that opens them, larger
+# ones are streamed in chunks, or handed to the server when it supports
+# the zero copy send extension
+class MediaFiles:
+    def __init__(self, directory, chunk_size=256 * 1024, small_size=64 * 1024, max_digests=65536, hash_workers=2):
+        self.directory = os.path.realpath(directory)
+        self.chunk_size = chunk_size
+        self.small_size = small_size
+        self.max_digests = max_digests
+        self.hash_executor = ThreadPoolExecutor(hash_workers, thread_name_prefix='media-hash')
+        
+        # (path, inode, mtime, size) -> hex md5, least recently used first
+        self._digests = OrderedDict()
+        # (path, inode, mtime, size) -> task hashing it
+        self._hashing = {}
+    
+    def _resolve(self, scope):
+        path = scope['path']
+        root = scope.get('root_path', '')
+        if root and path.startswith(root):
+            path = path[len(root):]
+        
+        full = os.path.realpath(os.path.join(self.directory, unquote(path).lstrip('/')))
+        if os.path.commonpath([full, self.directory]) != self.directory:
+            return None
+        
+        return full
+    
+    def _open(self, path, read_small):
+        try:
+            f = open(path, 'rb')
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError, PermissionError):
+            return None
+        
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            f.close()
+            return None
+        
+        data = None
+        if read_small and st.st_size <= self.small_size:
+            data = f.read()
+            f.close()
+            f = None
+        
+        return _Opened(f, st, data)
+    
+    @staticmethod
+    def _key(path, st):
+        return (path, st.st_ino, st.st_mtime_ns, st.st_size)
+    
+    def _hash_file(self, path, key):
+        h = hashlib.md5(usedforsecurity=False)
+        try:
+            with open(path, 'rb') as f:
+                if self._key(path, os.fstat(f.fileno())) != key:
+                    # changed since the request that asked for it
+                    return None
+                
+                while data := f.read(self.chunk_size):
+                    h.update(data)
+        
+        except OSError:
+            return None
+        
+        return h.hexdigest()
+    
+    def _store(self, key, digest):
+        self._digests[key] = digest
+        while len(self._digests) > self.max_digests:
+            self._digests.popitem(last=False)
+    
+    async def _hash(self, path, key):
+        try:
+            loop = asyncio.get_running_loop()
+            digest = await loop.run_in_executor(self.hash_executor, self._hash_file, path, key)
+            if digest is not None:
+                self._store(key, digest)
+        
+        finally:
+            del self._hashing[key]
+    
+    def _is_version(self, path, opened, version):
+        key = self._key(path, opened.stat)
+        digest = self._digests.get(key)
+        if digest is None and opened.data is not None:
+            digest = hashlib.md5(opened.data, usedforsecurity=False).hexdigest()
+            self._store(key, digest)
+        
+        if digest is None:
+            if key not in self._hashing:
+                self._hashing[key] = asyncio.ensure_future(self._hash(path, key))
+            
+            return False
+        
+        self._digests.move_to_end(key)
+        return version.lower() == digest
+    
+    @staticmethod
+    def _headers(scope):
+        return {k.decode('latin-1'): v.decode('latin-1') for k, v in scope['headers']}
+    
+    @staticmethod
+    async def _start(send, status, headers):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+        })
+    
+    @staticmethod
+    def _not_modified(request, etag, mtime):
+        if_none_match = request.get('if-none-match')
+        if if_none_match is not None:
+            etags = [t.strip() for t in if_none_match.split(',')]
+            return '*' in etags or any(t.removeprefix('W/') == etag for t in etags)
+        
+        if_modified_since = request.get('if-modified-since')
+        if if_modified_since is not None:
+            try:
+                return mtime <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                pass
+        
+        return False
+    
+    @staticmethod
+    def _if_range(request, etag, last_modified):
+        if_range = request.get('if-range')
+        if if_range is None:
+            return True
+        
+        # strong comparison only
+        return if_range == etag or if_range == last_modified
+    
+    async def _body(self, send, scope, opened, offset, count, more):
+        if opened.data is not None:
+            await send({'type': 'http.response.body', 'body': opened.data[offset:offset + count], 'more_body': more})
+            return
+        
+        if 'http.response.zerocopysend' in scope.get('extensions', {}):
+            await send({
+                'type': 'http.response.zerocopysend',
+                'file': opened.file,
+                'offset': offset,
+                'count': count,
+                'more_body': more,
+            })
+            return
+        
+        loop = asyncio.get_running_loop()
+        fd = opened.file.fileno()
+        while count > 0:
+            data = await loop.run_in_executor(None, os.pread, fd, min(count, self.chunk_size), offset)
+            if not data:
+                break
+            
+            offset += len(data)
+            count -= len(data)
+            await send({'type': 'http.response.body', 'body': data, 'more_body': more or count > 0})
+    
+    async def _error(self, send, status, headers=()):
+        await self._start(send, status, [('content-length', '0'), *headers])
+        await send({'type': 'http.response.body', 'body': b''})
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        
+        method = scope['method']
+        if method not in ('GET', 'HEAD'):
+            await self._error(send, 405, [('allow', 'GET, HEAD')])
+            return
+        
+        path = self._resolve(scope)
+        if path is None:
+            await self._error(send, 404)
+            return
+        
+        loop = asyncio.get_running_loop()
+        opened = await loop.run_in_executor(None, self._open, path, method == 'GET')
+        if opened is None:
+            await self._error(send, 404)
+            return
+        
+        try:
+            await self._serve(scope, send, method, path, opened)
+        
+        finally:
+            if opened.file is not None:
+                opened.file.close()
+    
+    async def _serve(self, scope, send, method, path, opened):
+        request = self._headers(scope)
+        size = opened.stat.st_size
+        mtime = opened.stat.st_mtime
+        last_modified = formatdate(mtime, usegmt=True)
+        
+        version = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('v')
+        if version and version[0].isalnum() and self._is_version(path, opened, version[0]):
+            etag = f'"{version[0]}"'
+            cache_control = IMMUTABLE
+        else:
+            etag = f'"{opened.stat.st_mtime_ns:x}-{size:x}"'
+            cache_control = REVALIDATE
+        
+        headers = [
+            ('etag', etag),
+            ('last-modified', last_modified),
+            ('cache-control', cache_control),
+            ('accept-ranges', 'bytes'),
+        ]
+        
+        if self._not_modified(request, etag, mtime):
+            await self._start(send, 304, headers)
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        
+        ranges = None
+        range_header = request.get('range')
+        if range_header is not None and self._if_range(request, etag, last_modified):
+            try:
+                ranges = parse_range(range_header, size)
+            except RangeNotSatisfiable:
+                await self._error(send, 416, [*headers, ('content-range', f'bytes */{size}')])
+                return
+        
+        content_type = mimetypes.guess_type(scope['path'])[0] or 'application/octet-stream'
+        
+        if ranges is None:
+            await self._start(send, 200, [*headers, ('content-type', content_type), ('content-length', str(size))])
+            if method == 'HEAD' or size == 0:
+                await send({'type': 'http.response.body', 'body': b''})
+            else:
+                await self._body(send, scope, opened, 0, size, False)
+            return
+        
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            await self._start(send, 206, [
+                *headers,
+                ('content-type', content_type),
+                ('content-range', f'bytes {start}-{end}/{size}'),
+                ('content-length', str(end - start + 1)),
+            ])
+            if method == 'HEAD':
+                await send({'type': 'http.response.body', 'body': b''})
+            else:
+                await self._body(send, scope, opened, start, end - start + 1, False)
+            return
+        
+        boundary = secrets.token_hex(16)
+        parts = [
+            (f'--{boundary}\r\ncontent-type: {content_type}\r\n'
+             f'content-range: bytes {start}-{end}/{size}\r\n\r\n').encode('latin-1')
+            for start, end in ranges
+        ]
+        closing = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+        length = sum(len(p) for p in parts) + sum(e - s + 1 for s, e in ranges) \
+                + 2 * (len(ranges) - 1) + len(closing)
+        
+        await self._start(send, 206, [
+            *headers,
+            ('content-type', f'multipart/byteranges; boundary={boundary}'),
+            ('content-length', str(length)),
+        ])
+        if method == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        
+        for i, ((start, end), part) in enumerate(zip(ranges, parts)):
+            if i > 0:
+                part = b'\r\n' + part
+            
+            await send({'type': 'http.response.body', 'body': part, 'more_body': True})
+            await self._body(send, scope, opened, start, end - start + 1, True)
+        
+        await send({'type': 'http.response.body', 'body': closing, 'more_body': False})
@@ -0,0 +1,244 @@
+import bisect
+import contextvars
+import math
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+_REQUEST_METRICS = contextvars.ContextVar('_REQUEST_METRICS', default=None)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    
+    pairs = ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+def _number(v):
+    if v == math.inf:
+        return '+Inf'
+    
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    kind = 'counter'
+    
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+    
+    def inc(self, value=1, *labels):
+        self._values[labels] = self._values.get(labels, 0) + value
+    
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, _labels(self.labels, labels), value
+
+
+class Gauge:
+    kind = 'gauge'
+    
+    def __init__(self, name, help, func):
+        self.name = name
+        self.help = help
+        self.func = func
+    
+    def samples(self):
+        yield self.name, '', self.func()
+
+
+class Histogram:
+    kind = 'histogram'
+    
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket..., sum]
+        self._values = {}
+    
+    def observe(self, value, *labels):
+        v = self._values.get(labels)
+        if v is None:
+            v = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        
+        v[bisect.bisect_left(self.buckets, value)] += 1
+        v[-1] += value
+    
+    def samples(self):
+        names = (*self.labels, 'le')
+        for labels, v in self._values.items():
+            total = 0
+            for le, count in zip((*self.buckets, math.inf), v):
+                total += count
+                yield f'{self.name}_bucket', _labels(names, (*labels, _number(le))), total
+            
+            yield f'{self.name}_sum', _labels(self.labels, labels), v[-1]
+            yield f'{self.name}_count', _labels(self.labels, labels), total
+
+
+# prometheus text format
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+    
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+    
+    def gauge(self, name, help, func):
+        return self._add(Gauge(name, help, func))
+    
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+    
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_number(value)}')
+        
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram('hoordu_api_request_seconds',
+    'Request latency', ('method', 'route', 'status'))
+SQL_STATEMENTS = registry.histogram('hoordu_api_request_sql_statements',
+    'SQL statements run by a request', ('route',), COUNT_BUCKETS)
+SQL_SECONDS = registry.histogram('hoordu_api_request_sql_seconds',
+    'Time a request spent running SQL statements', ('route',))
+BUILD_SECONDS = registry.histogram('hoordu_api_request_build_seconds',
+    'Time a request spent building and encoding responses', ('route',))
+FILE_STATS = registry.counter('hoordu_api_file_stats_total',
+    'Filesystem stats made to resolve file urls')
+
+
+# what a single request spent its time on
+class RequestMetrics:
+    __slots__ = ('sql_count', 'sql_time', 'build_time', 'stat_count')
+    
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.build_time = 0.0
+        self.stat_count = 0
+    
+    def server_timing(self, total):
+        return ', '.join((
+            f'sql;dur={self.sql_time * 1000:.1f};desc="{self.sql_count} statements"',
+            f'build;dur={self.build_time * 1000:.1f}',
+            f'stat;desc="{self.stat_count} stats"',
+            f'total;dur={total * 1000:.1f}',
+        ))
+
+
+def current():
+    return _REQUEST_METRICS.get()
+
+@contextmanager
+def building():
+    start = time.perf_counter()
+    try:
+        yield
+    
+    finally:
+        m = _REQUEST_METRICS.get()
+        if m is not None:
+            m.build_time += time.perf_counter() - start
+
+def count_stats(n):
+    FILE_STATS.inc(n)
+    m = _REQUEST_METRICS.get()
+    if m is not None:
+        m.stat_count += n
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_metrics_start', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['_metrics_start'].pop()
+    m = _REQUEST_METRICS.get()
+    if m is not None:
+        m.sql_count += 1
+        m.sql_time += time.perf_counter() - start
+
+def _handle_error(context):
+    starts = context.connection.info.get('_metrics_start') if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+# the async engine runs these in greenlets that share the request's context
+def instrument_engine(engine):
+    engine = getattr(engine, 'sync_engine', engine)
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+
+
+def _route(scope):
+    route = scope.get('route')
+    if route is not None:
+        return getattr(route, 'path', str(route))
+    
+    # mounted apps
+    return scope.get('root_path') or 'unmatched'
+
+# records the latency and the per request metrics of every http request
+# and optionally reports them to the client in a Server-Timing header
+class MetricsMiddleware:
+    def __init__(self, app, server_timing=False):
+        self.app = app
+        self.server_timing = server_timing
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        
+        m = RequestMetrics()
+        token = _REQUEST_METRICS.set(m)
+        start = time.perf_counter()
+        status = 500
+        
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if self.server_timing:
+                    timing = m.server_timing(time.perf_counter() - start)
+                    message['headers'] = [*message.get('headers', ()), (b'server-timing', timing.encode())]
+            
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_wrapper)
+        
+        finally:
+            elapsed = time.perf_counter() - start
+            route = _route(scope)
+            REQUEST_SECONDS.observe(elapsed, scope['method'], route, status)
+            SQL_STATEMENTS.observe(m.sql_count, route)
+            SQL_SECONDS.observe(m.sql_time, route)
+            BUILD_SECONDS.observe(m.build_time, route)
+            _REQUEST_METRICS.reset(token)
@@ -0,0 +1,72 @@
+import time
+from collections import OrderedDict
+
+from hoordu.models import Plugin, Source, Subscription
+from sqlalchemy import select
+
+
+_MISSING = object()
+
+
+# caches name -> id lookups for sources, subscriptions and plugins
+# names that don't exist are cached for a shorter time, past `maxsize`
+# entries the least recently used ones are dropped
+class NameResolver:
+    def __init__(self, ttl=300, negative_ttl=10, maxsize=16384):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.negative_ttl = negative_ttl
+        # key -> (id, expires), least recently used first
+        self._cache = OrderedDict()
+    
+    def _get(self, key, now):
+        entry = self._cache.get(key)
+        if entry is None:
+            return _MISSING
+        
+        id, expires = entry
+        if expires < now:
+            del self._cache[key]
+            return _MISSING
+        
+        self._cache.move_to_end(key)
+        return id
+    
+    async def _resolve(self, session, key, q):
+        now = time.monotonic()
+        id = self._get(key, now)
+        if id is _MISSING:
+            id = (await session.execute(q)).scalar_one_or_none()
+            ttl = self.ttl if id is not None else self.negative_ttl
+            self._cache[key] = (id, now + ttl)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        
+        return id
+    
+    async def source_id(self, session, name):
+        return await self._resolve(session, ('source', name),
+            select(Source.id).where(Source.name == name))
+    
+    async def plugin_id(self, session, name):
+        return await self._resolve(session, ('plugin', name),
+            select(Plugin.id).where(Plugin.name == name))
+    
+    async def subscription_id(self, session, source_id, name):
+        return await self._resolve(session, ('subscription', source_id, name),
+            select(Subscription.id).where(
+                Subscription.source_id == source_id,
+                Subscription.name == name,
+            ))
+    
+    def invalidate_source(self, name):
+        self._cache.pop(('source', name), None)
+    
+    def invalidate_plugin(self, name):
+        self._cache.pop(('plugin', name), None)
+    
+    def invalidate_subscription(self, source_id, name):
+        self._cache.pop(('subscription', source_id, name), None)
+    
+    def clear(self):
+        self._cache.clear()
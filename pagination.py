@@ -0,0 +1,120 @@
+import base64
+import json
+from decimal import Decimal
+
+from sqlalchemy import literal, tuple_
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class Page:
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+    
+    def headers(self):
+        h = {}
+        if self.next_cursor is not None:
+            h['X-Next-Cursor'] = self.next_cursor
+        if self.prev_cursor is not None:
+            h['X-Prev-Cursor'] = self.prev_cursor
+        return h
+
+
+# keyset pagination over one or more columns, the last columns act as
+# tie-breakers so the key must be unique within the query
+#
+# cursors are opaque urlsafe strings holding the key of the row to page
+# from and the direction, bound values are typed after their columns so
+# the comparison can use the index
+class Keyset:
+    def __init__(self, *columns, descending=True):
+        self.columns = columns
+        self.descending = descending
+    
+    def key(self, row):
+        return tuple(getattr(row, c.key) for c in self.columns)
+    
+    def encode(self, key, backward=False):
+        values = [str(v) if isinstance(v, Decimal) else v for v in key]
+        data = json.dumps([values, int(backward)], separators=(',', ':')).encode()
+        return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+    
+    def decode(self, cursor):
+        try:
+            data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            values, backward = json.loads(data)
+            if len(values) != len(self.columns):
+                raise InvalidCursor('cursor does not match this endpoint')
+            
+            values = tuple(c.type.python_type(v) for c, v in zip(self.columns, values))
+        
+        except InvalidCursor:
+            raise
+        
+        except Exception as e:
+            raise InvalidCursor('invalid cursor') from e
+        
+        return values, bool(backward)
+    
+    def _bind(self, column, value):
+        return literal(value, type_=column.type)
+    
+    def predicate(self, values, backward=False):
+        if len(self.columns) == 1:
+            lhs = self.columns[0]
+            rhs = self._bind(lhs, values[0])
+        else:
+            lhs = tuple_(*self.columns)
+            rhs = tuple_(*(self._bind(c, v) for c, v in zip(self.columns, values)))
+        
+        if self.descending != backward:
+            return lhs < rhs
+        else:
+            return lhs > rhs
+    
+    def ordering(self, backward=False):
+        if self.descending != backward:
+            return [c.desc() for c in self.columns]
+        else:
+            return [c.asc() for c in self.columns]
+    
+    def apply(self, q, count, cursor=None, until=None):
+        backward = False
+        if cursor is not None:
+            values, backward = self.decode(cursor)
+            q = q.where(self.predicate(values, backward))
+        
+        elif until is not None:
+            # legacy single value cursor on the first column
+            column = self.columns[0]
+            bound = self._bind(column, until)
+            q = q.where(column < bound if self.descending else column > bound)
+        
+        q = q \
+                .order_by(*self.ordering(backward)) \
+                .limit(count)
+        
+        return q, backward
+    
+    async def fetch(self, q, count, cursor=None, until=None):
+        q, backward = self.apply(q, count, cursor=cursor, until=until)
+        items = list(await q.all())
+        
+        full = len(items) >= count
+        paged = cursor is not None or until is not None
+        if backward:
+            items.reverse()
+        
+        next_cursor = None
+        prev_cursor = None
+        if items:
+            if full or backward:
+                next_cursor = self.encode(self.key(items[-1]))
+            if paged and (full or not backward):
+                prev_cursor = self.encode(self.key(items[0]), backward=True)
+        
+        return Page(items, next_cursor, prev_cursor)
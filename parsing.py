@@ -0,0 +1,105 @@
+import asyncio
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+# urls that only differ in these parse the same
+def normalize_url(url):
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        host = f'{host}:{port}'
+    
+    netloc = host
+    if parts.username is not None:
+        userinfo = parts.username if parts.password is None else f'{parts.username}:{parts.password}'
+        netloc = f'{userinfo}@{host}'
+    
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, parts.fragment))
+
+
+# parses urls with hrd.parse_url, the results are kept for `ttl` seconds
+# in an lru of `maxsize` urls, concurrent parses of the same url share a
+# single call, and at most `concurrency` calls run at once
+#
+# `convert` turns what parse_url returned into what is cached
+class UrlParser:
+    def __init__(self, hrd, convert, maxsize=4096, ttl=600, concurrency=8):
+        self.hrd = hrd
+        self.convert = convert
+        self.maxsize = maxsize
+        self.ttl = ttl
+        
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # url -> (expires, result), oldest first
+        self._entries = OrderedDict()
+        # url -> future of the parse
+        self._pending = {}
+        # bumped by clear, parses started before it aren't stored
+        self._generation = 0
+        
+        self.hits = 0
+        self.misses = 0
+    
+    # parses already running are left to finish for their callers, later
+    # ones start over
+    def clear(self):
+        self._entries.clear()
+        self._pending.clear()
+        self._generation += 1
+    
+    def _done(self, key, pending):
+        if self._pending.get(key) is pending:
+            del self._pending[key]
+    
+    async def _parse(self, key, url, generation):
+        async with self._semaphore:
+            result = self.convert(await self.hrd.parse_url(url))
+        
+        if generation == self._generation:
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        
+        return result
+    
+    async def parse(self, url):
+        key = normalize_url(url)
+        
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, result = entry
+            if expires >= time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+            
+            del self._entries[key]
+        
+        self.misses += 1
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = asyncio.ensure_future(self._parse(key, url, self._generation))
+            pending.add_done_callback(lambda _: self._done(key, pending))
+        
+        # a cancelled request doesn't cancel the parse for the others
+        return await asyncio.shield(pending)
+    
+    # returns (result, exception) pairs in the order of `urls`
+    async def parse_many(self, urls):
+        results = await asyncio.gather(*(self.parse(url) for url in urls), return_exceptions=True)
+        return [
+            (None, r) if isinstance(r, BaseException) else (r, None)
+            for r in results
+        ]
@@ -0,0 +1,72 @@
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+import metrics
+
+
+ACQUIRE_SECONDS = metrics.registry.histogram('hoordu_api_db_pool_acquire_seconds',
+    'Time spent waiting for a database connection')
+ACQUIRE_TIMEOUTS = metrics.registry.counter('hoordu_api_db_pool_timeouts_total',
+    'Database connection requests that timed out')
+
+
+# `limits` replace the pool_size, max_overflow and timeout arguments, so
+# pools recreated by engine.dispose() keep them
+def _timed(cls, limits):
+    class TimedPool(cls):
+        def __init__(self, creator, **kwargs):
+            kwargs.update(limits)
+            super().__init__(creator, **kwargs)
+            self.max_overflow = kwargs.get('max_overflow', 10)
+        
+        def connect(self):
+            start = time.perf_counter()
+            try:
+                return super().connect()
+            
+            except exc.TimeoutError:
+                ACQUIRE_TIMEOUTS.inc()
+                raise
+            
+            finally:
+                ACQUIRE_SECONDS.observe(time.perf_counter() - start)
+    
+    TimedPool.__name__ = f'Timed{cls.__name__}'
+    TimedPool.__qualname__ = TimedPool.__name__
+    return TimedPool
+
+# replaces the engine's pool with a timed one, with the given limits when
+# they're not None, and exports its state
+#
+# the new pool comes from the public recreate(), which copies every other
+# setting and the event listeners, the old pool's class is swapped first
+# so the copy is a timed one
+#
+# only queue pools have limits to configure, other pools are left alone
+def configure(engine, size=None, overflow=None, timeout=None):
+    engine = getattr(engine, 'sync_engine', engine)
+    old = engine.pool
+    if not isinstance(old, QueuePool):
+        return
+    
+    limits = {
+        name: value
+        for name, value in (('pool_size', size), ('max_overflow', overflow), ('timeout', timeout))
+        if value is not None
+    }
+    old.__class__ = _timed(type(old), limits)
+    engine.pool = old.recreate()
+    old.dispose()
+    
+    # engine.dispose() recreates the pool, always read the current one
+    def gauge(name, help, func):
+        metrics.registry.gauge(f'hoordu_api_db_pool_{name}', help, lambda: func(engine.pool))
+    
+    gauge('size', 'Connections the pool keeps open', lambda p: p.size())
+    gauge('max_overflow', 'Connections the pool may open past its size', lambda p: p.max_overflow)
+    gauge('timeout_seconds', 'How long a request waits for a connection', lambda p: p.timeout())
+    gauge('checked_out', 'Connections in use', lambda p: p.checkedout())
+    gauge('checked_in', 'Idle connections in the pool', lambda p: p.checkedin())
+    gauge('overflow', 'Connections open past the pool size', lambda p: max(p.overflow(), 0))
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+import hoordu
+from hoordu.models import Base, RemotePost
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, delete, func, insert, select
+
+
+log = logging.getLogger(__name__)
+
+MASK64 = (1 << 64) - 1
+# advisory lock held while the shuffle table is rebuilt
+REFRESH_LOCK = 0x68726472616e64
+
+
+class RandomPost(Base):
+    __tablename__ = 'random_post'
+    
+    position = Column(Integer, primary_key=True)
+    post_id = Column(Integer, ForeignKey('remote_post.id', ondelete='CASCADE'))
+
+
+class RandomPostState(Base):
+    __tablename__ = 'random_post_state'
+    
+    id = Column(Integer, primary_key=True)
+    refreshed = Column(DateTime(timezone=True), nullable=False)
+
+
+TABLES = [RandomPost.__table__, RandomPostState.__table__]
+
+
+def _mix(seed, k):
+    # splitmix64, maps (seed, ordinal) to a well distributed 64 bit value
+    z = (seed * 0x9e3779b97f4a7c15 + k + 1) & MASK64
+    z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & MASK64
+    return z ^ (z >> 31)
+
+
+def _permute(seed, i, n):
+    # a 4 round feistel network over the smallest even power of two that
+    # holds n, values past n are walked through the network again until
+    # they land inside, so this is a bijection of range(n)
+    half = max(1, ((n - 1).bit_length() + 1) // 2)
+    mask = (1 << half) - 1
+    
+    x = i
+    while True:
+        l, r = x >> half, x & mask
+        for j in range(4):
+            l, r = r, l ^ (_mix(seed ^ j, r) & mask)
+        
+        x = (l << half) | r
+        if x < n:
+            return x
+
+
+# pages through a seeded random permutation of remote posts, every result
+# is tagged with its ordinal in the permutation so passing the last one
+# back as `until` continues the same permutation
+#
+# `shuffle` reads the precomputed shuffle table through a seeded
+# permutation of its positions, one primary key lookup per post
+# `idrange` walks a seeded permutation of the ids between the smallest and
+# largest post id, skipping the ids no post has, it is used until the
+# shuffle table is built
+#
+# the shuffle table is shared by every worker, only one rebuilds it at a
+# time and only once it's older than `refresh_interval`
+class RandomSampler:
+    def __init__(self, hrd: hoordu.hoordu, refresh_interval=3600, oversample=2, max_rounds=4):
+        self.hrd = hrd
+        self.refresh_interval = refresh_interval
+        self.oversample = oversample
+        self.max_rounds = max_rounds
+        
+        self.size = None
+        self.id_range = None
+        self._id_range_time = 0
+        self._created = False
+        self._task = None
+    
+    async def refresh(self):
+        async with self.hrd.engine.begin() as conn:
+            # the other workers wait here and then find the table fresh
+            await conn.execute(select(func.pg_advisory_xact_lock(REFRESH_LOCK)))
+            if not self._created:
+                await conn.run_sync(Base.metadata.create_all, tables=TABLES)
+                self._created = True
+            
+            fresh = (await conn.execute(
+                select(func.count()) \
+                    .where(RandomPostState.refreshed > func.now() - timedelta(seconds=self.refresh_interval))
+            )).scalar()
+            
+            if not fresh:
+                await conn.execute(delete(RandomPost))
+                await conn.execute(
+                    insert(RandomPost).from_select(
+                        ['position', 'post_id'],
+                        select(
+                            func.row_number().over(order_by=func.random()) - 1,
+                            RemotePost.id,
+                        )
+                    )
+                )
+                await conn.execute(delete(RandomPostState))
+                await conn.execute(insert(RandomPostState).values(id=1, refreshed=func.now()))
+            
+            self.size = (await conn.execute(select(func.count()).select_from(RandomPost))).scalar()
+    
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                log.exception('failed to refresh the shuffle table')
+            
+            await asyncio.sleep(self.refresh_interval)
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    # returns the (ordinal, post_id) pairs and the last ordinal looked at,
+    # which is where the next page continues from, None once the whole
+    # permutation was read
+    #
+    # pages can come back short or empty before the end when ids are sparse
+    async def sample(self, session, count, seed, until=None, method=None):
+        start = until + 1 if until is not None else 0
+        
+        if method is None:
+            method = 'shuffle' if self.size else 'idrange'
+        
+        match method:
+            case 'shuffle':
+                return await self._sample_shuffle(session, count, seed, start)
+            
+            case 'idrange':
+                return await self._sample_idrange(session, count, seed, start)
+            
+            case _:
+                raise ValueError(f'unknown sampling method "{method}"')
+    
+    async def _sample_shuffle(self, session, count, seed, start):
+        n = self.size
+        if not n or start >= n:
+            return [], None
+        
+        end = min(start + count, n)
+        positions = {_permute(seed, o, n): o for o in range(start, end)}
+        
+        rows = await session.execute(
+            select(RandomPost.position, RandomPost.post_id) \
+                .where(RandomPost.position.in_(list(positions)))
+        )
+        
+        result = sorted((positions[position], post_id) for position, post_id in rows)
+        return result, end - 1 if end < n else None
+    
+    async def _get_id_range(self, session):
+        now = time.monotonic()
+        if self.id_range is None or now - self._id_range_time > self.refresh_interval:
+            lo, hi = (await session.execute(select(func.min(RemotePost.id), func.max(RemotePost.id)))).one()
+            self.id_range = (lo, hi) if lo is not None else None
+            self._id_range_time = now
+        
+        return self.id_range
+    
+    async def _sample_idrange(self, session, count, seed, start):
+        id_range = await self._get_id_range(session)
+        if id_range is None:
+            return [], None
+        
+        lo, hi = id_range
+        span = hi - lo + 1
+        
+        result = []
+        k = start
+        for _ in range(self.max_rounds):
+            if k >= span:
+                break
+            
+            batch = count * self.oversample
+            candidates = [(o, lo + _permute(seed, o, span)) for o in range(k, min(k + batch, span))]
+            k += batch
+            
+            rows = await session.execute(
+                select(RemotePost.id) \
+                    .where(RemotePost.id.in_([id for _, id in candidates]))
+            )
+            found = set(rows.scalars())
+            
+            for o, id in candidates:
+                if id in found:
+                    result.append((o, id))
+                    if len(result) >= count:
+                        return result, o if o < span - 1 else None
+        
+        last = min(k, span) - 1
+        return result, last if last < span - 1 else None
@@ -7,6 +7,7 @@ import inspect as ins
 
 class MessageHeader(BaseModel):
     c: str
+    n: int | None = None
 
 
 
@@ -21,48 +22,162 @@ class ParseResponse(BaseModel):
     id: str | None = None
     options: Any | None = None
 
+class ParseBatchRequest(BaseModel):
+    urls: list[str]
+
+class ParseBatchEntry(BaseModel):
+    url: str
+    results: list[ParseResponse] = []
+    error: str | None = None
+
 
 import hoordu.models as m
 import hoordu.forms as f
 from sqlalchemy import inspect
 from sqlalchemy.orm.collections import InstrumentedList
 
+# one ref map is shared by the whole build, refs added while building an
+# object are undone once it's built, so repeats along a path are cut
+# but siblings are kept
+#
+# objects built more than once are memoized, the built value is reused
+# when every outside object it was cut against is still on the current
+# path and none of the objects seen anywhere inside of it are
 class BuildContext:
-    def __init__(self, parent=None):
-        self.parent = parent
-        if self.parent is not None:
-            self._refs = self.parent._refs.copy()
-        else:
-            self._refs = set()
+    def __init__(self, models):
+        self.models = models
+        # ref -> position in _added
+        self._refs = {}
+        self._added = []
+        # refs that were cut while building the current objects
+        self._cuts = []
+        # every ref entered or reused while building the current objects,
+        # kept after the objects inside are done so their parents see them
+        self._inside = []
+        self._seen = {}
+        # key -> (value, ref, refs inside of it, outside refs it was cut against)
+        self._memo = {}
     
     def push(self):
-        return BuildContext(self)
+        return len(self._added), len(self._cuts), len(self._inside)
+    
+    # `key` memoizes the value under something other than its ref, for
+    # objects that are built differently depending on where they are
+    def pop(self, mark, ref=None, value=None, key=None):
+        mark, cut_mark, inside_mark = mark
+        added = self._added
+        refs = self._refs
+        
+        cuts = self._cuts
+        outside = tuple({r for r in cuts[cut_mark:] if refs[r] < mark})
+        del cuts[cut_mark:]
+        cuts.extend(outside)
+        
+        if ref is not None:
+            if key is None:
+                key = ref
+            
+            n = self._seen[key] = self._seen.get(key, 0) + 1
+            if n > 1:
+                inner = tuple({r for r in self._inside[inside_mark:] if r != ref})
+                self._memo[key] = (value, ref, inner, outside)
+        
+        while len(added) > mark:
+            del refs[added.pop()]
+        
+        if not added:
+            # nothing is being built around it anymore
+            del self._inside[:]
     
-    def pop(self):
-        return self.parent
+    def enter(self, ref):
+        if ref is not None and ref not in self._refs:
+            self._refs[ref] = len(self._added)
+            self._added.append(ref)
+            self._inside.append(ref)
     
     def check(self, v):
-        if not hasattr(v, '__table__'):
+        ref = self.models.plan(type(v)).ref(v)
+        if ref is None:
             return True
         
-        ins = inspect(v.__class__)
-        key = []
-        for pk in ins.primary_key:
-            k = next((attr for attr in ins.c.keys() if ins.c[attr].name == pk.name), None)
-            key.append(getattr(v, k))
-        
-        ref = (type(v), tuple(key))
         if ref in self._refs:
+            self._cuts.append(ref)
             return False
         
-        self._refs.add(ref)
+        self._refs[ref] = len(self._added)
+        self._added.append(ref)
+        self._inside.append(ref)
         return True
+    
+    # a fresh context to build `obj` on its own, like a related post, that
+    # still cuts objects of its type on the current path so cycles end,
+    # None when `obj` is on the path itself
+    def nested(self, obj):
+        plan = self.models.plan(type(obj))
+        ref = plan.ref(obj)
+        if ref is not None and ref in self._refs:
+            return None
+        
+        ctx = BuildContext(self.models)
+        for r in self._added:
+            if r[0] is plan.cls:
+                ctx.enter(r)
+        
+        return ctx
+    
+    def cached(self, key):
+        entry = self._memo.get(key)
+        if entry is None:
+            return None
+        
+        value, ref, inner, outside = entry
+        refs = self._refs
+        if any(r in refs for r in inner) or not all(r in refs for r in outside):
+            return None
+        
+        # the objects around it depend on what it saw and was cut against
+        self._inside.append(ref)
+        self._inside.extend(inner)
+        self._cuts.extend(outside)
+        return value
+
+
+class Plan:
+    __slots__ = ('cls', 'converter', 'target', 'attrs', 'accepts', 'pk')
+    
+    def __init__(self, cls, converter, target, attrs, accepts, pk):
+        self.cls = cls
+        self.converter = converter
+        self.target = target
+        # mapped attribute keys to emit, None for unmapped classes
+        self.attrs = attrs
+        self.accepts = accepts
+        self.pk = pk
+    
+    def ref(self, v):
+        if self.pk is None:
+            return None
+        
+        key = tuple(getattr(v, k) for k in self.pk)
+        if None in key:
+            # transient objects have no identity yet
+            return None
+        
+        return (self.cls, key)
+    
+    def values(self, obj):
+        d = obj.__dict__
+        if self.attrs is not None:
+            return ((k, d[k]) for k in self.attrs if k in d)
+        
+        return ((k, v) for k, v in d.items() if not k.startswith('_') and k in self.accepts)
 
 
 class Models:
     def __init__(self):
         self.models = {}
         self.converters = {}
+        self._plans = {}
         
         self._register_converter(list, self._conv_list)
         self._register_converter(InstrumentedList, self._conv_list)
@@ -71,7 +186,7 @@ class Models:
     def _conv_list(self, l, ctx):
         r = []
         for v in l:
-            rv = self.build(v, ctx.push())
+            rv = self.build(v, ctx)
             if rv is not None:
                 r.append(rv)
         
@@ -80,7 +195,7 @@ class Models:
     def _conv_dict(self, d, ctx):
         r = []
         for k, v  in d.items():
-            rv = self.build(v, ctx.push())
+            rv = self.build(v, ctx)
             if rv is not None:
                 r[k] = rv
         
@@ -89,11 +204,13 @@ class Models:
     def register(self, SQLModel):
         def reg_internal(PYDModel):
             self.models[SQLModel] = PYDModel
+            self._plans.clear()
             return PYDModel
         return reg_internal
     
     def _register_converter(self, type, converter):
         self.converters[type] = converter
+        self._plans.clear()
     
     def register_converter(self, Type):
         def reg_conv_internal(func):
@@ -107,22 +224,60 @@ class Models:
             if v is not None:
                 return v
     
+    def _compile(self, cls):
+        classes = ins.getmro(cls)
+        converter = self._find(self.converters, classes)
+        target = self._find(self.models, classes)
+        
+        accepts = None
+        if target is not None:
+            accepts = set()
+            for name, field in target.model_fields.items():
+                accepts.add(name)
+                if field.alias is not None:
+                    accepts.add(field.alias)
+        
+        attrs = None
+        pk = None
+        mapper = inspect(cls, raiseerr=False) if hasattr(cls, '__table__') else None
+        if mapper is not None:
+            if accepts is not None:
+                attrs = tuple(k for k in mapper.attrs.keys() if k in accepts)
+            
+            pk = tuple(mapper.get_property_by_column(c).key for c in mapper.primary_key)
+        
+        return Plan(cls, converter, target, attrs, accepts, pk)
+    
+    def plan(self, cls):
+        plan = self._plans.get(cls)
+        if plan is None:
+            plan = self._plans[cls] = self._compile(cls)
+        
+        return plan
+    
     def build(self, obj, ctx=None):
         if ctx is None:
-            ctx = BuildContext()
+            ctx = BuildContext(self)
         
-        classes = ins.getmro(type(obj))
+        plan = self.plan(type(obj))
         
-        conv = self._find(self.converters, classes)
-        if conv is not None:
-            obj = conv(obj, ctx)
-            classes = ins.getmro(type(obj))
+        if plan.converter is not None:
+            obj = plan.converter(obj, ctx)
+            plan = self.plan(type(obj))
         
-        target = self._find(self.models, classes)
-        if target is not None:
-            ctx.check(obj)
-            d = {k: self.build(v, ctx.push()) for k, v in obj.__dict__.items() if not k.startswith('_') and ctx.check(v)}
-            return target(**d)
+        if plan.target is not None:
+            ref = plan.ref(obj)
+            if ref is not None:
+                value = ctx.cached(ref)
+                if value is not None:
+                    return value
+            
+            mark = ctx.push()
+            ctx.enter(ref)
+            d = {k: self.build(v, ctx) for k, v in plan.values(obj) if ctx.check(v)}
+            value = plan.target(**d)
+            ctx.pop(mark, ref, value)
+            return value
             
         else:
             return obj
@@ -197,6 +352,8 @@ class File(BaseModel):
     
     file_url: str | None
     thumb_url: str | None
+    # width -> url of a resized thumbnail
+    thumb_variants: dict[str, str] | None = None
     
     hash: str | None
     filename: str | None
@@ -271,6 +428,70 @@ class FeedEntry(BaseModel):
     def sort_index_to_string(sort_index) -> str:
         return str(sort_index)
 
+class PostRef(BaseModel):
+    source: str
+    original_id: str
+
+class SubscriptionRef(BaseModel):
+    source: str
+    name: str
+
+# subscriptions to merge, `sources` adds every subscription of a source
+class TimelineRequest(BaseModel):
+    subscriptions: list[SubscriptionRef] = []
+    sources: list[str] = []
+
+class PostBatchRequest(BaseModel):
+    ids: list[int] = []
+    refs: list[PostRef] = []
+
+class PostBatch(BaseModel):
+    posts: list[Post]
+    missing_ids: list[int]
+    missing_refs: list[PostRef]
+
+class RelatedEdge(BaseModel):
+    post_id: int
+    related_id: int
+
+# nodes are ordered by their distance from the post, the post first
+class PostGraph(BaseModel):
+    nodes: list[Post]
+    edges: list[RelatedEdge]
+    truncated: bool
+
+# counts are as of `refreshed`, None until the first refresh is done
+class SubscriptionCount(BaseModel):
+    name: str
+    post_count: int
+
+class SourceStats(BaseModel):
+    name: str
+    post_count: int
+    subscriptions: list[SubscriptionCount]
+    refreshed: datetime | None
+
+class GalleryStats(BaseModel):
+    name: str
+    post_count: int
+    refreshed: datetime | None
+
+class TagFrequency(BaseModel):
+    id: int
+    source_id: int
+    category: m.TagCategory | None
+    tag: str | None
+    post_count: int
+
+class FeedFrame(BaseModel):
+    c: str
+    entries: list[FeedEntry] | None = None
+    cursor: str | None = None
+
+class ExportEntry(BaseModel):
+    cursor: str
+    entry: FeedEntry
+
 @models.register(m.Related)
 class Related(BaseModel):
     post: Post | None = Field(alias='remote', default=None)
@@ -0,0 +1,267 @@
+import re
+import time
+
+from hoordu.models import RemotePost, RemoteTag, Source, TagCategory, remote_post_tag
+from sqlalchemy import exists, func, literal_column, select, text
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+FULLTEXT_CONFIG = 'simple'
+
+# must be kept identical to the indexed expression
+def fulltext_document():
+    empty = literal_column("''")
+    return func.to_tsvector(
+        literal_column(f"'{FULLTEXT_CONFIG}'"),
+        func.coalesce(RemotePost.title, empty).op('||')(literal_column("' '")).op('||')(func.coalesce(RemotePost.comment, empty))
+    )
+
+FULLTEXT_INDEX_NAME = 'remote_post_fulltext_idx'
+FULLTEXT_INDEX = f'''
+CREATE INDEX CONCURRENTLY IF NOT EXISTS {FULLTEXT_INDEX_NAME} ON remote_post
+USING gin (to_tsvector('{FULLTEXT_CONFIG}', coalesce(title, '') || ' ' || coalesce(comment, '')))
+'''
+
+
+class TagRef:
+    def __init__(self, tag, category=None):
+        self.tag = tag
+        self.category = category
+    
+    def matches(self, tag, category):
+        return self.tag == tag and (self.category is None or self.category == category)
+
+
+# a tag term of the query, `literal` is the whole term as written when
+# it was read with operators, it's used instead when a tag has that name
+class TagTerm:
+    def __init__(self, refs, exclude=False, literal=None):
+        self.refs = refs
+        self.exclude = exclude
+        self.literal = literal
+
+
+# an optional "-" and "prefix:" followed by a quoted value, or a bare word
+TERM = re.compile(r'''(?P<prefix>-?(?:[^\s"':|]+:)?)(?:"(?P<dq>(?:[^"\\]|\\.)*)"|'(?P<sq>(?:[^'\\]|\\.)*)')(?=\s|$)|(?P<word>\S+)''')
+ESCAPE = re.compile(r'\\(.)')
+
+
+# query grammar, terms are separated by spaces
+#
+#   tag             post must have the tag
+#   a|b|c           post must have at least one of the tags
+#   -tag            post must not have the tag
+#   category:tag    tag restricted to a tag category, e.g. artist:name
+#   source:name     only posts from this source, can be repeated
+#   text:words      full-text match over the title and comment
+#
+# a term that is exactly the name of a tag is that tag, so tags with "-",
+# ":" or "|" in them can be written as they are, otherwise the value can
+# be quoted, "a|b" or -'x:y' are single tags, and \" or \' escape a quote
+# inside of it, quotes in the middle of a word are part of the tag
+class Query:
+    def __init__(self):
+        self.terms = []
+        self.sources = []
+        self.text = []
+    
+    @staticmethod
+    def _tag(term):
+        category, sep, tag = term.partition(':')
+        if sep and category in TagCategory.__members__:
+            return TagRef(tag, TagCategory[category])
+        
+        return TagRef(term)
+    
+    def _quoted(self, prefix, value):
+        exclude = prefix.startswith('-')
+        prefix = prefix.removeprefix('-')
+        
+        if prefix == 'source:' and not exclude:
+            self.sources.append(value)
+        
+        elif prefix == 'text:' and not exclude:
+            self.text.append(value)
+        
+        elif prefix and prefix[:-1] in TagCategory.__members__:
+            self.terms.append(TagTerm([TagRef(value, TagCategory[prefix[:-1]])], exclude))
+        
+        else:
+            self.terms.append(TagTerm([TagRef(prefix + value)], exclude))
+    
+    def _word(self, term):
+        if term.startswith('source:'):
+            self.sources.append(term[len('source:'):])
+        
+        elif term.startswith('text:'):
+            self.text.append(term[len('text:'):])
+        
+        elif term.startswith('-') and len(term) > 1:
+            self.terms.append(TagTerm([self._tag(term[1:])], True, term))
+        
+        else:
+            refs = [self._tag(t) for t in term.split('|') if t]
+            literal = None
+            if len(refs) != 1 or refs[0].tag != term:
+                literal = term
+            
+            self.terms.append(TagTerm(refs, False, literal))
+    
+    @classmethod
+    def parse(cls, query):
+        q = cls()
+        for m in TERM.finditer(query):
+            if m['word'] is not None:
+                q._word(m['word'])
+            else:
+                value = m['dq'] if m['dq'] is not None else m['sq']
+                q._quoted(m['prefix'], ESCAPE.sub(r'\1', value))
+        
+        if not q.text and all(t.exclude and t.literal is None for t in q.terms):
+            raise InvalidQuery('the query needs at least one tag or text term')
+        
+        return q
+    
+    def tags(self):
+        return [r for t in self.terms for r in t.refs] + [TagRef(t.literal) for t in self.terms if t.literal is not None]
+
+
+# tag frequencies come from the statistics tables once they're built,
+# until then they're counted and cached for `frequency_ttl` seconds
+class SearchEngine:
+    def __init__(self, stats=None, frequency_ttl=3600):
+        self.stats = stats
+        self.frequency_ttl = frequency_ttl
+        # tag_id -> (count, expires)
+        self._frequencies = {}
+    
+    # built concurrently so writes to remote_post aren't blocked while it
+    # builds, which can't run inside of a transaction
+    async def ensure_indexes(self, engine):
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+            
+            # a concurrent build that failed leaves an invalid index behind
+            # that IF NOT EXISTS would keep
+            invalid = (await conn.execute(text('''
+                SELECT 1 FROM pg_index
+                WHERE indexrelid = to_regclass(:name) AND NOT indisvalid
+            '''), {'name': FULLTEXT_INDEX_NAME})).first()
+            if invalid is not None:
+                await conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {FULLTEXT_INDEX_NAME}'))
+            
+            await conn.execute(text(FULLTEXT_INDEX))
+    
+    async def frequencies(self, session, tag_ids):
+        if self.stats is not None and self.stats.ready:
+            return await self.stats.tag_counts(session, tag_ids)
+        
+        now = time.monotonic()
+        result = {}
+        missing = []
+        for id in tag_ids:
+            entry = self._frequencies.get(id)
+            if entry is not None and entry[1] >= now:
+                result[id] = entry[0]
+            else:
+                missing.append(id)
+        
+        if missing:
+            rows = await session.execute(
+                select(remote_post_tag.c.tag_id, func.count()) \
+                    .where(remote_post_tag.c.tag_id.in_(missing)) \
+                    .group_by(remote_post_tag.c.tag_id)
+            )
+            counts = dict(rows.all())
+            for id in missing:
+                count = counts.get(id, 0)
+                self._frequencies[id] = (count, now + self.frequency_ttl)
+                result[id] = count
+        
+        return result
+    
+    async def _resolve_tags(self, session, refs, source_ids):
+        names = {r.tag for r in refs}
+        if not names:
+            return []
+        
+        q = select(RemoteTag.id, RemoteTag.tag, RemoteTag.category) \
+                .where(RemoteTag.tag.in_(names))
+        
+        if source_ids is not None:
+            q = q.where(RemoteTag.source_id.in_(source_ids))
+        
+        return (await session.execute(q)).all()
+    
+    def _ids(self, tags, refs):
+        return [id for id, tag, category in tags if any(r.matches(tag, category) for r in refs)]
+    
+    async def plan(self, session, query):
+        source_ids = None
+        if query.sources:
+            rows = await session.execute(select(Source.id).where(Source.name.in_(query.sources)))
+            source_ids = list(rows.scalars())
+            if not source_ids:
+                return None
+        
+        tags = await self._resolve_tags(session, query.tags(), source_ids)
+        names = {tag for _, tag, _ in tags}
+        
+        groups = []
+        excluded = []
+        for term in query.terms:
+            if term.literal is not None and term.literal in names:
+                groups.append(self._ids(tags, [TagRef(term.literal)]))
+            
+            elif term.exclude:
+                excluded.extend(self._ids(tags, term.refs))
+            
+            else:
+                ids = self._ids(tags, term.refs)
+                if not ids:
+                    # a required tag that doesn't exist can't match anything
+                    return None
+                
+                groups.append(ids)
+        
+        # a bare -x passes the parser's check in case a tag is named "-x"
+        if not groups and not query.text:
+            raise InvalidQuery('the query needs at least one tag or text term')
+        
+        # intersect starting from the rarest group
+        frequencies = await self.frequencies(session, {id for g in groups for id in g})
+        groups.sort(key=lambda ids: sum(frequencies[id] for id in ids))
+        
+        where = []
+        if source_ids is not None:
+            where.append(RemotePost.source_id.in_(source_ids))
+        
+        if groups:
+            rarest, *rest = groups
+            where.append(RemotePost.id.in_(
+                select(remote_post_tag.c.post_id) \
+                    .where(remote_post_tag.c.tag_id.in_(rarest))
+            ))
+            
+            for ids in rest:
+                where.append(exists().where(
+                    remote_post_tag.c.post_id == RemotePost.id,
+                    remote_post_tag.c.tag_id.in_(ids),
+                ))
+        
+        if excluded:
+            where.append(~exists().where(
+                remote_post_tag.c.post_id == RemotePost.id,
+                remote_post_tag.c.tag_id.in_(excluded),
+            ))
+        
+        rank = None
+        if query.text:
+            tsquery = func.websearch_to_tsquery(literal_column(f"'{FULLTEXT_CONFIG}'"), ' '.join(query.text))
+            where.append(fulltext_document().op('@@')(tsquery))
+            rank = func.ts_rank_cd(fulltext_document(), tsquery)
+        
+        return where, rank
@@ -5,13 +5,15 @@ uvloop.install()
 
 import asyncio
 import contextlib
+import logging
+import os
+import random
 from datetime import datetime, timedelta
 from functools import partial
 import pathlib
 
-from fastapi import FastAPI, APIRouter, WebSocket, Body, Depends, HTTPException, WebSocketException
-from fastapi.staticfiles import StaticFiles
-from starlette.responses import FileResponse, Response
+from fastapi import FastAPI, APIRouter, Request, WebSocket, Body, Depends, HTTPException, WebSocketException
+from starlette.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
 from starlette.websockets import WebSocketDisconnect
 
 import hoordu
@@ -23,17 +25,38 @@ import sqlalchemy.exc as sqlexc
 
 
 import schemas as s
-from context import ContextSessionDepedency, session
+from context import ContextSessionDepedency, session, release
+from files import FileResolver, collect_files
+from sampling import RandomSampler
+from pagination import Keyset, InvalidCursor
+from timeline import Timeline
+from search import SearchEngine, Query, InvalidQuery
+from stats import Statistics
+from names import NameResolver
+from graph import RelatedGraph
+from parsing import UrlParser
+from configs import PluginConfigCache
+from cache import ResponseCache, CHANNEL as CACHE_CHANNEL, encode_invalidation, decode_invalidation
+from singleflight import SingleFlight
+from media import MediaFiles, IMMUTABLE, REVALIDATE
+import thumbs
+from thumbs import ThumbnailCache
+from feed import FeedNotifier, FeedSocket
+import sparse
+import export
+import fastjson
+import metrics
+from metrics import MetricsMiddleware
+import pool
 from typing import Optional, Any
 
 
-from sqlalchemy import Table, Column, Integer, String, Text, LargeBinary, DateTime, Numeric, ForeignKey, Index, func, inspect, select, insert
+from sqlalchemy import Table, Column, Integer, String, Text, LargeBinary, DateTime, Numeric, ForeignKey, Index, func, inspect, select, insert, or_, tuple_
 from sqlalchemy.orm import relationship, ColumnProperty, RelationshipProperty
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.asyncio import async_object_session
 from sqlalchemy.ext.compiler import compiles
-from sqlalchemy_fulltext import FullText
 from sqlalchemy_utils import ChoiceType
 
 
@@ -49,7 +72,27 @@ class Gallery(Base):
 
 
 
-def create_api(hrd: hoordu.hoordu) -> APIRouter:
+log = logging.getLogger(__name__)
+
+MAX_BATCH = 1000
+
+# what each route includes when the client doesn't pass `include`
+POST_INCLUDE = 'source,files,tags'
+GALLERY_INCLUDE = 'files,source,related.files'
+SOURCE_POSTS_INCLUDE = 'files,tags,related.files'
+FEED_INCLUDE = 'files,tags,related.files'
+SEARCH_INCLUDE = 'files,tags,source,related.files'
+# the edges already say how the nodes are related
+GRAPH_INCLUDE = 'files,tags'
+
+# pool_size, max_overflow and pool_timeout override the database pool's
+# limits, None keeps the ones hoordu created it with
+# plugin configs are cached until one of config_files changes
+def create_api(hrd: hoordu.hoordu, fast_json: bool = True,
+        pool_size: int | None = None,
+        max_overflow: int | None = None,
+        pool_timeout: float | None = None,
+        config_files: list[str] = ()) -> APIRouter:
     api = APIRouter(
         dependencies=[Depends(ContextSessionDepedency(hrd))]
     )
@@ -58,26 +101,247 @@ def create_api(hrd: hoordu.hoordu) -> APIRouter:
     api.put = partial(api.put, response_model_exclude_unset=True, response_model_by_alias=False)
     api.delete = partial(api.delete, response_model_exclude_unset=True, response_model_by_alias=False)
     
-    # TODO get the type automatically?
-    @s.models.register_converter(File)
-    def convert_file(file: File, ctx) -> s.File:
-        orig, thumb = hrd.get_file_paths(file)
+    file_resolver = FileResolver(hrd)
+    thumbnails = ThumbnailCache(pathlib.Path(hrd.config.settings.base_path) / 'variants')
+    
+    gallery_keyset = Keyset(Gallery.id)
+    post_keyset = Keyset(RemotePost.id)
+    feed_keyset = Keyset(FeedEntry.sort_index, FeedEntry.remote_post_id)
+    timeline = Timeline()
+    
+    async def paginate(keyset, response, q, count, cursor, until):
+        try:
+            page = await keyset.fetch(q, count, cursor=cursor, until=until)
+        except InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        response.headers.update(page.headers())
+        return page.items
+    sampler = RandomSampler(hrd)
+    statistics = Statistics(hrd, Gallery)
+    search_engine = SearchEngine(statistics)
+    names = NameResolver()
+    related_graph = RelatedGraph()
+    feed_notifier = FeedNotifier(hrd)
+    plugin_configs = PluginConfigCache(hrd, s.models.build, config_files)
+    
+    def selection(include, fields, default):
+        try:
+            return sparse.parse(include, fields, default)
+        except sparse.InvalidFields as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    async def resolve_source(source_name):
+        source_id = await names.source_id(session, source_name)
+        if source_id is None:
+            raise HTTPException(status_code=404, detail=f'Source "{source_name}" not found')
+        
+        return source_id
+    
+    async def resolve_subscription(source_name, subscription_name):
+        source_id = await resolve_source(source_name)
+        subscription_id = await names.subscription_id(session, source_id, subscription_name)
+        if subscription_id is None:
+            raise HTTPException(status_code=404, detail=f'Subscription "{subscription_name}" not found')
+        
+        return subscription_id
+    
+    # the indexes are built in the background, a failed build is logged
+    # and tried again on the next start
+    index_task = None
+    
+    async def create_indexes():
+        try:
+            await search_engine.ensure_indexes(hrd.engine)
+            await timeline.ensure_indexes(hrd.engine)
+        
+        except asyncio.CancelledError:
+            raise
+        
+        except Exception:
+            log.exception('failed to create indexes')
+    
+    @api.on_event('startup')
+    async def startup():
+        nonlocal index_task
+        sampler.start()
+        statistics.start()
+        index_task = asyncio.create_task(create_indexes())
+        await feed_notifier.start()
+        await thumbnails.start()
+        plugin_configs.start()
+    
+    @api.on_event('shutdown')
+    async def shutdown():
+        if index_task is not None:
+            index_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await index_task
+        
+        await sampler.stop()
+        await statistics.stop()
+        await feed_notifier.stop()
+        thumbnails.stop()
+        await plugin_configs.stop()
+    
+    encoder = fastjson.Encoder(s.models)
+    normalizer = fastjson.Normalizer(encoder, {
+        RemotePost: 'posts',
+        File: 'files',
+        RemoteTag: 'tags',
+        Source: 'sources',
+    })
+    
+    async def build(obj):
+        await file_resolver.resolve(collect_files(obj))
+        with metrics.building():
+            return s.models.build(obj)
+    
+    # encodes ORM objects straight to json when fast_json is enabled
+    # the output is the same as returning the built models
+    # sparse selections always go through the encoder, the models would
+    # reject posts with missing fields
+    async def respond(obj, response=None, sel=None, normalize=False):
+        # everything is loaded by now, the connection isn't held while encoding
+        await release()
+        if not fast_json and not normalize and (sel is None or not sel.requested):
+            return await build(obj)
+        
+        await file_resolver.resolve(collect_files(obj))
+        with metrics.building():
+            if normalize:
+                content = normalizer.encode(obj, sel)
+            else:
+                content = encoder.encode(obj, sel)
+        
+        r = Response(content=content, media_type='application/json')
+        if response is not None:
+            r.headers.raw.extend(response.headers.raw)
+        
+        return r
+    
+    response_cache = ResponseCache()
+    
+    # invalidations apply to this worker right away and reach the others
+    # through the feed notifier's connection, the notification also comes
+    # back to this worker, invalidating twice is harmless
+    def on_invalidation(payload):
+        try:
+            tags = decode_invalidation(payload)
+        except ValueError:
+            return
+        
+        if tags is None:
+            response_cache.clear()
+        else:
+            response_cache.invalidate(*tags)
+    
+    feed_notifier.subscribe(CACHE_CHANNEL, on_invalidation)
+    
+    async def broadcast(payloads):
+        try:
+            await feed_notifier.publish(CACHE_CHANNEL, payloads)
+        except Exception:
+            log.exception('failed to send a cache invalidation to the other workers')
+    
+    async def invalidate(*tags):
+        response_cache.invalidate(*tags)
+        await broadcast(encode_invalidation(tags))
+    
+    async def clear_cache():
+        response_cache.clear()
+        await broadcast(encode_invalidation())
+    
+    metrics.instrument_engine(hrd.engine)
+    pool.configure(hrd.engine, pool_size, max_overflow, pool_timeout)
+    for name in ('hits', 'misses', 'not_modified', 'invalidations'):
+        metrics.registry.gauge(f'hoordu_api_response_cache_{name}', f'Response cache {name.replace("_", " ")}',
+            partial(getattr, response_cache, name))
+    
+    metrics.registry.gauge('hoordu_api_response_cache_bytes', 'Size of the cached response bodies',
+        partial(getattr, response_cache, 'size'))
+    metrics.registry.gauge('hoordu_api_stats_refresh_seconds', 'Time the last statistics refresh took',
+        lambda: statistics.refresh_seconds or 0)
+    
+    # serves a read mostly route from the response cache, `produce` returns
+    # the objects to encode or raises, errors aren't cached
+    async def cached(request, key, tags, produce, sel=None):
+        entry = response_cache.get(key)
+        if entry is None:
+            generation = response_cache.generation()
+            obj = await produce()
+            await release()
+            await file_resolver.resolve(collect_files(obj))
+            with metrics.building():
+                content = encoder.encode(obj, sel)
+            
+            entry = response_cache.put(key, content, tags, generation)
         
-        def convert_url(url):
-            url = pathlib.Path(url)
+        return response_cache.response(request, entry)
+    
+    reads = SingleFlight()
+    for name in ('calls', 'shared'):
+        metrics.registry.gauge(f'hoordu_api_coalesced_{name}', f'Coalesced reads {name}',
+            partial(getattr, reads, name))
+    
+    # identical concurrent reads of a page share one query and one encoded
+    # result, `fetch` gets its own session since it outlives the request
+    # that started it
+    async def coalesced(key, response, fetch, sel, normalize, wrap=None):
+        async def produce():
+            async with hrd.session() as session:
+                page = await fetch(session)
             
-            if not url.exists():
-                return None
+            items = page.items if wrap is None else [wrap(x) for x in page.items]
+            await file_resolver.resolve(collect_files(items))
+            with metrics.building():
+                if normalize:
+                    content = normalizer.encode(items, sel)
+                elif fast_json or sel.requested:
+                    content = encoder.encode(items, sel)
+                else:
+                    content = s.models.build(items)
             
-            base = pathlib.Path(hrd.config.settings.base_path)
-            return str(pathlib.Path('/data') / url.relative_to(base))
+            return content, page.headers()
+        
+        # name lookups are done, nothing else needs the request's session
+        await release()
+        try:
+            content, headers = await reads.do(key, produce)
+        except InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
-        orig = convert_url(orig)
-        thumb = convert_url(thumb)
+        response.headers.update(headers)
+        if not isinstance(content, bytes):
+            return content
+        
+        r = Response(content=content, media_type='application/json')
+        r.headers.raw.extend(response.headers.raw)
+        return r
+    
+    # images are resized from the original, anything else from the
+    # thumbnail the plugin made
+    def thumbnail_path(file: File):
+        orig, thumb = hrd.get_file_paths(file)
+        if file.mime is not None and file.mime.startswith('image/') and file_resolver.exists(orig):
+            return orig
+        
+        if file_resolver.exists(thumb):
+            return thumb
+        
+        return None
+    
+    def file_fields(file: File):
+        orig, thumb = file_resolver.urls(file)
         
         hash = file.hash.hex() if file.hash is not None else None
         
-        return s.File(
+        variants = None
+        if thumbnail_path(file) is not None:
+            version = f'&v={hash}' if hash is not None else ''
+            variants = {str(w): f'/api/thumb/{file.id}?w={w}{version}' for w in thumbs.WIDTHS}
+        
+        return dict(
             id=file.id,
             
             local_id=file.local_id,
@@ -87,6 +351,7 @@ def create_api(hrd: hoordu.hoordu) -> APIRouter:
             
             file_url=orig,
             thumb_url=thumb,
+            thumb_variants=variants,
             
             hash=hash,
             filename=file.filename,
@@ -96,12 +361,36 @@ def create_api(hrd: hoordu.hoordu) -> APIRouter:
             remote_identifier=file.remote_identifier,
         )
     
+    # TODO get the type automatically?
+    @s.models.register_converter(File)
+    def convert_file(file: File, ctx) -> s.File:
+        return s.File(**file_fields(file))
+    
+    @encoder.register_converter(File)
+    def encode_file(file: File, ctx, sel=None) -> dict:
+        return file_fields(file)
+    
     @s.models.register_converter(Related)
     def convert_related(related: Related, ctx) -> s.Post:
         if related.remote is not None:
-            return s.models.build(related.remote)
-        else:
-            return None
+            nested = ctx.nested(related.remote)
+            if nested is not None:
+                return s.models.build(related.remote, nested)
+        
+        return None
+    
+    @encoder.register_converter(Related)
+    def encode_related(related: Related, ctx, sel=None) -> dict:
+        if related.remote is not None:
+            nested = ctx.nested(related.remote)
+            if nested is not None:
+                return encoder.to_json(related.remote, nested, sel)
+        
+        return None
+    
+    @normalizer.register_unwrap(Related)
+    def unwrap_related(related: Related) -> RemotePost:
+        return related.remote
     
     @s.models.register_converter(FormEntry)
     def convert_entry(entry: FormEntry, ctx) -> s.Entry:
@@ -112,9 +401,7 @@ def create_api(hrd: hoordu.hoordu) -> APIRouter:
             value=entry.value,
         )
     
-    @api.get('/parse')
-    async def parse(url: str) -> list[s.ParseResponse]:
-        parsed = await hrd.parse_url(url)
+    def parse_responses(parsed):
         l = []
         for p, o in parsed:
             dl_type = s.DownloadType.Post
@@ -136,47 +423,83 @@ def create_api(hrd: hoordu.hoordu) -> APIRouter:
         
         return l
     
+    url_parser = UrlParser(hrd, parse_responses)
+    for name in ('hits', 'misses'):
+        metrics.registry.gauge(f'hoordu_api_parse_cache_{name}', f'Parse cache {name}',
+            partial(getattr, url_parser, name))
+    
+    @api.get('/parse')
+    async def parse(url: str) -> list[s.ParseResponse]:
+        return await url_parser.parse(url)
+    
+    @api.post('/parse')
+    async def parse_batch(request: s.ParseBatchRequest) -> list[s.ParseBatchEntry]:
+        if len(request.urls) > MAX_BATCH:
+            raise HTTPException(status_code=400, detail=f'At most {MAX_BATCH} urls can be parsed at once')
+        
+        l = []
+        for url, (results, error) in zip(request.urls, await url_parser.parse_many(request.urls)):
+            if error is not None:
+                l.append(s.ParseBatchEntry(url=url, error=str(error) or type(error).__name__))
+            else:
+                l.append(s.ParseBatchEntry(url=url, results=results))
+        
+        return l
+    
     @api.get('/sources')
-    async def list_sources() -> list[s.Source]:
-        sources = await session.select(Source) \
-                .options(
-                    selectinload(Source.preferred_plugin),
-                ) \
-                .all()
+    async def list_sources(request: Request) -> list[s.Source]:
+        async def produce():
+            return await session.select(Source) \
+                    .options(
+                        selectinload(Source.preferred_plugin),
+                    ) \
+                    .all()
         
-        return s.models.build(sources)
+        return await cached(request, ('sources',), ('sources',), produce)
     
     @api.get('/source/{source_name}')
-    async def get_source(source_name: str) -> s.Source:
-        source = await session.select(Source) \
-                .where(Source.name == source_name) \
-                .options(
-                    selectinload(Source.preferred_plugin),
-                ) \
-                .one_or_none()
-        
-        if source is None:
-            raise HTTPException(status_code=404, detail=f'Source "{source_name}" not found')
+    async def get_source(request: Request, source_name: str) -> s.Source:
+        async def produce():
+            source = await session.select(Source) \
+                    .where(Source.name == source_name) \
+                    .options(
+                        selectinload(Source.preferred_plugin),
+                    ) \
+                    .one_or_none()
+            
+            if source is None:
+                raise HTTPException(status_code=404, detail=f'Source "{source_name}" not found')
+            
+            return source
         
-        return s.models.build(source)
+        return await cached(request, ('source', source_name), ('sources',), produce)
+    
+    @api.get('/source/{source_name}/stats')
+    async def get_source_stats(source_name: str) -> s.SourceStats:
+        source_id = await resolve_source(source_name)
+        post_count = await statistics.source(session, source_id)
+        subscriptions = await statistics.subscriptions(session, source_id)
+        
+        return s.SourceStats(
+            name=source_name,
+            post_count=post_count,
+            subscriptions=[s.SubscriptionCount(name=name, post_count=n) for _, name, n in subscriptions],
+            refreshed=statistics.refreshed,
+        )
     
     @api.get('/source/{source_name}/subscriptions')
-    async def list_source_subscriptions(source_name: str) -> list[s.Subscription]:
-        source = await session.select(Source) \
-                .where(Source.name == source_name) \
-                .one_or_none()
-        
-        if source is None:
-            raise HTTPException(status_code=404, detail=f'Source "{source_name}" not found')
-        
-        subscriptions = await session.select(Subscription) \
-                .where(Subscription.source_id == source.id) \
-                .options(
-                    selectinload(Subscription.source),
-                ) \
-                .all()
+    async def list_source_subscriptions(request: Request, source_name: str) -> list[s.Subscription]:
+        async def produce():
+            source_id = await resolve_source(source_name)
+            
+            return await session.select(Subscription) \
+                    .where(Subscription.source_id == source_id) \
+                    .options(
+                        selectinload(Subscription.source),
+                    ) \
+                    .all()
         
-        return s.models.build(subscriptions)
+        return await cached(request, ('subscriptions', source_name), (('subscriptions', source_name),), produce)
     
     @api.post('/source/{source_name}/subscriptions')
     async def create_subscription(source_name: str, subscription: s.Subscription) -> s.Subscription:
@@ -206,20 +529,18 @@ def create_api(hrd: hoordu.hoordu) -> APIRouter:
         except sqlexc.IntegrityError:
             raise HTTPException(status_code=409)
         
+        names.invalidate_subscription(source.id, sub.name)
+        await invalidate(('subscriptions', source_name))
+        
         return s.models.build(sub)
     
     @api.get('/source/{source_name}/subscription/{subscription_name}')
     async def get_subscription(source_name: str, subscription_name: str) -> s.Subscription:
-        source = await session.select(Source) \
-                .where(Source.name == source_name) \
-                .one_or_none()
-        
-        if source is None:
-            raise HTTPException(status_code=404, detail=f'Source "{source_name}" not found')
+        source_id = await resolve_source(source_name)
         
         subscription = await session.select(Subscription) \
                 .where(
-                    Subscription.source_id == source.id,
+                    Subscription.source_id == source_id,
                     Subscription.name == subscription_name,
                 ) \
                 .options(
@@ -235,43 +556,61 @@ def create_api(hrd: hoordu.hoordu) -> APIRouter:
     
     
     @api.get('/plugins')
-    async def list_plugins() -> list[s.Plugin]:
-        plugins = await session.select(Plugin) \
-                .options(
-                    selectinload(Plugin.source),
-                ) \
-                .all()
+    async def list_plugins(request: Request) -> list[s.Plugin]:
+        async def produce():
+            return await session.select(Plugin) \
+                    .options(
+                        selectinload(Plugin.source),
+                    ) \
+                    .all()
         
-        return s.models.build(plugins)
+        return await cached(request, ('plugins',), ('plugins',), produce)
     
     @api.get('/plugin/{plugin_name}')
-    async def get_plugin(plugin_name: str) -> s.Plugin:
-        plugin = await session.select(Plugin) \
-                .where(Plugin.name == plugin_name) \
-                .options(
-                    selectinload(Plugin.source),
-                ) \
-                .one_or_none()
-        
-        if plugin is None:
-            raise HTTPException(status_code=404, detail=f'Plugin "{plugin_name}" not found')
+    async def get_plugin(request: Request, plugin_name: str) -> s.Plugin:
+        async def produce():
+            plugin_id = await names.plugin_id(session, plugin_name)
+            if plugin_id is None:
+                raise HTTPException(status_code=404, detail=f'Plugin "{plugin_name}" not found')
+            
+            plugin = await session.select(Plugin) \
+                    .where(Plugin.id == plugin_id) \
+                    .options(
+                        selectinload(Plugin.source),
+                    ) \
+                    .one_or_none()
+            
+            if plugin is None:
+                names.invalidate_plugin(plugin_name)
+                raise HTTPException(status_code=404, detail=f'Plugin "{plugin_name}" not found')
+            
+            return plugin
         
-        return s.models.build(plugin)
+        return await cached(request, ('plugin', plugin_name), ('plugins',), produce)
     
     
     @api.get('/plugin/{plugin_name}/config')
     async def get_plugin_config(plugin_name: str) -> s.Form:
-        success, form = await hrd.setup_plugin(plugin_name, parameters=None)
-        if form is None:
-            plugin = await session.plugin(plugin_name)
-            form = plugin.config_form()
-            form.fill(plugin.config)
-        
-        return s.models.build(form)
+        config = await plugin_configs.get(plugin_name)
+        return config.form
     
     @api.post('/plugin/{plugin_name}/config')
     async def update_plugin_config(plugin_name: str, params: Any = Body(...)) -> s.Form:
         success, form = await hrd.setup_plugin(plugin_name, parameters=params)
+        names.invalidate_plugin(plugin_name)
+        source_name = (await session.execute(
+            select(Source.name) \
+                .join(Plugin, Plugin.source_id == Source.id) \
+                .where(Plugin.name == plugin_name)
+        )).scalar_one_or_none()
+        if source_name is not None:
+            names.invalidate_source(source_name)
+        
+        plugin_configs.invalidate(plugin_name)
+        # setting a plugin up can add its source too
+        await invalidate('plugins', 'sources')
+        # and change which plugins parse a url
+        url_parser.clear()
         if form is None:
             plugin = await session.plugin(plugin_name)
             form = plugin.config_form()
@@ -282,54 +621,220 @@ def create_api(hrd: hoordu.hoordu) -> APIRouter:
         return s.models.build(form)
     
     
-    @api.get('/post/{post_id}')
-    async def get_post_by_id(post_id: int) -> s.Post:
-        post = await session.select(RemotePost) \
-                .where(
-                    RemotePost.id == post_id,
-                ) \
-                .options(
-                    selectinload(RemotePost.source),
-                    selectinload(RemotePost.files),
-                    selectinload(RemotePost.tags),
-                ) \
+    @api.post('/files/invalidate')
+    async def invalidate_files(ids: list[int] | None = Body(None)):
+        # cached posts hold the urls of their files
+        await invalidate('posts')
+        
+        if ids is None:
+            file_resolver.invalidate()
+            return
+        
+        files = await session.select(File) \
+                .where(File.id.in_(ids)) \
+                .all()
+        
+        file_resolver.invalidate(files)
+    
+    # called by whatever modifies posts outside of the api, e.g. downloaders
+    @api.post('/posts/invalidate')
+    async def invalidate_posts(ids: list[int] | None = Body(None)):
+        if ids is None:
+            await invalidate('posts')
+        else:
+            await invalidate(*(('post', id) for id in ids))
+    
+    @api.post('/cache/invalidate')
+    async def invalidate_cache():
+        await clear_cache()
+    
+    @api.get('/cache/stats')
+    async def cache_stats() -> dict[str, int]:
+        return response_cache.stats()
+    
+    
+    async def thumbnail_source(file: File):
+        await file_resolver.resolve([file])
+        return thumbnail_path(file)
+    
+    @api.get('/thumb/{file_id}')
+    async def get_thumbnail(
+            request: Request,
+            file_id: int,
+            w: int = 320,
+            fmt: str = 'webp',
+            v: Optional[str] = None,
+        ):
+        
+        if fmt not in thumbs.FORMATS:
+            raise HTTPException(status_code=400, detail=f'Unknown thumbnail format "{fmt}"')
+        
+        file = await session.select(File) \
+                .where(File.id == file_id) \
                 .one_or_none()
         
-        if post is None:
-            raise HTTPException(status_code=404, detail=f'Post id {post_id} not found')
+        if file is None:
+            raise HTTPException(status_code=404, detail=f'File id {file_id} not found')
+        
+        await release()
+        width = thumbnails.width(w)
+        
+        # variants are named after the file hash, the etag holds for any url
+        version = file.hash.hex() if file.hash is not None else 'none'
+        headers = {
+            'Cache-Control': REVALIDATE,
+            'ETag': f'"{version}-{width}-{fmt}"',
+        }
+        if v is not None and file.hash is not None and v == version:
+            headers['Cache-Control'] = IMMUTABLE
+        
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match is not None and headers['ETag'] in (t.strip().removeprefix('W/') for t in if_none_match.split(',')):
+            return Response(status_code=304, headers=headers)
+        
+        source = await thumbnail_source(file)
+        if source is None:
+            raise HTTPException(status_code=404, detail=f'File id {file_id} is not available')
+        
+        try:
+            content = await thumbnails.get(file, source, width, fmt)
+        except thumbs.RENDER_ERRORS:
+            raise HTTPException(status_code=415, detail=f'Cannot make a thumbnail of file id {file_id}')
+        
+        return Response(content=content, media_type=thumbs.FORMATS[fmt], headers=headers)
+    
+    @api.get('/post/{post_id}')
+    async def get_post_by_id(
+            request: Request,
+            post_id: int,
+            include: Optional[str] = None,
+            fields: Optional[str] = None,
+        ) -> s.Post:
+        
+        sel = selection(include, fields, POST_INCLUDE)
+        
+        async def produce():
+            post = await session.select(RemotePost) \
+                    .where(
+                        RemotePost.id == post_id,
+                    ) \
+                    .options(*sel.options()) \
+                    .one_or_none()
+            
+            if post is None:
+                raise HTTPException(status_code=404, detail=f'Post id {post_id} not found')
+            
+            return post
         
         #return s.build(s.Post, post)
-        return s.models.build(post)
+        return await cached(request, ('post', post_id, include, fields), ('posts', ('post', post_id)), produce, sel)
+    
+    @api.post('/posts')
+    async def get_posts(
+            request: s.PostBatchRequest,
+            include: Optional[str] = None,
+            fields: Optional[str] = None,
+        ) -> s.PostBatch:
+        
+        sel = selection(include, fields, POST_INCLUDE)
+        
+        if len(request.ids) + len(request.refs) > MAX_BATCH:
+            raise HTTPException(status_code=400, detail=f'At most {MAX_BATCH} posts can be requested at once')
+        
+        # every ref with its key, None when its source doesn't exist
+        refs = []
+        for ref in request.refs:
+            source_id = await names.source_id(session, ref.source)
+            refs.append((ref, (source_id, ref.original_id) if source_id is not None else None))
+        
+        keys = [k for _, k in refs if k is not None]
+        conditions = []
+        if request.ids:
+            conditions.append(RemotePost.id.in_(request.ids))
+        
+        if keys:
+            conditions.append(tuple_(RemotePost.source_id, RemotePost.original_id).in_(keys))
+        
+        posts = []
+        if conditions:
+            posts = await session.select(RemotePost) \
+                    .where(or_(*conditions)) \
+                    .options(*sel.options()) \
+                    .all()
+        
+        by_id = {p.id: p for p in posts}
+        by_ref = {(p.source_id, p.original_id): p for p in posts}
+        
+        ordered = []
+        missing_ids = []
+        for id in request.ids:
+            post = by_id.get(id)
+            if post is None:
+                missing_ids.append(id)
+            else:
+                ordered.append(post)
+        
+        missing_refs = []
+        for ref, key in refs:
+            post = by_ref.get(key)
+            if post is None:
+                missing_refs.append(ref)
+            else:
+                ordered.append(post)
+        
+        await release()
+        if fast_json or sel.requested:
+            await file_resolver.resolve(collect_files(ordered))
+            with metrics.building():
+                content = fastjson.dumps(dict(
+                    posts=encoder.to_json(ordered, sel=sel),
+                    missing_ids=missing_ids,
+                    missing_refs=[r.model_dump() for r in missing_refs],
+                ))
+            
+            return Response(content=content, media_type='application/json')
+        
+        return s.PostBatch(
+            posts=await build(ordered),
+            missing_ids=missing_ids,
+            missing_refs=missing_refs,
+        )
     
     @api.get('/source/{source_name}/post/{original_id}')
-    async def get_post(source_name: str, original_id: str) -> s.Post:
-        source = await session.select(Source) \
-                .where(Source.name == source_name) \
-                .one_or_none()
+    async def get_post(
+            source_name: str,
+            original_id: str,
+            include: Optional[str] = None,
+            fields: Optional[str] = None,
+        ) -> s.Post:
         
-        if source is None:
-            raise HTTPException(status_code=404, detail=f'Source "{source_name}" not found')
+        sel = selection(include, fields, POST_INCLUDE)
+        source_id = await resolve_source(source_name)
         
         post = await session.select(RemotePost) \
                 .where(
-                    RemotePost.source_id == source.id,
+                    RemotePost.source_id == source_id,
                     RemotePost.original_id == original_id,
                 ) \
-                .options(
-                    selectinload(RemotePost.source),
-                    selectinload(RemotePost.files),
-                    selectinload(RemotePost.tags),
-                ) \
+                .options(*sel.options()) \
                 .one_or_none()
         
         if post is None:
             raise HTTPException(status_code=404, detail=f'Post "{original_id}" not found')
         
         #return s.build(s.Post, post)
-        return s.models.build(post)
+        return await respond(post, sel=sel)
     
     @api.get('/post/{post_id}/related')
-    async def get_post_related(post_id: int) -> list[s.Post]:
+    async def get_post_related(
+            post_id: int,
+            include: Optional[str] = None,
+            fields: Optional[str] = None,
+            normalize: bool = False,
+        ) -> list[s.Post]:
+        
+        sel = selection(include, fields, POST_INCLUDE)
+        
         post = await session.select(RemotePost) \
                 .where(
                     RemotePost.id == post_id,
@@ -337,289 +842,474 @@ def create_api(hrd: hoordu.hoordu) -> APIRouter:
                 .one_or_none()
         
         if post is None:
-            raise HTTPException(status_code=404, detail=f'Post "{original_id}" not found')
+            raise HTTPException(status_code=404, detail=f'Post id {post_id} not found')
         
         related_posts = await session.select(RemotePost) \
                 .join(Related, RemotePost.id == Related.remote_id) \
                 .where(
                     Related.related_to_id == post.id,
                 ) \
-                .options(
-                    selectinload(RemotePost.source),
-                    selectinload(RemotePost.files),
-                    selectinload(RemotePost.tags),
-                ) \
+                .options(*sel.options()) \
+                .all()
+        
+        return await respond(related_posts, sel=sel, normalize=normalize)
+    
+    @api.get('/post/{post_id}/graph')
+    async def get_post_graph(
+            post_id: int,
+            depth: int = 2,
+            max_nodes: int = 200,
+            include: Optional[str] = None,
+            fields: Optional[str] = None,
+        ) -> s.PostGraph:
+        
+        sel = selection(include, fields, GRAPH_INCLUDE)
+        
+        nodes, truncated = await related_graph.nodes(session, post_id, depth, max_nodes)
+        
+        posts = await session.select(RemotePost) \
+                .where(RemotePost.id.in_(nodes)) \
+                .options(*sel.options()) \
                 .all()
         
-        return s.models.build(related_posts)
+        by_id = {p.id: p for p in posts}
+        if post_id not in by_id:
+            raise HTTPException(status_code=404, detail=f'Post id {post_id} not found')
+        
+        ordered = [by_id[id] for id in nodes if id in by_id]
+        edges = await related_graph.edges(session, list(by_id))
+        
+        await release()
+        if fast_json or sel.requested:
+            await file_resolver.resolve(collect_files(ordered))
+            with metrics.building():
+                content = fastjson.dumps(dict(
+                    nodes=encoder.to_json(ordered, sel=sel),
+                    edges=[dict(post_id=a, related_id=b) for a, b in edges],
+                    truncated=truncated,
+                ))
+            
+            return Response(content=content, media_type='application/json')
+        
+        return s.PostGraph(
+            nodes=await build(ordered),
+            edges=[s.RelatedEdge(post_id=a, related_id=b) for a, b in edges],
+            truncated=truncated,
+        )
+    
+    @api.get('/gallery/{name}/stats')
+    async def get_gallery_stats(name: str) -> s.GalleryStats:
+        return s.GalleryStats(
+            name=name,
+            post_count=await statistics.gallery_posts(session, name),
+            refreshed=statistics.refreshed,
+        )
     
     @api.get('/gallery/{name}')
     async def all_posts(
+            response: Response,
             name: str,
             count: int = 20,
-            until: Optional[int] = None
+            until: Optional[int] = None,
+            cursor: Optional[str] = None,
+            include: Optional[str] = None,
+            fields: Optional[str] = None,
+            normalize: bool = False,
         ) -> list[s.FeedEntry]:
         
-        q_posts = session.select(Gallery) \
-                        .join(RemotePost) \
-                        .where(Gallery.name == name)
-        
-        if until is not None:
-            q_posts = q_posts \
-                    .where(
-                        Gallery.id < cast(until, Numeric)
-                    )
+        sel = selection(include, fields, GALLERY_INCLUDE)
         
-        q_posts = q_posts \
-                .order_by(Gallery.id.desc()) \
-                .limit(count) \
-                .options(
-                    selectinload(Gallery.post).selectinload(RemotePost.files),
-                    selectinload(Gallery.post).selectinload(RemotePost.source),
-                    selectinload(Gallery.post) \
-                        .selectinload(RemotePost.related) \
-                        .selectinload(Related.remote) \
-                        .selectinload(RemotePost.files),
-                )
+        q_posts = session.select(Gallery) \
+                .join(RemotePost) \
+                .where(Gallery.name == name) \
+                .options(*sel.options(selectinload(Gallery.post)))
         
-        posts = await q_posts.all()
+        posts = await paginate(gallery_keyset, response, q_posts, count, cursor, until)
         
-        return s.models.build([FeedEntry(sort_index=x.id, post=x.post) for x in posts])
+        return await respond([FeedEntry(sort_index=x.id, post=x.post) for x in posts], response, sel.entry(), normalize)
     
     @api.get('/random')
     async def all_posts(
+            response: Response,
             count: int = 20,
-            until: Optional[int] = None
+            until: Optional[int] = None,
+            seed: Optional[int] = None,
+            method: Optional[str] = None,
+            include: Optional[str] = None,
+            fields: Optional[str] = None,
+            normalize: bool = False,
         ) -> list[s.FeedEntry]:
         
+        sel = selection(include, fields, GALLERY_INCLUDE)
+        
+        if seed is None:
+            seed = random.getrandbits(31)
+        
+        response.headers['X-Random-Seed'] = str(seed)
+        
+        try:
+            sample, last = await sampler.sample(session, count, seed, until=until, method=method)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        # short pages don't mean the end, the header does
+        if last is not None:
+            response.headers['X-Next-Until'] = str(last)
+        
+        if not sample:
+            return await respond([], response, sel.entry(), normalize)
+        
         q_posts = session.select(RemotePost) \
-                .order_by(func.random()) \
-                .limit(count) \
-                .options(
-                    selectinload(RemotePost.files),
-                    selectinload(RemotePost.source),
-                    selectinload(RemotePost.related) \
-                        .selectinload(Related.remote) \
-                        .selectinload(RemotePost.files),
-                )
+                .where(RemotePost.id.in_([id for _, id in sample])) \
+                .options(*sel.options())
+        
+        posts = {x.id: x for x in await q_posts.all()}
         
-        posts = await q_posts.all()
+        return await respond([FeedEntry(sort_index=o, post=posts[id]) for o, id in sample if id in posts], response, sel.entry(), normalize)
+    
+    def source_posts_query(session, source_id, sel=None):
+        if sel is None:
+            sel = sparse.parse(None, None, SOURCE_POSTS_INCLUDE)
         
-        return s.models.build([FeedEntry(sort_index=x.id, post=x) for x in posts])
+        return session.select(RemotePost) \
+                .where(
+                    RemotePost.source_id == source_id
+                ) \
+                .options(*sel.options())
     
     @api.get('/source/{source_name}/posts')
     async def get_source_posts(
+            response: Response,
             source_name: str,
             count: int = 20,
-            until: Optional[int] = None
+            until: Optional[int] = None,
+            cursor: Optional[str] = None,
+            include: Optional[str] = None,
+            fields: Optional[str] = None,
+            normalize: bool = False,
         ) -> list[s.FeedEntry]:
         
-        source = await session.select(Source) \
-                .where(Source.name == source_name) \
-                .options(
-                    selectinload(Source.preferred_plugin),
-                ) \
-                .one_or_none()
+        sel = selection(include, fields, SOURCE_POSTS_INCLUDE)
+        source_id = await resolve_source(source_name)
         
-        if source is None:
-            raise HTTPException(status_code=404, detail=f'Source "{source_name}" not found')
-        
-        q_posts = session.select(RemotePost) \
-                .where(
-                    RemotePost.source_id == source.id
-                )
-        
-        if until is not None:
-            q_posts = q_posts \
-                    .where(
-                        RemotePost.id < cast(until, Numeric)
-                    )
-        
-        q_posts = q_posts \
-                .order_by(RemotePost.id.desc()) \
-                .limit(count) \
-                .options(
-                    selectinload(RemotePost.files),
-                    selectinload(RemotePost.tags),
-                    selectinload(RemotePost.related) \
-                        .selectinload(Related.remote) \
-                        .selectinload(RemotePost.files),
-                )
+        def fetch(session):
+            return post_keyset.fetch(source_posts_query(session, source_id, sel), count, cursor=cursor, until=until)
         
-        posts = await q_posts.all()
+        return await coalesced(
+            ('source_posts', source_id, count, until, cursor, include, fields, normalize),
+            response, fetch, sel.entry(), normalize,
+            lambda x: FeedEntry(sort_index=x.id, post=x),
+        )
+    
+    def feed_query(session, subscription_id, sel=None):
+        if sel is None:
+            sel = sparse.parse(None, None, FEED_INCLUDE)
         
-        return s.models.build([FeedEntry(sort_index=x.id, post=x) for x in posts])
+        return session.select(FeedEntry) \
+                .join(RemotePost) \
+                .where(
+                    FeedEntry.subscription_id == subscription_id
+                ) \
+                .options(*sel.options(selectinload(FeedEntry.post)))
     
     @api.get('/source/{source_name}/subscription/{subscription_name}/feed')
     async def subscription_feed(
+            response: Response,
             source_name: str,
             subscription_name: str,
             count: int = 20,
-            until: Optional[int] = None
+            until: Optional[int] = None,
+            cursor: Optional[str] = None,
+            include: Optional[str] = None,
+            fields: Optional[str] = None,
+            normalize: bool = False,
         ) -> list[s.FeedEntry]:
         
-        source = await session.select(Source) \
-                .where(Source.name == source_name) \
-                .one_or_none()
+        sel = selection(include, fields, FEED_INCLUDE)
+        subscription_id = await resolve_subscription(source_name, subscription_name)
         
-        if source is None:
-            raise HTTPException(status_code=404, detail=f'Source "{source_name}" not found')
+        def fetch(session):
+            return feed_keyset.fetch(feed_query(session, subscription_id, sel), count, cursor=cursor, until=until)
         
-        subscription = await session.select(Subscription) \
-                .where(
-                    Subscription.source_id == source.id,
-                    Subscription.name == subscription_name,
-                ) \
-                .one_or_none()
+        return await coalesced(
+            ('feed', subscription_id, count, until, cursor, include, fields, normalize),
+            response, fetch, sel.entry(), normalize,
+        )
+    
+    def timeline_query(session, sel):
+        return session.select(FeedEntry) \
+                .options(*sel.options(selectinload(FeedEntry.post)))
+    
+    @api.post('/timeline')
+    async def merged_timeline(
+            response: Response,
+            request: s.TimelineRequest,
+            count: int = 20,
+            cursor: Optional[str] = None,
+            include: Optional[str] = None,
+            fields: Optional[str] = None,
+            normalize: bool = False,
+        ) -> list[s.FeedEntry]:
         
-        if subscription is None:
-            raise HTTPException(status_code=404, detail=f'Subscription "{subscription_name}" not found')
+        sel = selection(include, fields, FEED_INCLUDE)
         
-        q_posts = session.select(FeedEntry) \
-                .join(RemotePost) \
-                .where(
-                    FeedEntry.subscription_id == subscription.id
-                )
+        if len(request.subscriptions) + len(request.sources) > MAX_BATCH:
+            raise HTTPException(status_code=400, detail=f'At most {MAX_BATCH} subscriptions and sources can be merged at once')
         
-        if until is not None:
-            q_posts = q_posts \
-                    .where(
-                        FeedEntry.sort_index < cast(until, Numeric)
-                    )
+        subscription_ids = set()
+        for ref in request.subscriptions:
+            subscription_ids.add(await resolve_subscription(ref.source, ref.name))
         
-        q_posts = q_posts \
-                .order_by(FeedEntry.sort_index.desc()) \
-                .limit(count) \
-                .options(
-                    selectinload(FeedEntry.post).selectinload(RemotePost.files),
-                    selectinload(FeedEntry.post).selectinload(RemotePost.tags),
-                    selectinload(FeedEntry.post) \
-                        .selectinload(RemotePost.related) \
-                        .selectinload(Related.remote) \
-                        .selectinload(RemotePost.files),
-                )
+        source_ids = [await resolve_source(name) for name in request.sources]
+        if source_ids:
+            rows = await session.execute(select(Subscription.id).where(Subscription.source_id.in_(source_ids)))
+            subscription_ids.update(rows.scalars())
+        
+        subscription_ids = sorted(subscription_ids)
         
-        posts = await q_posts.all()
+        def fetch(session):
+            return timeline.fetch(session, partial(timeline_query, sel=sel), subscription_ids, count, cursor=cursor)
         
-        return s.models.build(posts)
+        return await coalesced(
+            ('timeline', tuple(subscription_ids), count, cursor, include, fields, normalize),
+            response, fetch, sel.entry(), normalize,
+        )
+    
+    async def export_response(query, keyset, entry, format, chunk, cursor):
+        if format not in export.MEDIA_TYPES:
+            raise HTTPException(status_code=400, detail=f'Unknown export format "{format}"')
+        
+        if cursor is not None:
+            try:
+                keyset.decode(cursor)
+            except InvalidCursor as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        
+        chunk = max(1, min(chunk, 1000))
+        # the chunks use their own sessions
+        await release()
+        chunks = export.export_chunks(hrd, query, keyset, entry, build, chunk=chunk, cursor=cursor)
+        return StreamingResponse(export.encode(chunks, format), media_type=export.MEDIA_TYPES[format])
+    
+    @api.get('/source/{source_name}/export')
+    async def export_source_posts(
+            source_name: str,
+            format: str = 'ndjson',
+            chunk: int = 200,
+            cursor: Optional[str] = None,
+        ):
+        
+        source_id = await resolve_source(source_name)
+        
+        return await export_response(
+            partial(source_posts_query, source_id=source_id),
+            post_keyset,
+            lambda x: FeedEntry(sort_index=x.id, post=x),
+            format, chunk, cursor,
+        )
+    
+    @api.get('/source/{source_name}/subscription/{subscription_name}/export')
+    async def export_subscription_feed(
+            source_name: str,
+            subscription_name: str,
+            format: str = 'ndjson',
+            chunk: int = 200,
+            cursor: Optional[str] = None,
+        ):
+        
+        subscription_id = await resolve_subscription(source_name, subscription_name)
+        
+        return await export_response(
+            partial(feed_query, subscription_id=subscription_id),
+            feed_keyset,
+            lambda x: x,
+            format, chunk, cursor,
+        )
     
     @api.websocket('/source/{source_name}/subscription/{subscription_name}/feed')
     async def subscription_feed(websocket: WebSocket,
             source_name: str,
             subscription_name: str,
             count: int = 20,
-            until: Optional[int] = None):
+            until: Optional[int] = None,
+            cursor: Optional[str] = None,
+            batch: int = 20,
+            live: bool = True):
         
         await websocket.accept()
         
-        source = await session.select(Source) \
-                .where(Source.name == source_name) \
-                .one_or_none()
-        
-        if source is None:
+        source_id = await names.source_id(session, source_name)
+        if source_id is None:
             raise WebSocketException(code=4404, reason=f'Source "{source_name}" not found')
         
-        subscription = await session.select(Subscription) \
-                .where(
-                    Subscription.source_id == source.id,
-                    Subscription.name == subscription_name,
-                ) \
-                .one_or_none()
-        
-        if subscription is None:
+        subscription_id = await names.subscription_id(session, source_id, subscription_name)
+        if subscription_id is None:
             raise WebSocketException(code=4404, reason=f'Subscription "{subscription_name}" not found')
         
+        # the socket can stay open for hours, don't hold on to a connection
+        await release()
+        
+        # every batch uses its own short lived session
+        async def fetch_page(n, cursor, until):
+            async with hrd.session() as batch_session:
+                page = await feed_keyset.fetch(feed_query(batch_session, subscription_id), n, cursor=cursor, until=until)
+                return await build(page.items), page.next_cursor
+        
+        async def fetch_entries(post_ids):
+            async with hrd.session() as batch_session:
+                entries = await feed_query(batch_session, subscription_id) \
+                        .where(FeedEntry.remote_post_id.in_(post_ids)) \
+                        .order_by(FeedEntry.sort_index.desc()) \
+                        .all()
+                
+                key = max((feed_keyset.key(e) for e in entries), default=None)
+                return await build(entries), key
+        
+        # the `n` entries right after `key`, oldest first, from the oldest
+        # entry when there's no key
+        async def fetch_newer(n, key):
+            async with hrd.session() as batch_session:
+                q = feed_query(batch_session, subscription_id)
+                if key is not None:
+                    q = q.where(feed_keyset.predicate(key, backward=True))
+                
+                entries = await q \
+                        .order_by(*feed_keyset.ordering(backward=True)) \
+                        .limit(n) \
+                        .all()
+                
+                if entries:
+                    key = feed_keyset.key(entries[-1])
+                
+                return await build(entries[::-1]), key
+        
+        live_key = None
+        if live:
+            async with hrd.session() as batch_session:
+                newest = (await batch_session.execute(
+                    select(FeedEntry.sort_index, FeedEntry.remote_post_id) \
+                        .where(FeedEntry.subscription_id == subscription_id) \
+                        .order_by(*feed_keyset.ordering()) \
+                        .limit(1)
+                )).first()
+                
+                if newest is not None:
+                    live_key = tuple(newest)
         
-        q_posts = session.select(FeedEntry) \
-                .join(RemotePost) \
-                .where(
-                    FeedEntry.subscription_id == subscription.id
-                ) \
+        if cursor is not None:
+            try:
+                feed_keyset.decode(cursor)
+            except InvalidCursor as e:
+                raise WebSocketException(code=4400, reason=str(e))
         
-        if until is not None:
-            q_posts = q_posts \
-                    .where(
-                        FeedEntry.sort_index < cast(until, Numeric)
-                    ) \
+        feed = FeedSocket(websocket, feed_notifier, subscription_id,
+                fetch_page, fetch_entries, fetch_newer,
+                count=count, batch=batch, cursor=cursor, until=until, live=live, live_key=live_key)
         
-        q_posts = q_posts \
-                .order_by(FeedEntry.sort_index.desc()) \
-                .limit(count) \
-                .options(
-                    selectinload(FeedEntry.post).selectinload(RemotePost.files),
-                    selectinload(FeedEntry.post).selectinload(RemotePost.tags),
-                    selectinload(FeedEntry.post) \
-                        .selectinload(RemotePost.related) \
-                        .selectinload(Related.remote) \
-                        .selectinload(RemotePost.files),
-                )
-        
-        posts = await q_posts.stream()
-        
-        c = 0
-        async for post in posts:
-            c += 1
-            await websocket.send_text(s.models.build(post).json())
-            
-            if c >= count:
-                try:
-                    data = await websocket.receive_text()
-                except WebSocketDisconnect:
-                    break
-                
-                header = s.MessageHeader(**json.loads(data))
-                match header.c:
-                    case 'continue':
-                        c = 0
-                        
-                    case 'stop':
-                        break
+        await feed.serve()
+    
+    
+    @api.get('/tags/top')
+    async def top_tags(
+            count: int = 50,
+            source: Optional[str] = None,
+            category: Optional[TagCategory] = None,
+        ) -> list[s.TagFrequency]:
+        
+        count = max(1, min(count, MAX_BATCH))
+        source_ids = None
+        if source is not None:
+            source_ids = [await resolve_source(source)]
+        
+        rows = await statistics.top_tags(session, count, source_ids, category)
+        return [
+            s.TagFrequency(
+                id=tag.id,
+                source_id=tag.source_id,
+                category=tag.category,
+                tag=tag.tag,
+                post_count=n,
+            )
+            for tag, n in rows
+        ]
     
+    @api.post('/stats/refresh')
+    async def refresh_stats():
+        await statistics.refresh(force=True)
+        return {'refreshed': statistics.refreshed, 'seconds': statistics.refresh_seconds}
     
     @api.get('/search')
     async def search_remote(
+            response: Response,
             query: str,
             count: int = 20,
-            until: Optional[int] = None
+            until: Optional[int] = None,
+            cursor: Optional[str] = None,
+            sort: str = 'recent',
+            offset: int = 0,
+            include: Optional[str] = None,
+            fields: Optional[str] = None,
+            normalize: bool = False,
         ) -> list[s.FeedEntry]:
         
-        q_posts = session.select(RemotePost) \
-                .join(remote_post_tag) \
-                .join(RemoteTag) \
-                .where(
-                    RemoteTag.tag == query
-                )
+        sel = selection(include, fields, SEARCH_INCLUDE)
         
-        if until is not None:
-            q_posts = q_posts \
-                    .where(
-                        RemotePost.id < cast(until, Numeric)
-                    ) \
+        try:
+            plan = await search_engine.plan(session, Query.parse(query))
+        except InvalidQuery as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
-        q_posts = q_posts \
-                .order_by(RemotePost.id.desc()) \
-                .limit(count) \
-                .options(
-                    selectinload(RemotePost.files),
-                    selectinload(RemotePost.tags),
-                    selectinload(RemotePost.source),
-                    selectinload(RemotePost.related) \
-                        .selectinload(Related.remote) \
-                        .selectinload(RemotePost.files),
-                )
+        if plan is None:
+            return await respond([], response, sel.entry(), normalize)
         
-        posts = await q_posts.all()
+        where, rank = plan
         
-        return s.models.build([FeedEntry(sort_index=x.id, post=x) for x in posts])
+        q_posts = session.select(RemotePost) \
+                .where(*where) \
+                .options(*sel.options())
+        
+        match sort:
+            case 'recent':
+                posts = await paginate(post_keyset, response, q_posts, count, cursor, until)
+                return await respond([FeedEntry(sort_index=x.id, post=x) for x in posts], response, sel.entry(), normalize)
+            
+            case 'rank' if rank is not None:
+                posts = await q_posts \
+                        .order_by(rank.desc(), RemotePost.id.desc()) \
+                        .offset(offset) \
+                        .limit(count) \
+                        .all()
+                
+                return await respond([FeedEntry(sort_index=offset + i, post=x) for i, x in enumerate(posts)], response, sel.entry(), normalize)
+            
+            case _:
+                raise HTTPException(status_code=400, detail=f'Cannot sort by "{sort}"')
     
     return api
 
 
+# the app is configured from the environment, HOORDU_API_CONFIG_FILES
+# lists the files plugin configs are read from, separated like PATH, and
+# HOORDU_API_POOL_SIZE, HOORDU_API_MAX_OVERFLOW and HOORDU_API_POOL_TIMEOUT
+# set the database pool's limits
+def _env(name, convert):
+    value = os.environ.get(name)
+    return convert(value) if value else None
+
 hrd = hoordu.hoordu(hoordu.load_config())
-api = create_api(hrd)
+api = create_api(hrd,
+    pool_size=_env('HOORDU_API_POOL_SIZE', int),
+    max_overflow=_env('HOORDU_API_MAX_OVERFLOW', int),
+    pool_timeout=_env('HOORDU_API_POOL_TIMEOUT', float),
+    config_files=_env('HOORDU_API_CONFIG_FILES', lambda v: [f for f in v.split(os.pathsep) if f]) or ())
 
 app = FastAPI()
-app.mount('/data', StaticFiles(directory='data'), name='data')
+app.add_middleware(MetricsMiddleware, server_timing=True)
+app.mount('/data', MediaFiles('data'), name='data')
+
+@app.get('/metrics', include_in_schema=False)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type='text/plain; version=0.0.4')
 
 app.include_router(
     api,
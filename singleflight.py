@@ -0,0 +1,51 @@
+import asyncio
+
+
+class _Flight:
+    __slots__ = ('task', 'waiters')
+    
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+# runs concurrent calls with the same key once, every caller gets the
+# same result or exception
+#
+# the call runs in its own task so a caller going away doesn't cancel it
+# for the others, it's only cancelled once every caller is gone
+class SingleFlight:
+    def __init__(self):
+        # key -> _Flight
+        self._flights = {}
+        
+        self.calls = 0
+        self.shared = 0
+    
+    def _done(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+    
+    async def do(self, key, func):
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight(asyncio.ensure_future(func()))
+            flight.task.add_done_callback(lambda _: self._done(key, flight))
+            self.calls += 1
+        else:
+            self.shared += 1
+        
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                # later callers start over instead of joining a cancelled call
+                self._done(key, flight)
+                flight.task.cancel()
+            
+            raise
+        
+        finally:
+            flight.waiters -= 1
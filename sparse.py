@@ -0,0 +1,140 @@
+from functools import lru_cache
+
+from hoordu.models import RemotePost, Related
+from sqlalchemy.orm import load_only, selectinload
+
+
+class InvalidFields(ValueError):
+    pass
+
+
+# post columns a client can ask for, by output name
+POST_COLUMNS = {
+    'original_id': 'original_id',
+    'url': 'url',
+    'title': 'title',
+    'comment': 'comment',
+    'post_time': 'post_time',
+    'type': 'type',
+    'metadata': 'metadata_',
+}
+# always loaded, the keysets and the responses need them
+POST_KEYS = ('id', 'source_id')
+
+# relationships a client can include and what can be included under them
+# related posts can't include their own related posts so the graph stays bounded
+POST_INCLUDES = {
+    'source': {},
+    'files': {},
+    'tags': {},
+    'related': {
+        'source': {},
+        'files': {},
+        'tags': {},
+    },
+}
+
+
+# which columns and relationships of a post get loaded and serialized
+# columns is None when every column is wanted, relations maps a relationship
+# to the selection for the posts under it, or None for other objects
+class Selection:
+    def __init__(self, columns, relations, requested=True):
+        self.columns = columns
+        self.relations = relations
+        # False for a route's default selection
+        self.requested = requested
+        # encoder plan -> trimmed fields
+        self._fields = {}
+        self._entry = None
+    
+    def entry(self):
+        # the same selection for posts wrapped in a FeedEntry
+        if self._entry is None:
+            self._entry = Selection(None, {'post': self}, self.requested)
+        
+        return self._entry
+    
+    def _keep(self, plan, attr):
+        if attr in plan.relations:
+            return attr in self.relations
+        
+        return self.columns is None or attr in self.columns
+    
+    def fields(self, plan):
+        fields = self._fields.get(plan)
+        if fields is None:
+            fields = self._fields[plan] = tuple(f for f in plan.fields if self._keep(plan, f[0]))
+        
+        return fields
+    
+    def options(self, base=None):
+        def load(attr):
+            return selectinload(attr) if base is None else base.selectinload(attr)
+        
+        opts = [] if base is None else [base]
+        if self.columns is not None:
+            columns = [getattr(RemotePost, c) for c in sorted(self.columns)]
+            opts.append(load_only(*columns) if base is None else base.load_only(*columns))
+        
+        for name, sub in self.relations.items():
+            loader = load(getattr(RemotePost, name))
+            if name == 'related':
+                opts.extend(sub.options(loader.selectinload(Related.remote)))
+            else:
+                opts.append(loader)
+        
+        return opts
+
+
+def _split(value):
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+def _relations(paths, allowed=POST_INCLUDES):
+    tree = {}
+    for path in paths:
+        node, level = tree, allowed
+        for name in path.split('.'):
+            if name not in level:
+                raise InvalidFields(f'Cannot include "{path}"')
+            
+            node = node.setdefault(name, {})
+            level = level[name]
+    
+    return tree
+
+def _selection(tree, columns, requested):
+    relations = {}
+    for name, sub in tree.items():
+        if name == 'related':
+            relations[name] = _selection(sub, columns, requested)
+        else:
+            # anything else is emitted as loaded
+            relations[name] = None
+    
+    return Selection(columns, relations, requested)
+
+# include is a comma separated list of relationship paths, e.g.
+# "files,related.files", and fields a comma separated list of post columns
+# either one falls back to the route's default when not given
+@lru_cache(maxsize=256)
+def parse(include, fields, default):
+    requested = include is not None or fields is not None
+    
+    tree = _relations(_split(include if include is not None else default))
+    
+    columns = None
+    if fields is not None:
+        columns = set(POST_KEYS)
+        for name in _split(fields):
+            if name in POST_KEYS:
+                continue
+            
+            if name not in POST_COLUMNS:
+                raise InvalidFields(f'Unknown field "{name}"')
+            
+            columns.add(POST_COLUMNS[name])
+        
+        columns = frozenset(columns)
+    
+    return _selection(tree, columns, requested)
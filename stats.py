@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+import hoordu
+from hoordu.models import Base, FeedEntry, RemotePost, RemoteTag, Subscription, remote_post_tag
+from sqlalchemy import Column, Integer, Float, Text, DateTime, ForeignKey, Index, delete, func, insert, select
+
+
+log = logging.getLogger(__name__)
+
+# advisory lock held while the summary tables are rebuilt
+REFRESH_LOCK = 0x68726473746174
+
+
+class SourceStats(Base):
+    __tablename__ = 'source_stats'
+    
+    source_id = Column(Integer, ForeignKey('source.id', ondelete='CASCADE'), primary_key=True)
+    post_count = Column(Integer, nullable=False)
+
+
+class SubscriptionStats(Base):
+    __tablename__ = 'subscription_stats'
+    
+    subscription_id = Column(Integer, ForeignKey('subscription.id', ondelete='CASCADE'), primary_key=True)
+    post_count = Column(Integer, nullable=False)
+
+
+class GalleryStats(Base):
+    __tablename__ = 'gallery_stats'
+    
+    name = Column(Text, primary_key=True)
+    post_count = Column(Integer, nullable=False)
+
+
+class TagStats(Base):
+    __tablename__ = 'tag_stats'
+    
+    tag_id = Column(Integer, ForeignKey('remote_tag.id', ondelete='CASCADE'), primary_key=True)
+    source_id = Column(Integer, nullable=False)
+    post_count = Column(Integer, nullable=False)
+    
+    __table_args__ = (
+        Index('tag_stats_top_idx', post_count.desc()),
+        Index('tag_stats_source_top_idx', source_id, post_count.desc()),
+    )
+
+
+class StatsState(Base):
+    __tablename__ = 'stats_state'
+    
+    id = Column(Integer, primary_key=True)
+    refreshed = Column(DateTime(timezone=True), nullable=False)
+    refresh_seconds = Column(Float, nullable=False)
+
+
+SUMMARY_TABLES = [SourceStats.__table__, SubscriptionStats.__table__, GalleryStats.__table__, TagStats.__table__]
+TABLES = [*SUMMARY_TABLES, StatsState.__table__]
+
+
+# post counts per source, subscription and gallery and the number of
+# posts with each tag, recomputed every `refresh_interval` seconds into
+# summary tables
+#
+# a refresh replaces every table in one transaction, readers keep seeing
+# the previous numbers until it commits
+#
+# the tables are shared by every worker, a refresh holds an advisory lock
+# and is skipped when another worker did one less than `refresh_interval`
+# seconds ago, the time of the last one is kept in the database
+class Statistics:
+    def __init__(self, hrd: hoordu.hoordu, gallery, refresh_interval=900):
+        self.hrd = hrd
+        self.gallery = gallery
+        self.refresh_interval = refresh_interval
+        
+        self.refreshed = None
+        self.refresh_seconds = None
+        self._task = None
+        self._created = False
+        self._lock = asyncio.Lock()
+    
+    @property
+    def ready(self):
+        return self.refreshed is not None
+    
+    async def _rebuild(self, conn):
+        for table in SUMMARY_TABLES:
+            await conn.execute(delete(table))
+        
+        await conn.execute(
+            insert(SourceStats).from_select(
+                ['source_id', 'post_count'],
+                select(RemotePost.source_id, func.count()) \
+                    .group_by(RemotePost.source_id)
+            )
+        )
+        await conn.execute(
+            insert(SubscriptionStats).from_select(
+                ['subscription_id', 'post_count'],
+                select(FeedEntry.subscription_id, func.count()) \
+                    .group_by(FeedEntry.subscription_id)
+            )
+        )
+        await conn.execute(
+            insert(GalleryStats).from_select(
+                ['name', 'post_count'],
+                select(self.gallery.name, func.count()) \
+                    .where(self.gallery.name.is_not(None)) \
+                    .group_by(self.gallery.name)
+            )
+        )
+        await conn.execute(
+            insert(TagStats).from_select(
+                ['tag_id', 'source_id', 'post_count'],
+                select(RemoteTag.id, RemoteTag.source_id, func.count()) \
+                    .join(remote_post_tag, remote_post_tag.c.tag_id == RemoteTag.id) \
+                    .group_by(RemoteTag.id, RemoteTag.source_id)
+            )
+        )
+    
+    # `force` refreshes even when the tables are fresh
+    async def refresh(self, force=False):
+        async with self._lock:
+            async with self.hrd.engine.begin() as conn:
+                # the other workers wait here and then find the tables fresh
+                await conn.execute(select(func.pg_advisory_xact_lock(REFRESH_LOCK)))
+                if not self._created:
+                    await conn.run_sync(Base.metadata.create_all, tables=TABLES)
+                    self._created = True
+                
+                state = (await conn.execute(
+                    select(StatsState.refreshed, StatsState.refresh_seconds, func.now())
+                )).first()
+                
+                stale = state is None or state[2] - state[0] >= timedelta(seconds=self.refresh_interval)
+                if force or stale:
+                    start = time.perf_counter()
+                    await self._rebuild(conn)
+                    seconds = time.perf_counter() - start
+                    
+                    await conn.execute(delete(StatsState))
+                    await conn.execute(insert(StatsState).values(id=1, refreshed=func.now(), refresh_seconds=seconds))
+                    state = (await conn.execute(
+                        select(StatsState.refreshed, StatsState.refresh_seconds, func.now())
+                    )).first()
+            
+            self.refreshed, self.refresh_seconds, _ = state
+    
+    async def _run(self):
+        while True:
+            delay = self.refresh_interval
+            try:
+                await self.refresh()
+                
+                # wake up when the last refresh, by any worker, goes stale
+                age = datetime.now(timezone.utc) - self.refreshed
+                delay = max(1, self.refresh_interval - age.total_seconds())
+            
+            except Exception:
+                log.exception('failed to refresh the statistics')
+            
+            await asyncio.sleep(delay)
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+    
+    async def source(self, session, source_id):
+        post_count = (await session.execute(
+            select(SourceStats.post_count).where(SourceStats.source_id == source_id)
+        )).scalar_one_or_none()
+        return post_count or 0
+    
+    # (subscription_id, name, post_count) of every subscription of the source
+    async def subscriptions(self, session, source_id):
+        rows = await session.execute(
+            select(Subscription.id, Subscription.name, func.coalesce(SubscriptionStats.post_count, 0)) \
+                .outerjoin(SubscriptionStats, SubscriptionStats.subscription_id == Subscription.id) \
+                .where(Subscription.source_id == source_id) \
+                .order_by(Subscription.name)
+        )
+        return rows.all()
+    
+    async def gallery_posts(self, session, name):
+        post_count = (await session.execute(
+            select(GalleryStats.post_count).where(GalleryStats.name == name)
+        )).scalar_one_or_none()
+        return post_count or 0
+    
+    async def tag_counts(self, session, tag_ids):
+        rows = await session.execute(
+            select(TagStats.tag_id, TagStats.post_count) \
+                .where(TagStats.tag_id.in_(tag_ids))
+        )
+        counts = dict(rows.all())
+        # tags made since the last refresh have few posts, if any
+        return {id: counts.get(id, 0) for id in tag_ids}
+    
+    # (RemoteTag, post_count) of the most used tags
+    async def top_tags(self, session, count, source_ids=None, category=None):
+        q = select(RemoteTag, TagStats.post_count) \
+                .join(TagStats, TagStats.tag_id == RemoteTag.id)
+        
+        if source_ids is not None:
+            q = q.where(TagStats.source_id.in_(source_ids))
+        
+        if category is not None:
+            q = q.where(RemoteTag.category == category)
+        
+        rows = await session.execute(
+            q \
+                .order_by(TagStats.post_count.desc(), RemoteTag.id) \
+                .limit(count)
+        )
+        return rows.all()
@@ -0,0 +1,6 @@
+import sys
+import pathlib
+
+root = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(root / 'bench'))
+sys.path.insert(0, str(root))
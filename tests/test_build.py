@@ -0,0 +1,157 @@
+import random
+
+import hoordu.models as m
+import orjson
+import pytest
+
+import fastjson
+import schemas as s
+from build import LegacyModels, make_post, register_converters
+from encode import register_encoders
+
+
+@pytest.fixture(scope='module')
+def models():
+    register_converters(s.models)
+    return s.models
+
+@pytest.fixture(scope='module')
+def legacy():
+    legacy = LegacyModels()
+    legacy.models = s.models.models
+    register_converters(legacy)
+    return legacy
+
+
+def source(id):
+    return m.Source(id=id, name=f's{id}', config=None, metadata_=None)
+
+def plugin(id):
+    return m.Plugin(id=id, name=f'p{id}', source_id=id)
+
+def dump(values):
+    return [v.model_dump() for v in values]
+
+
+def test_memo_not_reused_under_an_ancestor_it_contains(models, legacy):
+    p0, p2 = plugin(0), plugin(2)
+    s0, s1 = source(0), source(1)
+    p0.source = s0
+    p2.source = s1
+    s0.preferred_plugin = p2
+    s1.preferred_plugin = p0
+    
+    built = dump(models.build([p2, s1, p2]))
+    
+    assert built == dump(legacy.build([p2, s1, p2]))
+    # p2 is on the path, so s0 can't hold it again
+    assert built[2]['source']['preferred_plugin']['source']['preferred_plugin'] is None
+
+
+def test_matches_legacy_on_random_source_plugin_graphs(models, legacy):
+    rng = random.Random(0)
+    for _ in range(3000):
+        n = rng.randint(1, 4)
+        sources = [source(i) for i in range(n)]
+        plugins = [plugin(i) for i in range(n)]
+        for x in sources:
+            if rng.random() < 0.8:
+                x.preferred_plugin = rng.choice(plugins)
+        for x in plugins:
+            if rng.random() < 0.8:
+                x.source = rng.choice(sources)
+        
+        objs = [rng.choice(sources + plugins) for _ in range(rng.randint(1, 5))]
+        assert dump(models.build(objs)) == dump(legacy.build(objs))
+
+
+def test_repeat_along_a_path_is_cut(models):
+    s0, p0 = source(0), plugin(0)
+    s0.preferred_plugin = p0
+    p0.source = s0
+    
+    built = models.build(s0).model_dump()
+    
+    assert built['preferred_plugin']['id'] == 0
+    assert built['preferred_plugin']['source'] is None
+
+
+def test_repeated_siblings_are_kept(models, legacy):
+    s0, p0 = source(0), plugin(0)
+    s0.preferred_plugin = p0
+    tag = m.RemoteTag(id=1, source_id=0, source=source(1), category=next(iter(m.TagCategory)), tag='t')
+    posts = [make_post(s0, [tag, tag], id, 1) for id in (1, 2)]
+    
+    built = dump(models.build(posts))
+    
+    assert built == dump(legacy.build(posts))
+    for post in built:
+        assert post['source']['preferred_plugin']['id'] == 0
+        assert [t['id'] for t in post['tags']] == [1, 1]
+        assert all(t['source']['id'] == 1 for t in post['tags'])
+
+
+def test_source_plugin_cycle(models, legacy):
+    s0, s1 = source(0), source(1)
+    p0, p1 = plugin(0), plugin(1)
+    s0.preferred_plugin = p1
+    p1.source = s1
+    s1.preferred_plugin = p0
+    p0.source = s0
+    
+    built = dump(models.build([s0, p0, s1]))
+    
+    assert built == dump(legacy.build([s0, p0, s1]))
+    assert built[0]['preferred_plugin']['source']['preferred_plugin']['source'] is None
+    assert built[1]['source']['preferred_plugin']['source']['preferred_plugin'] is None
+
+
+def test_post_related_cycle(models):
+    s0 = source(0)
+    a, b = make_post(s0, [], 1, 1), make_post(s0, [], 2, 1)
+    a.related = [m.Related(id=1, remote=b)]
+    b.related = [m.Related(id=2, remote=a), m.Related(id=3, remote=b)]
+    
+    built = models.build(a).model_dump()
+    
+    related = built['related']
+    assert [p['id'] for p in related] == [2]
+    # a and b are both on the path
+    assert related[0]['related'] == []
+    # related posts are built on their own, only posts are cut
+    assert related[0]['source']['id'] == 0
+
+
+def test_same_object_at_the_top_level_and_nested(models, legacy):
+    s0, p0 = source(0), plugin(0)
+    s0.preferred_plugin = p0
+    p0.source = s0
+    
+    objs = [s0, p0, s0, p0]
+    built = dump(models.build(objs))
+    
+    assert built == dump(legacy.build(objs))
+    assert built[0] == built[2]
+    assert built[1] == built[3]
+    assert built[0]['preferred_plugin']['source'] is None
+    assert built[1]['source']['preferred_plugin'] is None
+
+
+def test_encoder_matches_models_on_cycles(models):
+    encoder = fastjson.Encoder(models)
+    register_encoders(encoder)
+    
+    s0, s1 = source(0), source(1)
+    p0, p1 = plugin(0), plugin(1)
+    s0.preferred_plugin = p1
+    p1.source = s1
+    s1.preferred_plugin = p0
+    p0.source = s0
+    a, b = make_post(s0, [], 1, 1), make_post(s1, [], 2, 1)
+    a.related = [m.Related(id=1, remote=b)]
+    b.related = [m.Related(id=2, remote=a)]
+    
+    objs = [a, b, s0, p0, a]
+    expected = [v.model_dump(mode='json', by_alias=False, exclude_unset=True) for v in models.build(objs)]
+    
+    assert orjson.loads(encoder.encode(objs)) == expected
@@ -0,0 +1,31 @@
+from cache import ResponseCache, MAX_PAYLOAD, encode_invalidation, decode_invalidation
+
+
+def test_invalidations_survive_the_round_trip():
+    tags = ['posts', ('post', 1), ('subscriptions', 'a:b')]
+    payloads = encode_invalidation(tags)
+    
+    assert len(payloads) == 1
+    assert decode_invalidation(payloads[0]) == tags
+    assert decode_invalidation(encode_invalidation()[0]) is None
+
+
+def test_long_invalidations_are_split():
+    tags = [('post', id) for id in range(10000)]
+    payloads = encode_invalidation(tags)
+    
+    assert len(payloads) > 1
+    assert all(len(p) <= MAX_PAYLOAD for p in payloads)
+    assert [t for p in payloads for t in decode_invalidation(p)] == tags
+
+
+def test_a_received_invalidation_drops_the_tagged_entries():
+    cache = ResponseCache()
+    cache.put('a', b'a', [('post', 1)])
+    cache.put('b', b'b', [('post', 2)])
+    
+    for payload in encode_invalidation([('post', 1)]):
+        cache.invalidate(*decode_invalidation(payload))
+    
+    assert cache.get('a') is None
+    assert cache.get('b') is not None
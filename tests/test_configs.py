@@ -0,0 +1,49 @@
+import asyncio
+
+from configs import PluginConfigCache
+
+
+class Hoordu:
+    def __init__(self):
+        self.setups = 0
+        self.release = asyncio.Event()
+    
+    async def setup_plugin(self, name, parameters=None):
+        self.setups += 1
+        setup = self.setups
+        await self.release.wait()
+        return True, setup
+
+
+def test_invalidate_drops_the_pending_setup():
+    async def run():
+        hrd = Hoordu()
+        cache = PluginConfigCache(hrd, lambda form: form)
+        
+        first = asyncio.ensure_future(cache.get('p'))
+        await asyncio.sleep(0)
+        cache.invalidate('p')
+        second = asyncio.ensure_future(cache.get('p'))
+        await asyncio.sleep(0)
+        
+        hrd.release.set()
+        assert (await first).form == 1
+        assert (await second).form == 2
+        # only the setup started after the invalidation is kept
+        assert (await cache.get('p')).form == 2
+        assert hrd.setups == 2
+    
+    asyncio.run(run())
+
+
+def test_entries_expire():
+    async def run():
+        hrd = Hoordu()
+        hrd.release.set()
+        cache = PluginConfigCache(hrd, lambda form: form, ttl=0)
+        
+        assert (await cache.get('p')).form == 1
+        await asyncio.sleep(0.01)
+        assert (await cache.get('p')).form == 2
+    
+    asyncio.run(run())
@@ -0,0 +1,90 @@
+# checks that the keyset predicates used by the paginated endpoints are
+# planned as index conditions on the keyset columns, against the database
+# in HOORDU_TEST_DATABASE, e.g. postgresql+asyncpg://user@localhost/hoordu
+#
+# the database should hold a realistic amount of data, bench/seed.py can
+# fill one, on near empty tables a sequential scan is the better plan
+
+import asyncio
+import json
+import os
+from decimal import Decimal
+
+import pytest
+from hoordu.models import FeedEntry, RemotePost
+from sqlalchemy import Column, Integer, MetaData, Table, Text, select, text
+from sqlalchemy.dialects import postgresql
+
+from pagination import Keyset
+
+
+DATABASE = os.environ.get('HOORDU_TEST_DATABASE')
+
+pytestmark = pytest.mark.skipif(DATABASE is None, reason='HOORDU_TEST_DATABASE is not set')
+
+# only the columns the query needs, the model lives in server.py
+gallery = Table('gallery', MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('name', Text),
+)
+
+CASES = {
+    'source posts': (
+        Keyset(RemotePost.id),
+        select(RemotePost).where(RemotePost.source_id == 1),
+        (1000000,),
+    ),
+    'subscription feed': (
+        Keyset(FeedEntry.sort_index, FeedEntry.remote_post_id),
+        select(FeedEntry).where(FeedEntry.subscription_id == 1),
+        (Decimal(1000000), 1000000),
+    ),
+    'gallery': (
+        Keyset(gallery.c.id),
+        select(gallery).where(gallery.c.name == 'bench'),
+        (1000000,),
+    ),
+}
+
+
+def compile(q):
+    return str(q.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+
+def index_conds(node):
+    if 'Index Cond' in node:
+        yield node['Index Cond']
+    
+    for child in node.get('Plans', ()):
+        yield from index_conds(child)
+
+async def explain(q):
+    # needs greenlet, only imported when there's a database to talk to
+    from sqlalchemy.ext.asyncio import create_async_engine
+    
+    engine = create_async_engine(DATABASE)
+    try:
+        async with engine.connect() as conn:
+            rows = await conn.execute(text('EXPLAIN (FORMAT JSON) ' + compile(q)))
+            plan = rows.scalar()
+    
+    finally:
+        await engine.dispose()
+    
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    
+    return plan[0]['Plan']
+
+
+@pytest.mark.parametrize('backward', [False, True], ids=['forward', 'backward'])
+@pytest.mark.parametrize('name', CASES)
+def test_keyset_is_an_index_cond(name, backward):
+    keyset, q, key = CASES[name]
+    paged, _ = keyset.apply(q, 20, cursor=keyset.encode(key, backward=backward))
+    
+    plan = asyncio.run(explain(paged))
+    
+    conds = list(index_conds(plan))
+    columns = [c.name for c in keyset.columns]
+    assert any(all(c in cond for c in columns) for cond in conds), \
+            f'no index condition on {columns}:\n{compile(paged)}\n{json.dumps(plan, indent=2)}'
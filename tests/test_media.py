@@ -0,0 +1,73 @@
+import asyncio
+import hashlib
+
+import pytest
+
+from media import MediaFiles, IMMUTABLE, REVALIDATE
+
+
+async def get(app, path, query=b''):
+    response = {}
+    
+    async def receive():
+        return {'type': 'http.disconnect'}
+    
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = {k.decode(): v.decode() for k, v in message['headers']}
+    
+    scope = {
+        'type': 'http',
+        'method': 'GET',
+        'path': path,
+        'root_path': '',
+        'query_string': query,
+        'headers': [],
+    }
+    await app(scope, receive, send)
+    return response
+
+
+def write(tmp_path, size):
+    content = bytes(range(256)) * (size // 256 + 1)
+    (tmp_path / 'file.bin').write_bytes(content)
+    return hashlib.md5(content).hexdigest()
+
+
+def test_small_files_are_checked_right_away(tmp_path):
+    digest = write(tmp_path, 10)
+    app = MediaFiles(tmp_path)
+    
+    async def run():
+        response = await get(app, '/file.bin', f'v={digest}'.encode())
+        assert response['headers']['cache-control'] == IMMUTABLE
+        assert response['headers']['etag'] == f'"{digest}"'
+        
+        response = await get(app, '/file.bin', b'v=0123456789abcdef')
+        assert response['headers']['cache-control'] == REVALIDATE
+        assert response['headers']['etag'] != '"0123456789abcdef"'
+    
+    asyncio.run(run())
+
+
+def test_large_files_are_hashed_in_the_background(tmp_path):
+    digest = write(tmp_path, 1024 * 1024)
+    app = MediaFiles(tmp_path)
+    
+    async def run():
+        # not hashed yet, served like an unversioned url
+        response = await get(app, '/file.bin', f'v={digest}'.encode())
+        assert response['headers']['cache-control'] == REVALIDATE
+        
+        while app._hashing:
+            await asyncio.sleep(0.01)
+        
+        response = await get(app, '/file.bin', f'v={digest}'.encode())
+        assert response['headers']['cache-control'] == IMMUTABLE
+        assert response['headers']['etag'] == f'"{digest}"'
+        
+        response = await get(app, '/file.bin', b'v=0123456789abcdef')
+        assert response['headers']['cache-control'] == REVALIDATE
+    
+    asyncio.run(run())
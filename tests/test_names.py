@@ -0,0 +1,42 @@
+import asyncio
+
+from names import NameResolver
+
+
+class Result:
+    def __init__(self, value):
+        self.value = value
+    
+    def scalar_one_or_none(self):
+        return self.value
+
+
+class Session:
+    def __init__(self):
+        self.queries = 0
+    
+    async def execute(self, q):
+        self.queries += 1
+        return Result(self.queries)
+
+
+def test_evicts_the_least_recently_used():
+    names = NameResolver(maxsize=2)
+    session = Session()
+    
+    async def run():
+        await names.source_id(session, 'a')
+        await names.source_id(session, 'b')
+        # a is used again, b is the one dropped for c
+        await names.source_id(session, 'a')
+        await names.source_id(session, 'c')
+        
+        queries = session.queries
+        await names.source_id(session, 'a')
+        await names.source_id(session, 'c')
+        assert session.queries == queries
+        
+        await names.source_id(session, 'b')
+        assert session.queries == queries + 1
+    
+    asyncio.run(run())
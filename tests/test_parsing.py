@@ -0,0 +1,41 @@
+import asyncio
+
+from parsing import UrlParser, normalize_url
+
+
+class Hoordu:
+    def __init__(self):
+        self.parses = 0
+        self.release = asyncio.Event()
+    
+    async def parse_url(self, url):
+        self.parses += 1
+        parse = self.parses
+        await self.release.wait()
+        return parse
+
+
+def test_normalize_url():
+    assert normalize_url(' HTTPS://Example.com:443') == 'https://example.com/'
+    assert normalize_url('http://example.com:8080/a?b') == 'http://example.com:8080/a?b'
+
+
+def test_clear_drops_the_pending_parse():
+    async def run():
+        hrd = Hoordu()
+        parser = UrlParser(hrd, lambda result: result)
+        
+        first = asyncio.ensure_future(parser.parse('https://example.com/1'))
+        await asyncio.sleep(0)
+        parser.clear()
+        second = asyncio.ensure_future(parser.parse('https://example.com/1'))
+        await asyncio.sleep(0)
+        
+        hrd.release.set()
+        assert await first == 1
+        assert await second == 2
+        # only the parse started after the clear is kept
+        assert await parser.parse('https://example.com/1') == 2
+        assert hrd.parses == 2
+    
+    asyncio.run(run())
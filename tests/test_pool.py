@@ -0,0 +1,18 @@
+import sqlalchemy as sa
+
+import pool
+
+
+def test_configure_keeps_the_limits_across_dispose():
+    engine = sa.create_engine('sqlite://', poolclass=sa.pool.QueuePool, pool_size=3, max_overflow=4, pool_pre_ping=True)
+    pool.configure(engine, size=7, timeout=2)
+    
+    for _ in range(2):
+        p = engine.pool
+        assert type(p).__name__ == 'TimedQueuePool'
+        assert (p.size(), p.max_overflow, p.timeout()) == (7, 4, 2)
+        
+        with engine.connect() as conn:
+            assert conn.execute(sa.text('SELECT 1')).scalar() == 1
+        
+        engine.dispose()
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from sampling import RandomSampler, _permute
+
+
+@pytest.mark.parametrize('n', [1, 2, 3, 7, 64, 100, 1000, 4097])
+@pytest.mark.parametrize('seed', [0, 1, 12345])
+def test_permute_is_a_bijection(n, seed):
+    assert sorted(_permute(seed, i, n) for i in range(n)) == list(range(n))
+
+
+def test_permute_depends_on_the_seed():
+    assert [_permute(0, i, 1000) for i in range(1000)] != [_permute(1, i, 1000) for i in range(1000)]
+
+
+class Rows:
+    def __init__(self, ids):
+        self.ids = ids
+    
+    def scalars(self):
+        return iter(self.ids)
+
+
+class Session:
+    def __init__(self, ids):
+        self.ids = ids
+    
+    async def execute(self, q):
+        wanted = q.whereclause.right.value
+        return Rows([id for id in wanted if id in self.ids])
+
+
+def test_sparse_idrange_pages_until_the_end():
+    ids = {10, 500, 1009}
+    sampler = RandomSampler(None)
+    sampler.id_range = (10, 1009)
+    sampler._id_range_time = float('inf')
+    session = Session(ids)
+    
+    async def run():
+        seen = []
+        pages = 0
+        until = None
+        while True:
+            page, until = await sampler.sample(session, 5, 42, until=until, method='idrange')
+            seen.extend(id for _, id in page)
+            pages += 1
+            if until is None:
+                return seen, pages
+    
+    seen, pages = asyncio.run(run())
+    assert sorted(seen) == sorted(ids)
+    # most pages came back empty without ending the walk
+    assert pages > len(ids)
+
+
+class PositionSession:
+    async def execute(self, q):
+        positions = q.whereclause.right.value
+        # the table holds post 1000 + p at position p
+        return [(p, 1000 + p) for p in positions]
+
+
+def test_each_seed_has_its_own_shuffle_order():
+    sampler = RandomSampler(None)
+    sampler.size = 100
+    session = PositionSession()
+    
+    async def walk(seed):
+        order = []
+        until = None
+        while True:
+            page, until = await sampler.sample(session, 7, seed, until=until, method='shuffle')
+            order.extend(id for _, id in page)
+            if until is None:
+                return order
+    
+    a, b = asyncio.run(walk(1)), asyncio.run(walk(2))
+    assert sorted(a) == sorted(b) == list(range(1000, 1100))
+    # not just the same cycle rotated
+    rotations = [a[i:] + a[:i] for i in range(len(a))]
+    assert b not in rotations
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+from hoordu.models import TagCategory
+
+from search import Query, InvalidQuery, SearchEngine
+
+
+def refs(term):
+    return [(r.tag, r.category) for r in term.refs]
+
+
+def test_operators():
+    q = Query.parse('a|b -c artist:d source:s text:"some words"')
+    
+    assert [refs(t) for t in q.terms] == [
+        [('a', None), ('b', None)],
+        [('c', None)],
+        [('d', TagCategory.artist)],
+    ]
+    assert [t.exclude for t in q.terms] == [False, True, False]
+    assert [t.literal for t in q.terms] == ['a|b', '-c', 'artist:d']
+    assert q.sources == ['s']
+    assert q.text == ['some words']
+
+
+def test_apostrophes_are_part_of_the_tag():
+    q = Query.parse("girls'_frontline don't")
+    
+    assert [refs(t) for t in q.terms] == [[("girls'_frontline", None)], [("don't", None)]]
+    assert [t.literal for t in q.terms] == [None, None]
+
+
+def test_quoted_terms_are_exact_tags():
+    q = Query.parse('"a|b" -\'x:y\' artist:"re:zero" "say \\"hi\\""')
+    
+    assert [refs(t) for t in q.terms] == [
+        [('a|b', None)],
+        [('x:y', None)],
+        [('re:zero', TagCategory.artist)],
+        [('say "hi"', None)],
+    ]
+    assert [t.exclude for t in q.terms] == [False, True, False, False]
+    assert [t.literal for t in q.terms] == [None, None, None, None]
+
+
+def test_unbalanced_quotes_are_kept():
+    q = Query.parse('"abc \'d')
+    
+    assert [refs(t) for t in q.terms] == [[('"abc', None)], [("'d", None)]]
+
+
+def test_literals_are_looked_up():
+    q = Query.parse('-x')
+    
+    assert {r.tag for r in q.tags()} == {'x', '-x'}
+
+
+def test_needs_a_tag_or_text():
+    with pytest.raises(InvalidQuery):
+        Query.parse('source:s')
+    
+    with pytest.raises(InvalidQuery):
+        Query.parse('-"x"')
+
+
+def test_exclusions_alone_are_rejected_once_resolved():
+    engine = SearchEngine()
+    
+    async def resolve_tags(session, refs, source_ids):
+        # only "x" exists, "-x" is read as excluding it
+        return [(1, 'x', None)]
+    
+    async def frequencies(session, ids):
+        return {id: 1 for id in ids}
+    
+    engine._resolve_tags = resolve_tags
+    engine.frequencies = frequencies
+    
+    with pytest.raises(InvalidQuery):
+        asyncio.run(engine.plan(None, Query.parse('-x')))
+    
+    where, rank = asyncio.run(engine.plan(None, Query.parse('x -x')))
+    assert rank is None
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_followers_get_the_leaders_exception():
+    async def run():
+        flights = SingleFlight()
+        release = asyncio.Event()
+        
+        async def fail():
+            await release.wait()
+            raise ValueError('boom')
+        
+        leader = asyncio.ensure_future(flights.do('k', fail))
+        follower = asyncio.ensure_future(flights.do('k', fail))
+        await asyncio.sleep(0)
+        
+        release.set()
+        for caller in (leader, follower):
+            with pytest.raises(ValueError):
+                await caller
+        
+        assert flights.calls == 1
+        assert flights.shared == 1
+        assert 'k' not in flights._flights
+    
+    asyncio.run(run())
+
+
+def test_a_cancelled_leader_does_not_cancel_the_followers():
+    async def run():
+        flights = SingleFlight()
+        release = asyncio.Event()
+        
+        async def work():
+            await release.wait()
+            return 42
+        
+        leader = asyncio.ensure_future(flights.do('k', work))
+        follower = asyncio.ensure_future(flights.do('k', work))
+        await asyncio.sleep(0)
+        
+        leader.cancel()
+        await asyncio.sleep(0)
+        assert leader.cancelled()
+        
+        release.set()
+        assert await follower == 42
+    
+    asyncio.run(run())
+
+
+def test_the_last_waiter_leaving_cancels_the_work():
+    async def run():
+        flights = SingleFlight()
+        started = []
+        cancelled = asyncio.Event()
+        
+        async def work():
+            started.append(None)
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+        
+        callers = [asyncio.ensure_future(flights.do('k', work)) for _ in range(2)]
+        await asyncio.sleep(0)
+        
+        for caller in callers:
+            caller.cancel()
+            await asyncio.sleep(0)
+        
+        await asyncio.wait_for(cancelled.wait(), 1)
+        assert 'k' not in flights._flights
+        
+        # the next caller starts over
+        async def again():
+            return 1
+        
+        assert await flights.do('k', again) == 1
+        assert len(started) == 1
+        assert flights.calls == 2
+    
+    asyncio.run(run())
@@ -0,0 +1,176 @@
+import asyncio
+import fcntl
+import logging
+import os
+import pathlib
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+
+log = logging.getLogger(__name__)
+
+# variants are snapped to these widths so there's a bounded number per file
+WIDTHS = (160, 320, 640, 1280)
+FORMATS = {
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+}
+# what a render raises for files that can't be thumbnailed
+RENDER_ERRORS = (OSError, ValueError, Image.DecompressionBombError)
+# temporary files older than this are left over from a crashed render
+STALE_TMP_SECONDS = 3600
+
+
+# runs in the worker processes
+def render(source, destination, width, fmt):
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.width > width:
+            image.thumbnail((width, image.height))
+        
+        if fmt == 'jpeg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        
+        tmp = f'{destination}.{os.getpid()}.tmp'
+        image.save(tmp, format=fmt.upper(), quality=80)
+    
+    os.replace(tmp, destination)
+    return os.path.getsize(destination)
+
+
+# resized thumbnails made on demand in a process pool and kept on disk,
+# the directory is the cache and is shared by every worker
+#
+# a variant's mtime is bumped every time it's read, once the renders of
+# this worker add up to `scan_size` bytes the directory is scanned under
+# a lock file and the least recently read variants are removed until they
+# take at most `max_size` bytes, so every worker evicts from the same lru
+# and the disk use can only go past it by `scan_size` per worker
+#
+# variants are small, they're read whole before the response starts so
+# an eviction by another worker can't remove them midway, one that was
+# removed between the lookup and the read is rendered again
+#
+# concurrent requests for the same variant in a worker wait on a single
+# render
+class ThumbnailCache:
+    def __init__(self, directory, max_size=1024 * 1024 * 1024, workers=2, scan_size=None):
+        self.directory = pathlib.Path(directory)
+        self.max_size = max_size
+        self.workers = workers
+        self.scan_size = scan_size if scan_size is not None else max_size // 32
+        # bytes on disk as of the last scan, plus this worker's renders
+        self.size = 0
+        
+        self._executor = None
+        # bytes rendered by this worker since the last scan
+        self._rendered = 0
+        self._evicting = None
+        # name -> future of the render
+        self._pending = {}
+    
+    @staticmethod
+    def width(w):
+        return next((x for x in WIDTHS if x >= w), WIDTHS[-1])
+    
+    def _scan(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            
+            now = time.time()
+            entries = []
+            for p in self.directory.iterdir():
+                if p.name == '.lock':
+                    continue
+                
+                try:
+                    st = p.stat()
+                except FileNotFoundError:
+                    continue
+                
+                if p.suffix == '.tmp':
+                    # other workers may be writing to the recent ones
+                    if now - st.st_mtime > STALE_TMP_SECONDS:
+                        p.unlink(missing_ok=True)
+                    continue
+                
+                entries.append((st.st_mtime, p, st.st_size))
+            
+            entries.sort()
+            size = sum(s for _, _, s in entries)
+            for _, p, s in entries:
+                if size <= self.max_size:
+                    break
+                
+                p.unlink(missing_ok=True)
+                size -= s
+            
+            return size
+    
+    async def _evict(self):
+        try:
+            loop = asyncio.get_running_loop()
+            self._rendered = 0
+            self.size = await loop.run_in_executor(None, self._scan)
+        
+        except Exception:
+            log.exception('failed to evict thumbnails')
+        
+        finally:
+            self._evicting = None
+    
+    async def start(self):
+        self._executor = ProcessPoolExecutor(self.workers)
+        await self._evict()
+    
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+    
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+                # marks it as recently used for every worker
+                os.utime(f.fileno())
+        
+        except FileNotFoundError:
+            return None
+        
+        return data
+    
+    async def _render(self, name, source, width, fmt):
+        loop = asyncio.get_running_loop()
+        path = self.directory / name
+        size = await loop.run_in_executor(self._executor, render, str(source), str(path), width, fmt)
+        
+        self.size += size
+        self._rendered += size
+        if self._rendered >= self.scan_size and self._evicting is None:
+            self._evicting = asyncio.ensure_future(self._evict())
+    
+    # the content of the variant
+    async def get(self, file, source, width, fmt):
+        version = file.hash.hex() if file.hash is not None else 'none'
+        name = f'{file.id}-{version}-{width}.{fmt}'
+        path = self.directory / name
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            data = await loop.run_in_executor(None, self._read, path)
+            if data is not None:
+                return data
+            
+            pending = self._pending.get(name)
+            if pending is None:
+                pending = self._pending[name] = asyncio.ensure_future(self._render(name, source, width, fmt))
+                pending.add_done_callback(lambda _: self._pending.pop(name, None))
+            
+            # a cancelled request doesn't cancel the render for the others
+            await asyncio.shield(pending)
@@ -0,0 +1,113 @@
+from hoordu.models import FeedEntry
+from sqlalchemy import Integer, and_, column, exists, or_, select, text, true, tuple_, values
+from sqlalchemy.orm import aliased
+
+from pagination import Keyset, Page, InvalidCursor
+
+
+# each subscription's entries are read newest first from this index, and
+# the other subscriptions holding a post are found through the second one
+TIMELINE_INDEXES = {
+    f'{FeedEntry.__tablename__}_timeline_idx': f'''
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS {FeedEntry.__tablename__}_timeline_idx
+    ON {FeedEntry.__tablename__} (subscription_id, sort_index DESC, remote_post_id DESC)
+    ''',
+    f'{FeedEntry.__tablename__}_post_idx': f'''
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS {FeedEntry.__tablename__}_post_idx
+    ON {FeedEntry.__tablename__} (remote_post_id)
+    ''',
+}
+
+
+# one page of the feeds of several subscriptions merged by sort_index
+#
+# the newest `count` entries of every subscription past the cursor are
+# read in a lateral join, each one an index scan, and merged by the outer
+# order by, ties on sort_index are broken by subscription and post
+#
+# a post in more than one of the subscriptions is only returned for the
+# entry with the highest (sort_index, subscription_id), so it shows up
+# once across all pages
+#
+# the cursor is the full key of the last entry, only forward paging
+class Timeline:
+    def __init__(self):
+        self.keyset = Keyset(FeedEntry.sort_index, FeedEntry.subscription_id, FeedEntry.remote_post_id)
+    
+    async def ensure_indexes(self, engine):
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+            
+            for name, index in TIMELINE_INDEXES.items():
+                # a concurrent build that failed leaves an invalid index
+                # behind that IF NOT EXISTS would keep
+                invalid = (await conn.execute(text('''
+                    SELECT 1 FROM pg_index
+                    WHERE indexrelid = to_regclass(:name) AND NOT indisvalid
+                '''), {'name': name})).first()
+                if invalid is not None:
+                    await conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+                
+                await conn.execute(text(index))
+    
+    def _keys(self, subscription_ids, count, cursor):
+        subs = values(column('id', Integer), name='subs') \
+                .data([(id,) for id in subscription_ids])
+        
+        other = aliased(FeedEntry)
+        duplicate = exists() \
+                .where(
+                    other.remote_post_id == FeedEntry.remote_post_id,
+                    other.subscription_id.in_(subscription_ids),
+                    tuple_(other.sort_index, other.subscription_id) > tuple_(FeedEntry.sort_index, FeedEntry.subscription_id),
+                )
+        
+        where = [FeedEntry.subscription_id == subs.c.id, ~duplicate]
+        if cursor is not None:
+            sort_index, subscription_id, post_id = cursor
+            where.append(FeedEntry.sort_index <= sort_index)
+            where.append(or_(
+                FeedEntry.sort_index < sort_index,
+                subs.c.id < subscription_id,
+                and_(subs.c.id == subscription_id, FeedEntry.remote_post_id < post_id),
+            ))
+        
+        top = select(FeedEntry.sort_index, FeedEntry.subscription_id, FeedEntry.remote_post_id) \
+                .where(*where) \
+                .order_by(FeedEntry.sort_index.desc(), FeedEntry.remote_post_id.desc()) \
+                .limit(count) \
+                .lateral('top')
+        
+        return select(top.c.sort_index, top.c.subscription_id, top.c.remote_post_id) \
+                .select_from(subs) \
+                .join(top, true()) \
+                .order_by(top.c.sort_index.desc(), top.c.subscription_id.desc(), top.c.remote_post_id.desc()) \
+                .limit(count)
+    
+    # `query(session)` selects the FeedEntry objects with their loader options
+    async def fetch(self, session, query, subscription_ids, count, cursor=None):
+        key = None
+        if cursor is not None:
+            key, backward = self.keyset.decode(cursor)
+            if backward:
+                raise InvalidCursor('the timeline can only be paged forward')
+        
+        if not subscription_ids:
+            return Page([])
+        
+        keys = (await session.execute(self._keys(subscription_ids, count, key))).all()
+        if not keys:
+            return Page([])
+        
+        entries = await query(session) \
+                .where(tuple_(FeedEntry.subscription_id, FeedEntry.remote_post_id).in_([(k[1], k[2]) for k in keys])) \
+                .all()
+        
+        by_key = {(e.subscription_id, e.remote_post_id): e for e in entries}
+        items = [by_key[k[1], k[2]] for k in keys if (k[1], k[2]) in by_key]
+        
+        next_cursor = None
+        if len(keys) >= count:
+            next_cursor = self.keyset.encode(tuple(keys[-1]))
+        
+        return Page(items, next_cursor)